@@ -16,6 +16,8 @@ context CONTEXT_TYPE NOT NULL,
 run_started_at TIMESTAMP WITH TIME ZONE NOT NULL,
 run_ended_at TIMESTAMP WITH TIME ZONE,
 total_scraped_items INTEGER,
+-- the run that was resumed by this run, its completed work was skipped
+resumed_run INTEGER REFERENCES spider_runs(id),
 UNIQUE (spider, context, run_started_at)
 );
 
@@ -28,8 +30,65 @@ last_available_change INTEGER REFERENCES spider_runs(id),
 last_available_item JSONB,
 last_detail_check INTEGER REFERENCES spider_runs(id),
 detail_check_needed BOOLEAN NOT NULL,
+-- the start of the run of the last detail check, '-infinity' if there was none yet, so these items come first
+-- it is maintained by the triggers below and is the order in which the details are crawled again
+detail_check_priority TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT '-infinity',
+-- sha256 of the canonical json of last_available_item, computed by the crawler
+last_available_item_hash TEXT,
+-- the details run that leased the item last, the lease ends when the item is written or at lease_expires_at
+lease_owner INTEGER REFERENCES spider_runs(id) ON DELETE SET NULL,
+leased_at TIMESTAMP WITH TIME ZONE,
+lease_expires_at TIMESTAMP WITH TIME ZONE,
+-- the number of successful versions of the detail item and the start of the run of the first one,
+-- maintained by the triggers on details_items_history, they tell how often the item changes (see db:smart ids)
+detail_versions INTEGER NOT NULL DEFAULT 0,
+first_detail_version_at TIMESTAMP WITH TIME ZONE,
 PRIMARY KEY (id, context)
 );
+CREATE INDEX available_items_detail_check_priority ON available_items (context, detail_check_priority, id);
+CREATE INDEX available_items_needed_detail_check_priority ON available_items (context, detail_check_priority, id)
+    WHERE detail_check_needed OR detail_check_priority = '-infinity';
+CREATE INDEX available_items_open_leases ON available_items (lease_owner) WHERE lease_expires_at IS NOT NULL;
+
+CREATE FUNCTION available_items_detail_checked() RETURNS TRIGGER LANGUAGE PLPGSQL AS $$
+    BEGIN
+        NEW.detail_check_priority := COALESCE(
+            (SELECT run_started_at FROM spider_runs WHERE id = NEW.last_detail_check),
+            '-infinity');
+        RETURN NEW;
+    END $$;
+
+CREATE TRIGGER available_items_detail_check_priority_on_insert BEFORE INSERT ON available_items
+    FOR EACH ROW WHEN (NEW.last_detail_check IS NOT NULL) EXECUTE FUNCTION available_items_detail_checked();
+
+CREATE TRIGGER available_items_detail_check_priority_on_update BEFORE UPDATE OF last_detail_check ON available_items
+    FOR EACH ROW WHEN (NEW.last_detail_check IS DISTINCT FROM OLD.last_detail_check)
+    EXECUTE FUNCTION available_items_detail_checked();
+
+-- the search results of the running search_results runs, they are merged into available_items at the end of a run
+-- it is unlogged, because a run that did not finish is never merged anyway
+CREATE UNLOGGED TABLE search_results_staging
+(
+position BIGSERIAL,
+run_id INTEGER NOT NULL REFERENCES spider_runs(id) ON DELETE CASCADE,
+id INTEGER NOT NULL,
+item JSONB NOT NULL,
+item_hash TEXT NOT NULL,
+-- the start index of the search results page of the item
+page_index INTEGER
+);
+CREATE INDEX search_results_staging_run_id ON search_results_staging (run_id, id);
+
+-- the search results pages of the running search_results runs, that are parsed completely,
+-- a resumed run skips them, if all their `items` (the number of distinct ids on the page) are staged
+CREATE UNLOGGED TABLE search_results_checkpoints
+(
+run_id INTEGER NOT NULL REFERENCES spider_runs(id) ON DELETE CASCADE,
+page_index INTEGER NOT NULL,
+items INTEGER NOT NULL,
+total_items INTEGER NOT NULL
+);
+CREATE INDEX search_results_checkpoints_run_id ON search_results_checkpoints (run_id, page_index);
 
 CREATE TYPE DETAIL_STATUS_TYPE AS ENUM ('success', 'error', 'moved');
 CREATE TABLE details_items_history
@@ -39,16 +98,250 @@ context CONTEXT_TYPE,
 created_at INTEGER REFERENCES spider_runs(id),
 item JSONB,
 status DETAIL_STATUS_TYPE NOT NULL,
+-- sha256 of the canonical json of the item, computed by the crawler
+item_hash TEXT,
 PRIMARY KEY (id, context, created_at),
 FOREIGN KEY (id, context) REFERENCES available_items (id, context),
 CHECK ((status = 'success' AND item IS NOT NULL) OR (status != 'success' AND item IS NULL))
+) PARTITION BY LIST (context);
+
+-- each context is partitioned again by ranges of run ids, they are created for each new run (see below)
+-- the default partitions only get rows of runs that were created before the partitions existed
+CREATE TABLE details_items_history_projekt PARTITION OF details_items_history
+    FOR VALUES IN ('projekt') PARTITION BY RANGE (created_at);
+CREATE TABLE details_items_history_person PARTITION OF details_items_history
+    FOR VALUES IN ('person') PARTITION BY RANGE (created_at);
+CREATE TABLE details_items_history_institution PARTITION OF details_items_history
+    FOR VALUES IN ('institution') PARTITION BY RANGE (created_at);
+CREATE TABLE details_items_history_projekt_default PARTITION OF details_items_history_projekt DEFAULT;
+CREATE TABLE details_items_history_person_default PARTITION OF details_items_history_person DEFAULT;
+CREATE TABLE details_items_history_institution_default PARTITION OF details_items_history_institution DEFAULT;
+
+-- the run id range partitions of the history, archived ones are detached and dropped
+CREATE TABLE details_items_history_partitions
+(
+name TEXT PRIMARY KEY,
+context CONTEXT_TYPE NOT NULL,
+first_run INTEGER NOT NULL,
+-- exclusive
+end_run INTEGER NOT NULL,
+archived_at TIMESTAMP WITH TIME ZONE,
+archive_file TEXT,
+UNIQUE (context, first_run)
 );
 
--- this gives the latest item for each id/context from details
-CREATE VIEW latest_detail_items AS
-SELECT DISTINCT ON (h.id, h.context) h.id, h.context, h.created_at, h.item, h.status
-FROM details_items_history h JOIN spider_runs r ON (h.created_at = r.id)
-ORDER BY h.id, h.context, r.run_started_at DESC;
+-- creates the partitions of all contexts for the range of runs that contains the given run, if they do not exist
+-- an archived partition is created again, if there is a new run in its range
+-- concurrent calls (runs started at the same time) wait for each other, so the partitions are only created once
+CREATE FUNCTION create_details_items_history_partitions(run_id INTEGER, runs_per_partition INTEGER DEFAULT 1000)
+RETURNS VOID LANGUAGE PLPGSQL AS $$
+    DECLARE
+        first_run INTEGER := run_id - run_id % runs_per_partition;
+        partition_context CONTEXT_TYPE;
+        partition_name TEXT;
+    BEGIN
+        PERFORM pg_advisory_xact_lock(hashtext('create_details_items_history_partitions'));
+        FOR partition_context IN SELECT UNNEST(enum_range(NULL::CONTEXT_TYPE)) LOOP
+            partition_name := format('details_items_history_%s_%s', partition_context, first_run);
+            IF to_regclass(partition_name) IS NULL THEN
+                EXECUTE format('CREATE TABLE %I PARTITION OF %I FOR VALUES FROM (%s) TO (%s)',
+                               partition_name, 'details_items_history_' || partition_context,
+                               first_run, first_run + runs_per_partition);
+                INSERT INTO details_items_history_partitions (name, context, first_run, end_run)
+                    VALUES (partition_name, partition_context, first_run, first_run + runs_per_partition)
+                    ON CONFLICT (name) DO UPDATE
+                    SET end_run = EXCLUDED.end_run, archived_at = NULL, archive_file = NULL;
+            END IF;
+        END LOOP;
+    END $$;
+
+CREATE FUNCTION spider_run_inserted() RETURNS TRIGGER LANGUAGE PLPGSQL AS $$
+    BEGIN
+        PERFORM create_details_items_history_partitions(NEW.id);
+        RETURN NULL;
+    END $$;
+
+CREATE TRIGGER details_items_history_partitions_on_run AFTER INSERT ON spider_runs
+    FOR EACH ROW EXECUTE FUNCTION spider_run_inserted();
+
+-- the latest version of each item in the archived partitions of the history
+CREATE TABLE details_items_baseline
+(
+id INTEGER,
+context CONTEXT_TYPE,
+created_at INTEGER NOT NULL REFERENCES spider_runs(id),
+item JSONB,
+status DETAIL_STATUS_TYPE NOT NULL,
+item_hash TEXT,
+PRIMARY KEY (id, context),
+FOREIGN KEY (id, context) REFERENCES available_items (id, context)
+);
+
+-- moves the latest versions of the partition into the baseline, then detaches and drops the partition
+-- the partition has to be exported before, to the given file
+CREATE FUNCTION archive_details_items_history_partition(partition_name TEXT, archive_file TEXT)
+RETURNS VOID LANGUAGE PLPGSQL AS $$
+    DECLARE
+        partition details_items_history_partitions;
+    BEGIN
+        SELECT * INTO STRICT partition FROM details_items_history_partitions
+            WHERE name = partition_name AND archived_at IS NULL;
+        EXECUTE format('INSERT INTO details_items_baseline AS b (id, context, created_at, item, status, item_hash)'
+                       ' SELECT DISTINCT ON (h.id) h.id, h.context, h.created_at, h.item, h.status, h.item_hash'
+                       ' FROM %I h JOIN spider_runs r ON (h.created_at = r.id)'
+                       ' ORDER BY h.id, r.run_started_at DESC'
+                       ' ON CONFLICT (id, context) DO UPDATE'
+                       ' SET created_at = EXCLUDED.created_at, item = EXCLUDED.item, status = EXCLUDED.status,'
+                       ' item_hash = EXCLUDED.item_hash'
+                       ' WHERE (SELECT run_started_at FROM spider_runs WHERE id = EXCLUDED.created_at)'
+                       ' >= (SELECT run_started_at FROM spider_runs WHERE id = b.created_at)',
+                       partition_name);
+        EXECUTE format('ALTER TABLE %I DETACH PARTITION %I',
+                       'details_items_history_' || partition.context, partition_name);
+        EXECUTE format('DROP TABLE %I', partition_name);
+        UPDATE details_items_history_partitions
+            SET archived_at = CURRENT_TIMESTAMP, archive_file = archive_details_items_history_partition.archive_file
+            WHERE name = partition_name;
+    END $$;
+
+-- this holds the latest item for each id/context from details
+-- it is maintained by the triggers on details_items_history, in the same transaction as the change of the history
+CREATE TABLE latest_detail_items
+(
+id INTEGER,
+context CONTEXT_TYPE,
+created_at INTEGER NOT NULL REFERENCES spider_runs(id),
+item JSONB,
+status DETAIL_STATUS_TYPE NOT NULL,
+item_hash TEXT,
+PRIMARY KEY (id, context),
+FOREIGN KEY (id, context) REFERENCES available_items (id, context)
+);
+-- used to find the items changed since a run
+CREATE INDEX latest_detail_items_created_at ON latest_detail_items (created_at);
+
+-- the fingerprint of the german details page of each item, from the run that wrote the item the last time
+-- a details run that gets the same fingerprint again only records the check and skips the other pages of the item
+CREATE TABLE details_page_states
+(
+id INTEGER,
+context CONTEXT_TYPE,
+-- sha256 of the html of the content div of the german page, computed by the crawler
+page_hash TEXT NOT NULL,
+-- the validators of the german page for conditional requests and the sha256 of its body, if the server ignores them
+etag TEXT,
+last_modified TEXT,
+body_hash TEXT,
+created_at INTEGER NOT NULL REFERENCES spider_runs(id),
+PRIMARY KEY (id, context),
+FOREIGN KEY (id, context) REFERENCES available_items (id, context)
+);
+
+-- the content of large fields of the detail items (like descriptions and publications), by the sha256 of its json
+-- the items in the history only hold references like {"$blob": "<hash>"}, so the same content is stored once
+CREATE TABLE item_blobs
+(
+hash TEXT PRIMARY KEY,
+content JSONB NOT NULL
+);
+
+-- replaces the references to item_blobs in the item and in its result with their content
+CREATE FUNCTION expand_item_blobs(item JSONB) RETURNS JSONB LANGUAGE PLPGSQL STABLE AS $$
+    DECLARE
+        path TEXT[];
+    BEGIN
+        FOR path IN
+            SELECT ARRAY[key] FROM jsonb_each(CASE WHEN jsonb_typeof(item) = 'object' THEN item END)
+            WHERE jsonb_typeof(value) = 'object' AND value ? '$blob'
+            UNION ALL
+            SELECT ARRAY['result', key]
+            FROM jsonb_each(CASE WHEN jsonb_typeof(item->'result') = 'object' THEN item->'result' END)
+            WHERE jsonb_typeof(value) = 'object' AND value ? '$blob'
+        LOOP
+            item := jsonb_set(item, path,
+                              (SELECT content FROM item_blobs WHERE hash = item #>> (path || '$blob'::TEXT)));
+        END LOOP;
+        RETURN item;
+    END $$;
+
+-- all versions of the items that are not archived, and the latest archived version of each item
+CREATE VIEW details_items_versions AS
+SELECT id, context, created_at, item, status, item_hash FROM details_items_history
+UNION ALL
+SELECT id, context, created_at, item, status, item_hash FROM details_items_baseline;
+
+-- sets the entry in latest_detail_items for this id/context to the latest version (by run start)
+CREATE FUNCTION refresh_latest_detail_item(item_id INTEGER, item_context CONTEXT_TYPE) RETURNS VOID LANGUAGE PLPGSQL AS $$
+    BEGIN
+        DELETE FROM latest_detail_items WHERE id = item_id AND context = item_context;
+        INSERT INTO latest_detail_items (id, context, created_at, item, status, item_hash)
+            SELECT v.id, v.context, v.created_at, v.item, v.status, v.item_hash
+            FROM details_items_versions v JOIN spider_runs r ON (v.created_at = r.id)
+            WHERE v.id = item_id AND v.context = item_context
+            ORDER BY r.run_started_at DESC
+            LIMIT 1;
+    END $$;
+
+-- the latest version of each item as it was after the run `as_of_run`
+-- for runs in archived partitions this is incomplete, the versions before the baseline are only in the archive files
+CREATE FUNCTION detail_items_as_of(as_of_run INTEGER)
+RETURNS TABLE (id INTEGER, context CONTEXT_TYPE, created_at INTEGER, item JSONB, status DETAIL_STATUS_TYPE, item_hash TEXT)
+LANGUAGE SQL STABLE AS $$
+    SELECT DISTINCT ON (v.id, v.context) v.id, v.context, v.created_at, expand_item_blobs(v.item), v.status, v.item_hash
+    FROM details_items_versions v JOIN spider_runs r ON (v.created_at = r.id)
+    WHERE r.run_started_at <= (SELECT run_started_at FROM spider_runs WHERE spider_runs.id = as_of_run)
+    ORDER BY v.id, v.context, r.run_started_at DESC;
+$$;
+
+-- adds (or removes) a successful version of the item to its count in available_items,
+-- archiving a partition does not change the counts
+CREATE FUNCTION count_detail_version(item_id INTEGER, item_context CONTEXT_TYPE, run_id INTEGER, change INTEGER)
+RETURNS VOID LANGUAGE SQL AS $$
+    UPDATE available_items
+        SET detail_versions = GREATEST(detail_versions + change, 0),
+            first_detail_version_at = CASE WHEN change > 0
+                THEN LEAST(first_detail_version_at, (SELECT run_started_at FROM spider_runs WHERE id = run_id))
+                ELSE first_detail_version_at END
+        WHERE id = item_id AND context = item_context;
+$$;
+
+CREATE FUNCTION details_items_history_inserted() RETURNS TRIGGER LANGUAGE PLPGSQL AS $$
+    BEGIN
+        INSERT INTO latest_detail_items AS l (id, context, created_at, item, status, item_hash)
+            VALUES (NEW.id, NEW.context, NEW.created_at, NEW.item, NEW.status, NEW.item_hash)
+            ON CONFLICT (id, context) DO UPDATE
+            SET created_at = EXCLUDED.created_at, item = EXCLUDED.item, status = EXCLUDED.status,
+                item_hash = EXCLUDED.item_hash
+            WHERE (SELECT run_started_at FROM spider_runs WHERE id = EXCLUDED.created_at)
+                >= (SELECT run_started_at FROM spider_runs WHERE id = l.created_at);
+        IF NEW.status = 'success' THEN
+            PERFORM count_detail_version(NEW.id, NEW.context, NEW.created_at, 1);
+        END IF;
+        RETURN NULL;
+    END $$;
+
+CREATE FUNCTION details_items_history_changed() RETURNS TRIGGER LANGUAGE PLPGSQL AS $$
+    BEGIN
+        PERFORM refresh_latest_detail_item(OLD.id, OLD.context);
+        IF TG_OP = 'UPDATE' AND (NEW.id, NEW.context) IS DISTINCT FROM (OLD.id, OLD.context) THEN
+            PERFORM refresh_latest_detail_item(NEW.id, NEW.context);
+        END IF;
+        IF TG_OP = 'DELETE' OR (NEW.id, NEW.context, NEW.status) IS DISTINCT FROM (OLD.id, OLD.context, OLD.status) THEN
+            IF OLD.status = 'success' THEN
+                PERFORM count_detail_version(OLD.id, OLD.context, OLD.created_at, -1);
+            END IF;
+            IF TG_OP = 'UPDATE' AND NEW.status = 'success' THEN
+                PERFORM count_detail_version(NEW.id, NEW.context, NEW.created_at, 1);
+            END IF;
+        END IF;
+        RETURN NULL;
+    END $$;
+
+CREATE TRIGGER latest_detail_items_on_insert AFTER INSERT ON details_items_history
+    FOR EACH ROW EXECUTE FUNCTION details_items_history_inserted();
+
+CREATE TRIGGER latest_detail_items_on_change AFTER UPDATE OR DELETE ON details_items_history
+    FOR EACH ROW EXECUTE FUNCTION details_items_history_changed();
 
 -- this gives the latest item for each id/context from details
 -- if there was an error in the latest item of details, the we try to set it to the latest available item
@@ -56,10 +349,11 @@ ORDER BY h.id, h.context, r.run_started_at DESC;
 CREATE VIEW latest_items AS
 SELECT i.id, i.context,
     CASE
-        WHEN i.status = 'success' THEN i.item
+        WHEN i.status = 'success' THEN expand_item_blobs(i.item)
         WHEN i.status = 'error' AND a.last_available_item IS NOT NULL THEN a.last_available_item
         WHEN i.status = 'error' THEN '{}'::JSONB
-    END AS item
+    END AS item,
+    i.created_at
 FROM latest_detail_items i JOIN available_items a ON (i.id = a.id AND i.context = a.context)
 WHERE i.status != 'moved';
 
@@ -96,23 +390,83 @@ CREATE TYPE INSTITUTION_PROJEKT_BEZIEHUNG_TYPE AS ENUM (
     'igk_institutionen'
 );
 
-CREATE VIEW latest_person_projekt_references AS
-SELECT jsonb_array_elements_text(item->'attributes'->attr_name::TEXT)::INT AS person_id,
-id AS projekt_id,
-attr_name::PERSON_PROJEKT_BEZIEHUNG_TYPE AS reference_type
-FROM latest_detail_items JOIN
-(SELECT UNNEST(enum_range(NULL::PERSON_PROJEKT_BEZIEHUNG_TYPE))::TEXT AS attr_name) attrs
-ON (jsonb_exists(item->'attributes', attr_name))
-WHERE context='projekt';
-
-CREATE VIEW latest_institution_projekt_references AS
-SELECT jsonb_array_elements_text(item->'attributes'->attr_name::TEXT)::INT AS institution_id,
-id AS projekt_id,
-attr_name::INSTITUTION_PROJEKT_BEZIEHUNG_TYPE AS reference_type
-FROM latest_detail_items l JOIN
-(SELECT UNNEST(enum_range(NULL::INSTITUTION_PROJEKT_BEZIEHUNG_TYPE))::TEXT AS attr_name) attrs
-ON (jsonb_exists(l.item->'attributes', attrs.attr_name))
-WHERE context='projekt';
+-- the references between projekte and personen/institutionen in the latest detail items
+-- they are maintained by the triggers on latest_detail_items, only for projekte whose item changed
+CREATE TABLE latest_person_projekt_references
+(
+person_id INTEGER NOT NULL,
+projekt_id INTEGER NOT NULL,
+reference_type PERSON_PROJEKT_BEZIEHUNG_TYPE NOT NULL,
+PRIMARY KEY (projekt_id, reference_type, person_id)
+);
+CREATE INDEX latest_person_projekt_references_person_id ON latest_person_projekt_references (person_id);
+
+CREATE TABLE latest_institution_projekt_references
+(
+institution_id INTEGER NOT NULL,
+projekt_id INTEGER NOT NULL,
+reference_type INSTITUTION_PROJEKT_BEZIEHUNG_TYPE NOT NULL,
+PRIMARY KEY (projekt_id, reference_type, institution_id)
+);
+CREATE INDEX latest_institution_projekt_references_institution_id
+    ON latest_institution_projekt_references (institution_id);
+
+CREATE TYPE PERSON_GENDER_TYPE AS ENUM ('male', 'female', 'unknown');
+
+-- the genders of personen that are guessed from the references of the latest projekt detail items
+CREATE TABLE latest_person_gender_references
+(
+person_id INTEGER NOT NULL,
+projekt_id INTEGER NOT NULL,
+gender PERSON_GENDER_TYPE NOT NULL,
+PRIMARY KEY (projekt_id, gender, person_id)
+);
+CREATE INDEX latest_person_gender_references_person_id ON latest_person_gender_references (person_id);
+
+CREATE FUNCTION latest_projekt_references_removed() RETURNS TRIGGER LANGUAGE PLPGSQL AS $$
+    BEGIN
+        DELETE FROM latest_person_projekt_references WHERE projekt_id = OLD.id;
+        DELETE FROM latest_institution_projekt_references WHERE projekt_id = OLD.id;
+        DELETE FROM latest_person_gender_references WHERE projekt_id = OLD.id;
+        RETURN NULL;
+    END $$;
+
+CREATE FUNCTION latest_projekt_references_added() RETURNS TRIGGER LANGUAGE PLPGSQL AS $$
+    BEGIN
+        IF TG_OP = 'UPDATE' THEN
+            DELETE FROM latest_person_projekt_references WHERE projekt_id = OLD.id;
+            DELETE FROM latest_institution_projekt_references WHERE projekt_id = OLD.id;
+            DELETE FROM latest_person_gender_references WHERE projekt_id = OLD.id;
+        END IF;
+        INSERT INTO latest_person_projekt_references (person_id, projekt_id, reference_type)
+            SELECT jsonb_array_elements_text(attrs.value)::INT, NEW.id, attrs.key::PERSON_PROJEKT_BEZIEHUNG_TYPE
+            FROM jsonb_each(NEW.item->'attributes') attrs
+            WHERE attrs.key IN (SELECT UNNEST(enum_range(NULL::PERSON_PROJEKT_BEZIEHUNG_TYPE))::TEXT)
+            ON CONFLICT DO NOTHING;
+        INSERT INTO latest_institution_projekt_references (institution_id, projekt_id, reference_type)
+            SELECT jsonb_array_elements_text(attrs.value)::INT, NEW.id, attrs.key::INSTITUTION_PROJEKT_BEZIEHUNG_TYPE
+            FROM jsonb_each(NEW.item->'attributes') attrs
+            WHERE attrs.key IN (SELECT UNNEST(enum_range(NULL::INSTITUTION_PROJEKT_BEZIEHUNG_TYPE))::TEXT)
+            ON CONFLICT DO NOTHING;
+        INSERT INTO latest_person_gender_references (person_id, projekt_id, gender)
+            SELECT jsonb_array_elements_text(attrs.value)::INT, NEW.id, split_part(attrs.key, '_', 1)::PERSON_GENDER_TYPE
+            FROM jsonb_each(NEW.item->'attributes') attrs
+            WHERE attrs.key IN ('male_personen', 'female_personen')
+            ON CONFLICT DO NOTHING;
+        RETURN NULL;
+    END $$;
+
+CREATE TRIGGER latest_projekt_references_on_insert AFTER INSERT ON latest_detail_items
+    FOR EACH ROW WHEN (NEW.context = 'projekt') EXECUTE FUNCTION latest_projekt_references_added();
+
+-- items without hash are always handled as changed
+CREATE TRIGGER latest_projekt_references_on_update AFTER UPDATE ON latest_detail_items
+    FOR EACH ROW WHEN (NEW.context = 'projekt'
+        AND (NEW.item_hash IS NULL OR OLD.item_hash IS DISTINCT FROM NEW.item_hash))
+    EXECUTE FUNCTION latest_projekt_references_added();
+
+CREATE TRIGGER latest_projekt_references_on_delete AFTER DELETE ON latest_detail_items
+    FOR EACH ROW WHEN (OLD.context = 'projekt') EXECUTE FUNCTION latest_projekt_references_removed();
 
 CREATE VIEW institution_hierarchy AS
     WITH RECURSIVE institutionen_abhaengigkeiten AS (
@@ -165,8 +519,6 @@ current_index_date TIMESTAMP WITH TIME ZONE NOT NULL
 -------- actual Gepris Schema ------
 ------------------------------------
 
-CREATE TYPE PERSON_GENDER_TYPE AS ENUM ('male', 'female', 'unknown');
-
 CREATE TABLE personen (
   id INTEGER PRIMARY KEY,
   name TEXT NOT NULL,
@@ -230,7 +582,28 @@ CREATE TABLE personen_projekte (
     PRIMARY KEY (person_id, projekt_id, beziehung)
 );
 
-CREATE FUNCTION create_personen_from_items() RETURNS VOID LANGUAGE PLPGSQL AS $$
+-- the latest items that changed after the spider run `since_run` (all of them if it is NULL)
+-- the item is NULL if the id was removed (moved) in the latest detail item
+CREATE FUNCTION latest_items_since(since_run INTEGER) RETURNS TABLE (id INTEGER, context CONTEXT_TYPE, item JSONB)
+LANGUAGE SQL STABLE AS $$
+    SELECT l.id, l.context, i.item
+    FROM latest_detail_items l LEFT JOIN latest_items i ON (l.id = i.id AND l.context = i.context)
+    WHERE since_run IS NULL OR l.created_at > since_run;
+$$;
+
+-- the gender guessed by the projekt references wins over the one of the item, 'female' wins over 'male'
+CREATE FUNCTION person_gender(person_id INTEGER, item_gender PERSON_GENDER_TYPE) RETURNS PERSON_GENDER_TYPE
+LANGUAGE SQL STABLE AS $$
+    SELECT COALESCE(
+        (SELECT g.gender
+         FROM latest_person_gender_references g
+         WHERE g.person_id = person_gender.person_id
+         ORDER BY g.gender = 'female' DESC
+         LIMIT 1),
+        item_gender);
+$$;
+
+CREATE FUNCTION refresh_personen(since_run INTEGER DEFAULT NULL) RETURNS VOID LANGUAGE PLPGSQL AS $$
     BEGIN
         INSERT INTO personen (id, name, adresse, mail, internet, telefax, telefon, orcid_id, verstorben, gender)
             SELECT id,
@@ -242,12 +615,23 @@ CREATE FUNCTION create_personen_from_items() RETURNS VOID LANGUAGE PLPGSQL AS $$
                 item->'attributes'->>'telefon',
                 item->'attributes'->>'orcid_id',
                 (item->>'verstorben')::BOOLEAN,
-                (item->>'gender')::PERSON_GENDER_TYPE
-            FROM latest_items
-            WHERE context = 'person';
+                person_gender(id, (item->>'gender')::PERSON_GENDER_TYPE)
+            FROM latest_items_since(since_run)
+            WHERE context = 'person'
+                AND item IS NOT NULL
+        ON CONFLICT (id) DO UPDATE SET
+            name = EXCLUDED.name,
+            adresse = EXCLUDED.adresse,
+            mail = EXCLUDED.mail,
+            internet = EXCLUDED.internet,
+            telefax = EXCLUDED.telefax,
+            telefon = EXCLUDED.telefon,
+            orcid_id = EXCLUDED.orcid_id,
+            verstorben = EXCLUDED.verstorben,
+            gender = EXCLUDED.gender;
     END $$;
 
-CREATE FUNCTION create_institutionen_from_items() RETURNS VOID LANGUAGE PLPGSQL AS $$
+CREATE FUNCTION refresh_institutionen(since_run INTEGER DEFAULT NULL) RETURNS VOID LANGUAGE PLPGSQL AS $$
     BEGIN
         INSERT INTO institutionen (id, name, adresse, mail, internet, telefax, telefon)
             SELECT id,
@@ -257,11 +641,23 @@ CREATE FUNCTION create_institutionen_from_items() RETURNS VOID LANGUAGE PLPGSQL
                 item->'attributes'->>'internet',
                 item->'attributes'->>'telefax',
                 item->'attributes'->>'telefon'
-            FROM latest_items
-            WHERE context = 'institution';
+            FROM latest_items_since(since_run)
+            WHERE context = 'institution'
+                AND item IS NOT NULL
+        ON CONFLICT (id) DO UPDATE SET
+            name = EXCLUDED.name,
+            adresse = EXCLUDED.adresse,
+            mail = EXCLUDED.mail,
+            internet = EXCLUDED.internet,
+            telefax = EXCLUDED.telefax,
+            telefon = EXCLUDED.telefon;
         -- This recursive monstrosity creates a table with ids and it's parent ids that is used to create the
         -- "uebergeordnete_institution" of an institution
-        WITH RECURSIVE institutionen_abhaengigkeiten AS (
+        -- only the trees of the changed institutionen and the trees that contain a changed institution are used,
+        -- e.g. a new child of an unchanged parent gets its parent from the (unchanged) tree of its root
+        WITH RECURSIVE changed_institutionen AS (
+            SELECT id FROM latest_items_since(since_run) WHERE context = 'institution'
+        ), institutionen_abhaengigkeiten AS (
             -- the base query
             SELECT NULL::INT AS parent_id,
                 id,
@@ -269,6 +665,9 @@ CREATE FUNCTION create_institutionen_from_items() RETURNS VOID LANGUAGE PLPGSQL
             FROM latest_items
             WHERE context = 'institution'
                 AND item->'trees'->'normalised_subinstitutions' IS NOT NULL
+                AND (since_run IS NULL
+                    OR id IN (SELECT id FROM changed_institutionen)
+                    OR id IN (SELECT h.root_id FROM institution_hierarchy h JOIN changed_institutionen c ON c.id = h.id))
             UNION
             -- the recursive query
             SELECT id AS parent_id,
@@ -289,7 +688,7 @@ CREATE FUNCTION create_institutionen_from_items() RETURNS VOID LANGUAGE PLPGSQL
                 AND i.parent_id IS NOT NULL;
     END $$;
 
-CREATE FUNCTION create_projekte_from_items() RETURNS VOID LANGUAGE PLPGSQL AS $$
+CREATE FUNCTION refresh_projekte(since_run INTEGER DEFAULT NULL) RETURNS VOID LANGUAGE PLPGSQL AS $$
     BEGIN
         INSERT INTO projekte (
             id,
@@ -325,7 +724,7 @@ CREATE FUNCTION create_projekte_from_items() RETURNS VOID LANGUAGE PLPGSQL AS $$
                 ARRAY(SELECT jsonb_array_elements_text(item->'attributes'->'geraetegruppe')),
                 item->'attributes'->>'dfg_verfahren',
                 ARRAY(SELECT jsonb_array_elements_text(item->'attributes'->'fachrichtungen')),
-                ARRAY(SELECT jsonb_array_elements_text(item->'attributes'->>'fachliche_zuordnungen')),
+                item->'attributes'->>'fachliche_zuordnungen',
                 item->'attributes'->>'webseite',
                 (item->'attributes'->>'foerderung_beginn')::INT,
                 (item->'attributes'->>'foerderung_ende')::INT,
@@ -334,53 +733,103 @@ CREATE FUNCTION create_projekte_from_items() RETURNS VOID LANGUAGE PLPGSQL AS $$
                 item->'result'->>'ergebnis_zusammenfassung_en',
                 (item->'result'->'attributes'->>'ergebnis_erstellungsjahr')::INT,
                 (item->'attributes'->>'teil_projekt')::INT
-            FROM latest_items
-            WHERE context = 'projekt';
+            FROM latest_items_since(since_run)
+            WHERE context = 'projekt'
+                AND item IS NOT NULL
+        ON CONFLICT (id) DO UPDATE SET
+            name_de = EXCLUDED.name_de,
+            name_en = EXCLUDED.name_en,
+            beschreibung_de = EXCLUDED.beschreibung_de,
+            beschreibung_en = EXCLUDED.beschreibung_en,
+            dfg_ansprechpartner = EXCLUDED.dfg_ansprechpartner,
+            internationaler_bezug = EXCLUDED.internationaler_bezug,
+            gross_geraete = EXCLUDED.gross_geraete,
+            geraetegruppe = EXCLUDED.geraetegruppe,
+            dfg_verfahren = EXCLUDED.dfg_verfahren,
+            fachrichtungen = EXCLUDED.fachrichtungen,
+            fachliche_zuordnungen = EXCLUDED.fachliche_zuordnungen,
+            webseite = EXCLUDED.webseite,
+            foerderung_beginn = EXCLUDED.foerderung_beginn,
+            foerderung_ende = EXCLUDED.foerderung_ende,
+            ergebnis_publikationen = EXCLUDED.ergebnis_publikationen,
+            ergebnis_zusammenfassung_de = EXCLUDED.ergebnis_zusammenfassung_de,
+            ergebnis_zusammenfassung_en = EXCLUDED.ergebnis_zusammenfassung_en,
+            ergebnis_erstellungsjahr = EXCLUDED.ergebnis_erstellungsjahr,
+            teil_projekt_zu = EXCLUDED.teil_projekt_zu;
     END $$;
 
-CREATE FUNCTION create_institutionen_projekte_references() RETURNS VOID LANGUAGE PLPGSQL AS $$
-    DECLARE
-        attribute text;
+-- creates the references of the changed projekte and of the changed personen/institutionen in one pass each
+-- references to personen/institutionen that are not (yet) in the schema are left out
+CREATE FUNCTION refresh_projekte_references(since_run INTEGER DEFAULT NULL) RETURNS VOID LANGUAGE PLPGSQL AS $$
     BEGIN
-        FOR attribute IN SELECT unnest(enum_range(NULL::INSTITUTION_PROJEKT_BEZIEHUNG_TYPE)) LOOP
-            INSERT INTO institutionen_projekte (institution_id, projekt_id, beziehung)
-                SELECT jsonb_array_elements_text(item->'attributes'->attribute::TEXT)::INT AS institution_id,
-            	    id AS projekt_id,
-            	    attribute::INSTITUTION_PROJEKT_BEZIEHUNG_TYPE AS beziehung
-                FROM latest_detail_items
-                WHERE context='projekt';
-        END LOOP;
+        INSERT INTO institutionen_projekte (institution_id, projekt_id, beziehung)
+            SELECT r.institution_id, r.projekt_id, r.reference_type
+            FROM latest_institution_projekt_references r
+                JOIN institutionen i ON (i.id = r.institution_id)
+                JOIN projekte p ON (p.id = r.projekt_id)
+            WHERE since_run IS NULL
+                OR r.projekt_id IN (SELECT id FROM latest_items_since(since_run) WHERE context = 'projekt')
+                OR r.institution_id IN (SELECT id FROM latest_items_since(since_run) WHERE context = 'institution')
+        ON CONFLICT DO NOTHING;
+        INSERT INTO personen_projekte (person_id, projekt_id, beziehung)
+            SELECT r.person_id, r.projekt_id, r.reference_type
+            FROM latest_person_projekt_references r
+                JOIN personen pe ON (pe.id = r.person_id)
+                JOIN projekte p ON (p.id = r.projekt_id)
+            WHERE since_run IS NULL
+                OR r.projekt_id IN (SELECT id FROM latest_items_since(since_run) WHERE context = 'projekt')
+                OR r.person_id IN (SELECT id FROM latest_items_since(since_run) WHERE context = 'person')
+        ON CONFLICT DO NOTHING;
     END $$;
 
-CREATE FUNCTION create_personen_projekte_references() RETURNS VOID LANGUAGE PLPGSQL AS $$
+-- refreshes the gepris schema with the items that changed after the spider run `since_run`
+-- without a run, the schema is rebuilt from all latest items
+CREATE FUNCTION refresh_gepris_schema(since_run INTEGER DEFAULT NULL) RETURNS VOID LANGUAGE PLPGSQL AS $$
     DECLARE
-        attribute text;
-    BEGIN
-        FOR attribute IN SELECT unnest(enum_range(NULL::PERSON_PROJEKT_BEZIEHUNG_TYPE)) LOOP
-            INSERT INTO personen_projekte (person_id, projekt_id, beziehung)
-                SELECT jsonb_array_elements_text(item->'attributes'->attribute::TEXT)::INT AS person_id,
-            	    id AS projekt_id,
-            	    attribute::PERSON_PROJEKT_BEZIEHUNG_TYPE AS beziehung
-                FROM latest_detail_items
-                WHERE context='projekt';
-        END LOOP;
-    END $$;
-
-CREATE FUNCTION update_personen_gender_from_references(male_or_female PERSON_GENDER_TYPE) RETURNS VOID LANGUAGE PLPGSQL AS $$
-    BEGIN
-        WITH projekt_referenced_gender AS (
-            SELECT DISTINCT jsonb_array_elements_text(item->'attributes'->(concat(male_or_female::TEXT, '_personen')))::INT AS id
-            FROM latest_detail_items
-            WHERE context='projekt'
-        )
-        UPDATE personen SET gender = male_or_female
-        WHERE id IN (SELECT * FROM projekt_referenced_gender);
-    END $$;
-
-CREATE FUNCTION handle_projekte_references() RETURNS VOID LANGUAGE PLPGSQL AS $$
+        gender_personen INTEGER[];
     BEGIN
-        PERFORM create_institutionen_projekte_references();
-        PERFORM create_personen_projekte_references();
-        PERFORM update_personen_gender_from_references('male'::PERSON_GENDER_TYPE);
-        PERFORM update_personen_gender_from_references('female'::PERSON_GENDER_TYPE);
+        IF since_run IS NULL THEN
+            TRUNCATE personen_projekte, institutionen_projekte, projekte, personen, institutionen;
+        ELSE
+            -- the genders of these personen may change with the references of the changed projekte
+            SELECT array_agg(DISTINCT person_id) INTO gender_personen FROM (
+                SELECT person_id FROM personen_projekte
+                WHERE projekt_id IN (SELECT id FROM latest_items_since(since_run) WHERE context = 'projekt')
+                UNION
+                SELECT person_id FROM latest_person_gender_references
+                WHERE projekt_id IN (SELECT id FROM latest_items_since(since_run) WHERE context = 'projekt')
+            ) p;
+            -- the references of changed projekte are created again, the ones of removed items are gone
+            DELETE FROM personen_projekte
+                WHERE projekt_id IN (SELECT id FROM latest_items_since(since_run) WHERE context = 'projekt')
+                    OR person_id IN (SELECT id FROM latest_items_since(since_run)
+                                     WHERE context = 'person' AND item IS NULL);
+            DELETE FROM institutionen_projekte
+                WHERE projekt_id IN (SELECT id FROM latest_items_since(since_run) WHERE context = 'projekt')
+                    OR institution_id IN (SELECT id FROM latest_items_since(since_run)
+                                          WHERE context = 'institution' AND item IS NULL);
+            UPDATE projekte SET teil_projekt_zu = NULL
+                WHERE teil_projekt_zu IN (SELECT id FROM latest_items_since(since_run)
+                                          WHERE context = 'projekt' AND item IS NULL);
+            -- the children of changed institutionen get their parent again from the new tree
+            UPDATE institutionen SET uebergeordnete_institution = NULL
+                WHERE uebergeordnete_institution IN (SELECT id FROM latest_items_since(since_run)
+                                                     WHERE context = 'institution');
+            DELETE FROM projekte
+                WHERE id IN (SELECT id FROM latest_items_since(since_run) WHERE context = 'projekt' AND item IS NULL);
+            DELETE FROM personen
+                WHERE id IN (SELECT id FROM latest_items_since(since_run) WHERE context = 'person' AND item IS NULL);
+            DELETE FROM institutionen
+                WHERE id IN (SELECT id FROM latest_items_since(since_run)
+                             WHERE context = 'institution' AND item IS NULL);
+        END IF;
+        PERFORM refresh_personen(since_run);
+        PERFORM refresh_institutionen(since_run);
+        PERFORM refresh_projekte(since_run);
+        PERFORM refresh_projekte_references(since_run);
+        UPDATE personen SET gender = person_gender(personen.id, (i.item->>'gender')::PERSON_GENDER_TYPE)
+            FROM latest_items i
+            WHERE i.id = personen.id
+                AND i.context = 'person'
+                AND personen.id = ANY(gender_personen);
     END $$;
@@ -0,0 +1,85 @@
+------------------------------------
+-------- Upgrade ------------------
+------------------------------------
+
+-- Upgrades a database created by the earlier init/dfg-gepris.sql (details_items_history as a plain table,
+-- latest_detail_items and the projekt references as views) to the current schema, in a single transaction.
+-- A plain table can not become a partitioned one, so the old tables are moved to the schema "legacy",
+-- the current schema is created by init/dfg-gepris.sql and the data is copied into it.
+-- The crawler has to be stopped, run it as the owner of the database (\ir finds init/ relative to this file):
+--   psql -v ON_ERROR_STOP=1 -d dfg-gepris -f database/migrations/upgrade-to-partitioned-history.sql
+-- Afterwards "scrapy collapse_history" computes the hashes of the stored detail items (see the README).
+
+\set ON_ERROR_STOP on
+
+BEGIN;
+
+-- the views, functions and the gepris schema are created again
+DROP VIEW institution_hierarchy, latest_person_projekt_references, latest_institution_projekt_references,
+    latest_items, latest_detail_items;
+DROP FUNCTION handle_projekte_references(), update_personen_gender_from_references(PERSON_GENDER_TYPE),
+    create_personen_projekte_references(), create_institutionen_projekte_references(),
+    create_projekte_from_items(), create_institutionen_from_items(), create_personen_from_items();
+DROP TABLE personen_projekte, institutionen_projekte, projekte, personen, institutionen;
+DROP TYPE PERSON_PROJEKT_BEZIEHUNG_TYPE, INSTITUTION_PROJEKT_BEZIEHUNG_TYPE, PERSON_GENDER_TYPE;
+
+-- the tables with data and their types are kept until they are copied
+CREATE SCHEMA legacy;
+ALTER TABLE details_items_history SET SCHEMA legacy;
+ALTER TABLE available_items SET SCHEMA legacy;
+ALTER TABLE spider_runs SET SCHEMA legacy;
+ALTER TABLE data_monitor SET SCHEMA legacy;
+ALTER SEQUENCE spider_runs_id SET SCHEMA legacy;
+ALTER TYPE SPIDER_TYPE SET SCHEMA legacy;
+ALTER TYPE CONTEXT_TYPE SET SCHEMA legacy;
+ALTER TYPE DETAIL_STATUS_TYPE SET SCHEMA legacy;
+
+\ir ../init/dfg-gepris.sql
+
+-- the partitions of the history are created by the trigger on spider_runs
+INSERT INTO spider_runs (id, spider, context, run_started_at, run_ended_at, total_scraped_items)
+    SELECT id, spider::TEXT::SPIDER_TYPE, context::TEXT::CONTEXT_TYPE, run_started_at, run_ended_at, total_scraped_items
+    FROM legacy.spider_runs
+    ORDER BY id;
+SELECT setval('spider_runs_id', last_value, is_called) FROM legacy.spider_runs_id;
+
+-- the detail_check_priority is set by the trigger on available_items
+INSERT INTO available_items (id, context, last_available_seen, last_available_change, last_available_item,
+                             last_detail_check, detail_check_needed)
+    SELECT id, context::TEXT::CONTEXT_TYPE, last_available_seen, last_available_change, last_available_item,
+        last_detail_check, detail_check_needed
+    FROM legacy.available_items;
+
+-- the triggers of the history would update latest_detail_items and the version counts for every row,
+-- they are filled at once below instead (the copied rows were consistent, so the foreign keys are not checked again)
+SET LOCAL session_replication_role = replica;
+INSERT INTO details_items_history (id, context, created_at, item, status)
+    SELECT id, context::TEXT::CONTEXT_TYPE, created_at, item, status::TEXT::DETAIL_STATUS_TYPE
+    FROM legacy.details_items_history;
+SET LOCAL session_replication_role = DEFAULT;
+
+-- the triggers of latest_detail_items fill the projekt reference tables
+INSERT INTO latest_detail_items (id, context, created_at, item, status)
+    SELECT DISTINCT ON (h.id, h.context) h.id, h.context, h.created_at, h.item, h.status
+    FROM details_items_history h JOIN spider_runs r ON r.id = h.created_at
+    ORDER BY h.id, h.context, r.run_started_at DESC;
+
+UPDATE available_items a
+    SET detail_versions = v.versions, first_detail_version_at = v.first_version
+    FROM (
+        SELECT h.id, h.context, count(*) AS versions, min(r.run_started_at) AS first_version
+        FROM details_items_history h JOIN spider_runs r ON r.id = h.created_at
+        WHERE h.status = 'success'
+        GROUP BY h.id, h.context
+    ) v
+    WHERE a.id = v.id AND a.context = v.context;
+
+INSERT INTO data_monitor SELECT * FROM legacy.data_monitor;
+
+SELECT refresh_gepris_schema();
+
+DROP SCHEMA legacy CASCADE;
+
+COMMIT;
+
+ANALYZE;
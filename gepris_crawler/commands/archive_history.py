@@ -0,0 +1,35 @@
+import os
+
+from scrapy.commands import ScrapyCommand
+
+from gepris_crawler.database import PostgresDatabase
+
+
+class Command(ScrapyCommand):
+    requires_project = True
+    requires_crawler_process = False
+
+    def short_desc(self):
+        return 'Archive old partitions of the details_items_history to compressed csv files'
+
+    def add_options(self, parser):
+        super().add_options(parser)
+        parser.add_argument('--keep', type=int, default=None,
+                            help='number of the newest partitions of each context that are not archived'
+                                 ' (defaults to HISTORY_ARCHIVE_KEEP_PARTITIONS)')
+        parser.add_argument('--directory', default=None,
+                            help='directory the archive files are written to (defaults to HISTORY_ARCHIVE_DIRECTORY)')
+
+    def run(self, args, opts):
+        keep = opts.keep if opts.keep is not None else self.settings.getint('HISTORY_ARCHIVE_KEEP_PARTITIONS', 2)
+        directory = opts.directory or self.settings.get('HISTORY_ARCHIVE_DIRECTORY')
+        os.makedirs(directory, exist_ok=True)
+        db = PostgresDatabase(self.settings)
+        db.open()
+        try:
+            for name in db.get_archivable_history_partitions(keep):
+                path = os.path.join(directory, f'{name}.csv.gz')
+                db.archive_history_partition(name, path)
+                print(f'Archived {name} to {path}')
+        finally:
+            db.close()
@@ -0,0 +1,62 @@
+from scrapy.commands import ScrapyCommand
+from scrapy.exceptions import UsageError
+
+from gepris_crawler.database import PostgresDatabase, hash_item
+from gepris_crawler.normalisation.canonicalisation import canonicalise
+
+
+class Command(ScrapyCommand):
+    requires_project = True
+    requires_crawler_process = False
+
+    def short_desc(self):
+        return 'Bring the stored detail items into their canonical form and remove the versions that did not change'
+
+    def add_options(self, parser):
+        super().add_options(parser)
+        parser.add_argument('--context', action='append', choices=['projekt', 'person', 'institution'],
+                            help='context of the items, can be given multiple times (defaults to all contexts)')
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='number of changed versions that are written in one transaction')
+
+    def run(self, args, opts):
+        if opts.batch_size < 1:
+            raise UsageError('--batch-size has to be at least 1')
+        db = PostgresDatabase(self.settings)
+        db.open()
+        try:
+            for context in opts.context or ['projekt', 'person', 'institution']:
+                removed_count, rewritten_count = self.collapse(db, context, opts.batch_size)
+                print(f'Removed {removed_count} and rewrote {rewritten_count} versions of context {context}')
+        finally:
+            db.close()
+
+    @staticmethod
+    def collapse(db, context, batch_size):
+        """
+        A version is removed, if it has the same status and canonical item as the previous version of the id.
+        The remaining versions get their canonical item (and its hash), if it differs from the stored one.
+        @return: Tuple with the number of (removed, rewritten) versions
+        """
+        removed = []
+        rewritten = []
+        removed_count = 0
+        rewritten_count = 0
+        previous = None
+        for item_id, created_at, item, status, item_hash in db.iter_history_versions(context):
+            canonical_item = None if item is None else canonicalise(item)
+            canonical_hash = hash_item(canonical_item)
+            if previous == (item_id, status, canonical_hash):
+                removed.append((item_id, created_at))
+            else:
+                previous = (item_id, status, canonical_hash)
+                if canonical_hash != item_hash or canonical_item != item:
+                    rewritten.append((item_id, created_at, canonical_item))
+            if len(removed) + len(rewritten) >= batch_size:
+                db.collapse_history_versions(context, removed, rewritten)
+                removed_count += len(removed)
+                rewritten_count += len(rewritten)
+                removed = []
+                rewritten = []
+        db.collapse_history_versions(context, removed, rewritten)
+        return removed_count + len(removed), rewritten_count + len(rewritten)
@@ -12,3 +12,7 @@ class PageDoesNotExistAnymoreError(Exception):
 
 class UnexpectedDetailsPageStructure(Exception):
     pass
+
+
+class PageUnchangedError(Exception):
+    pass
@@ -1,8 +1,192 @@
+import csv
+import gzip
+import hashlib
+import io
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
 import psycopg2
+from psycopg2 import sql
 from psycopg2.extras import Json
+from psycopg2.pool import ThreadedConnectionPool
 from pypika import PostgreSQLQuery, Table
 from pypika.functions import CurTimestamp, Cast
-from pypika.terms import ExistsCriterion, PseudoColumn, CustomFunction, Field
+from pypika.terms import ExistsCriterion, Field
+
+logger = logging.getLogger(__name__)
+
+
+def canonical_json(value):
+    return json.dumps(value, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+
+
+def hash_item(item_or_none):
+    """
+    Computes the hash that is stored with each item in the details_items_history
+    @param item_or_none: The item, or None for items without content (like 'moved' or 'error' ones)
+    @return: The sha256 hexdigest of the json of the item with sorted keys, or None
+    """
+    if item_or_none is None:
+        return None
+    return hashlib.sha256(canonical_json(dict(item_or_none)).encode('utf-8')).hexdigest()
+
+
+# the paths of the large fields of detail items, their content is stored in the item_blobs table
+BLOB_FIELDS = [
+    ('beschreibung_de',),
+    ('beschreibung_en',),
+    ('result', 'ergebnis_publikationen'),
+    ('result', 'ergebnis_zusammenfassung_de'),
+    ('result', 'ergebnis_zusammenfassung_en'),
+]
+# smaller contents are kept in the item, a reference is not much shorter
+BLOB_MIN_LENGTH = 200
+
+
+def split_item_blobs(item_or_none):
+    """
+    Replaces the content of the BLOB_FIELDS of the item with references like {"$blob": hash},
+    the content is stored once in the item_blobs table and expanded again by the latest_items view
+    @param item_or_none: The item, or None for items without content
+    @return: Tuple of the json of the item with the references (or None) and a list of tuples like (hash, content json)
+    """
+    if item_or_none is None:
+        return None, []
+    item = dict(item_or_none)
+    blobs = []
+    for path in BLOB_FIELDS:
+        parent = item
+        for key in path[:-1]:
+            if not isinstance(parent.get(key), dict):
+                break
+            # the nested dicts are copied, so the original item keeps its content
+            parent[key] = dict(parent[key])
+            parent = parent[key]
+        else:
+            content = parent.get(path[-1])
+            if content is None:
+                continue
+            content_json = canonical_json(content)
+            if len(content_json) < BLOB_MIN_LENGTH:
+                continue
+            blob_hash = hashlib.sha256(content_json.encode('utf-8')).hexdigest()
+            parent[path[-1]] = {'$blob': blob_hash}
+            blobs.append((blob_hash, content_json))
+    return json.dumps(item), blobs
+
+
+# items stored before there were hashes are compared by their json
+SEARCH_RESULT_CHANGED = " CASE WHEN items.last_available_item_hash IS NULL" \
+                        " THEN items.last_available_item IS DISTINCT FROM EXCLUDED.last_available_item" \
+                        " ELSE items.last_available_item_hash IS DISTINCT FROM EXCLUDED.last_available_item_hash END"
+
+# doesn't seem to work with pypika yet because of missing distinct from
+UPSERT_SEARCH_RESULT_CONFLICT = " ON CONFLICT (id, context) DO UPDATE" \
+                                " SET last_available_seen = EXCLUDED.last_available_seen," \
+                                " last_available_change = CASE " \
+                                " WHEN" + SEARCH_RESULT_CHANGED + \
+                                " THEN EXCLUDED.last_available_change" \
+                                " ELSE items.last_available_change END," \
+                                " last_available_item = EXCLUDED.last_available_item," \
+                                " last_available_item_hash = EXCLUDED.last_available_item_hash," \
+                                " detail_check_needed = CASE " \
+                                " WHEN" + SEARCH_RESULT_CHANGED + \
+                                " AND items.last_available_seen IS NOT NULL" \
+                                " THEN True" \
+                                " ELSE items.detail_check_needed END"
+
+# merges the staged search results of a run into available_items in a single statement:
+# staged ids are inserted or updated, the ids of the context that were not staged have disappeared
+# (only after a run over all pages, a delta run does not see most of the ids)
+# both parts see the available_items from before the statement, so they do not touch the same rows
+MERGE_SEARCH_RESULTS = "WITH staged AS (" \
+                       " SELECT DISTINCT ON (id) id, item, item_hash FROM search_results_staging" \
+                       " WHERE run_id = %(run_id)s ORDER BY id, position DESC" \
+                       "), merged AS (" \
+                       " INSERT INTO available_items AS items" \
+                       " (id, context, last_available_seen, last_available_change, last_available_item," \
+                       " last_available_item_hash, detail_check_needed)" \
+                       " SELECT id, %(context)s, %(run_id)s, %(run_id)s, item, item_hash, True FROM staged" + \
+                       UPSERT_SEARCH_RESULT_CONFLICT + \
+                       " RETURNING xmax = 0 AS inserted, last_available_change = %(run_id)s AS changed" \
+                       "), disappeared AS (" \
+                       " UPDATE available_items AS items" \
+                       " SET detail_check_needed = True, last_available_item = NULL," \
+                       " last_available_item_hash = NULL, last_available_change = %(run_id)s" \
+                       " WHERE %(mark_disappeared)s AND items.context = %(context)s" \
+                       " AND items.last_available_item IS NOT NULL" \
+                       " AND NOT EXISTS (SELECT * FROM staged WHERE staged.id = items.id)" \
+                       " RETURNING items.id" \
+                       ")" \
+                       " SELECT (SELECT count(*) FROM merged WHERE inserted)," \
+                       " (SELECT count(*) FROM merged WHERE changed AND NOT inserted)," \
+                       " (SELECT count(*) FROM disappeared)"
+
+# the columns of details_page_states, that describe the german page of an item
+PAGE_STATE_FIELDS = ['page_hash', 'etag', 'last_modified', 'body_hash']
+
+# the statements that are executed for every item or batch by their name, their durations are collected per name
+# the batch statements read temporary tables, so a prepared plan could not be reused for them anyway
+STATEMENTS = {
+    # a detail check also ends the lease of the item
+    'upsert_detail_available_item':
+        "INSERT INTO available_items AS items (id, context, last_detail_check, detail_check_needed)"
+        " VALUES (%(id)s, %(context)s, %(run_id)s, False) ON CONFLICT (id, context) DO UPDATE"
+        " SET last_detail_check = EXCLUDED.last_detail_check,"
+        " detail_check_needed = False,"
+        " lease_expires_at = NULL",
+    'upsert_detail_available_items':
+        "INSERT INTO available_items AS items (id, context, last_detail_check, detail_check_needed)"
+        " SELECT DISTINCT u.id, %(context)s::CONTEXT_TYPE, %(run_id)s, False FROM unnest(%(ids)s::INTEGER[]) AS u(id)"
+        " ON CONFLICT (id, context) DO UPDATE"
+        " SET last_detail_check = EXCLUDED.last_detail_check,"
+        " detail_check_needed = False,"
+        " lease_expires_at = NULL",
+    # the states of the german pages of the written items, the item has to be in available_items already
+    'upsert_details_page_states':
+        "INSERT INTO details_page_states AS states (id, context, page_hash, etag, last_modified, body_hash, created_at)"
+        " SELECT u.id, %(context)s::CONTEXT_TYPE, u.page_hash, u.etag, u.last_modified, u.body_hash, %(run_id)s"
+        " FROM unnest(%(ids)s::INTEGER[], %(page_hash)s::TEXT[], %(etag)s::TEXT[], %(last_modified)s::TEXT[],"
+        " %(body_hash)s::TEXT[]) AS u(id, page_hash, etag, last_modified, body_hash)"
+        " ON CONFLICT (id, context) DO UPDATE"
+        " SET page_hash = EXCLUDED.page_hash,"
+        " etag = EXCLUDED.etag,"
+        " last_modified = EXCLUDED.last_modified,"
+        " body_hash = EXCLUDED.body_hash,"
+        " created_at = EXCLUDED.created_at",
+    'upsert_search_result_available_item':
+        "INSERT INTO available_items AS items"
+        " (id, context, last_available_seen, last_available_change, last_available_item, last_available_item_hash,"
+        " detail_check_needed)"
+        " VALUES (%(id)s, %(context)s, %(run_id)s, %(run_id)s, %(item)s, %(item_hash)s, True)"
+        + UPSERT_SEARCH_RESULT_CONFLICT,
+    # the temporary table is created in the same transaction, before the statement is executed
+    'insert_item_blobs':
+        "INSERT INTO item_blobs (hash, content)"
+        " SELECT DISTINCT ON (hash) hash, content FROM item_blobs_batch"
+        " ON CONFLICT (hash) DO NOTHING",
+    'insert_detail_item':
+        "INSERT INTO details_items_history (id, context, created_at, item, status, item_hash)"
+        " SELECT %(id)s, %(context)s::CONTEXT_TYPE, %(run_id)s, %(item)s::JSONB, %(status)s::DETAIL_STATUS_TYPE,"
+        " %(item_hash)s"
+        " WHERE NOT EXISTS (SELECT * FROM latest_detail_items WHERE id = %(id)s AND context = %(context)s"
+        " AND status = %(status)s AND item_hash IS NOT DISTINCT FROM %(item_hash)s::TEXT)",
+    # the temporary table is created in the same transaction, before the statement is executed
+    'insert_detail_items':
+        "INSERT INTO details_items_history (id, context, created_at, item, status, item_hash)"
+        " SELECT b.id, %(context)s::CONTEXT_TYPE, %(run_id)s, b.item, b.status, b.item_hash"
+        " FROM detail_items_batch b"
+        " WHERE NOT EXISTS (SELECT * FROM latest_detail_items l"
+        " WHERE l.id = b.id AND l.context = %(context)s AND l.status = b.status"
+        " AND l.item_hash IS NOT DISTINCT FROM b.item_hash)",
+    'update_run_result':
+        "UPDATE spider_runs SET run_ended_at = CURRENT_TIMESTAMP, total_scraped_items = %(total_items)s"
+        " WHERE id = %(run_id)s",
+}
 
 
 class PostgresDatabase:
@@ -13,126 +197,531 @@ class PostgresDatabase:
         self.password = scrapy_settings.get('DATABASE_PASSWORD')
         self.host = scrapy_settings.get('DATABASE_HOST')
         self.port = scrapy_settings.get('DATABASE_PORT')
-        self.connection = None
+        self.pool_size = max(scrapy_settings.getint('DATABASE_POOL_SIZE', 2), 1)
+        if scrapy_settings.getbool('DATABASE_ASYNC_WRITES') and self.pool_size < 2:
+            # the writer thread and the calls of the spider need a connection each, otherwise they wait for each other
+            raise ValueError(f'DATABASE_POOL_SIZE has to be at least 2 with DATABASE_ASYNC_WRITES,'
+                             f' but was {self.pool_size}')
+        self.retries = scrapy_settings.getint('DATABASE_RETRIES', 3)
+        self.health_check_after = scrapy_settings.getfloat('DATABASE_HEALTH_CHECK_AFTER', 60)
+        self.pool = None
+        # the pool raises an error if it is exhausted, so we wait for a free connection before taking one
+        self._free_connections = None
+        self._last_used = {}
+        # the executions and the cumulative time of the STATEMENTS by their name
+        self._statement_stats = {}
+        self._statement_stats_lock = threading.Lock()
 
     def open(self):
-        self.connection = psycopg2.connect(
+        self.pool = ThreadedConnectionPool(
+            1,
+            self.pool_size,
             dbname=self.name,
             user=self.user,
             password=self.password,
             host=self.host,
             port=self.port
         )
+        self._free_connections = threading.BoundedSemaphore(self.pool_size)
 
     def close(self):
-        self.connection.close()
-        self.connection = None
+        self.pool.closeall()
+        self.pool = None
+        self._last_used = {}
+
+    @contextmanager
+    def connection(self):
+        """
+        Takes a healthy connection from the pool and gives it back afterwards.
+        The transaction is committed at the end of the block, or rolled back if there was an error.
+        Can be used by several threads at once.
+        """
+        with self._free_connections:
+            connection = self._get_healthy_connection()
+            try:
+                yield connection
+                connection.commit()
+            except BaseException:
+                try:
+                    connection.rollback()
+                except psycopg2.Error:
+                    # the connection is broken, it is discarded below
+                    pass
+                raise
+            finally:
+                self._put_connection(connection)
+
+    @contextmanager
+    def dedicated_connection(self):
+        """
+        Opens a connection outside of the pool for long running reads (like server side cursors),
+        so they do not keep a connection of the pool from the writer thread and the other calls.
+        It is closed at the end of the block.
+        """
+        connection = psycopg2.connect(dbname=self.name, user=self.user, password=self.password, host=self.host,
+                                      port=self.port)
+        try:
+            yield connection
+        finally:
+            connection.close()
+
+    def _get_healthy_connection(self):
+        connection = self.pool.getconn()
+        last_used = self._last_used.get(connection)
+        if connection.closed or (last_used is not None and time.monotonic() - last_used > self.health_check_after
+                                 and not self._is_healthy(connection)):
+            logger.info('Replacing broken database connection')
+            self._last_used.pop(connection, None)
+            self.pool.putconn(connection, close=True)
+            connection = self.pool.getconn()
+        return connection
+
+    def _is_healthy(self, connection):
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT 1')
+            connection.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _put_connection(self, connection):
+        if connection.closed:
+            self._last_used.pop(connection, None)
+            self.pool.putconn(connection, close=True)
+        else:
+            self._last_used[connection] = time.monotonic()
+            self.pool.putconn(connection)
+
+    def run_in_transaction(self, func, idempotent=False):
+        """
+        Calls `func` with a cursor and commits the transaction afterwards.
+        If the connection is lost, idempotent transactions are retried on a new connection.
+        @param func: Function that gets the cursor, its result is returned
+        @param idempotent: Whether the transaction can be run again, even if the lost one was committed after all
+        @return: The result of `func`
+        """
+        attempt = 0
+        while True:
+            try:
+                with self.connection() as connection:
+                    with connection.cursor() as cursor:
+                        return func(cursor)
+            except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+                if not idempotent or attempt >= self.retries:
+                    raise
+                attempt += 1
+                logger.warning(f'Database transaction failed, retrying ({attempt}/{self.retries}): {e}')
+                time.sleep(attempt)
 
-    def execute_sql(self, sql, params=None, fetch=False):
-        results = None
-        with self.connection.cursor() as cursor:
+    def execute_sql(self, sql, params=None, fetch=False, idempotent=False):
+        def execute(cursor):
             if params is None:
                 cursor.execute(sql)
             else:
                 cursor.execute(sql, params)
             if fetch:
-                results = cursor.fetchall()
-        self.connection.commit()
-        return results
+                return cursor.fetchall()
+            return None
+
+        return self.run_in_transaction(execute, idempotent=idempotent)
+
+    def execute_statement(self, cursor, name, params=None):
+        """
+        Executes one of the STATEMENTS and adds its duration to the statement stats
+        @param cursor: The cursor of the currently open transaction
+        @param name: The name of the statement
+        @param params: dict with the values of the named parameters of the statement
+        """
+        start = time.perf_counter()
+        cursor.execute(STATEMENTS[name], params)
+        duration = time.perf_counter() - start
+        with self._statement_stats_lock:
+            count, total_duration = self._statement_stats.get(name, (0, 0.0))
+            self._statement_stats[name] = (count + 1, total_duration + duration)
+
+    def get_statement_stats(self):
+        """
+        @return: dict with a tuple (executions, cumulative seconds) for each of the STATEMENTS that was executed
+        """
+        with self._statement_stats_lock:
+            return dict(self._statement_stats)
+
+    def copy_rows(self, cursor, table, columns, rows):
+        """
+        Writes the rows with a single COPY statement into the given table
+        @param cursor: The cursor of the currently open transaction
+        @param table: The name of the (mostly temporary) table
+        @param columns: The column names of the table, in the order of the values in each row
+        @param rows: List of tuples, `None` values are written as NULL
+        """
+        data = io.StringIO()
+        csv.writer(data).writerows(rows)
+        data.seek(0)
+        cursor.copy_expert(f"COPY {table} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)", data)
 
     def get_ids(self, context, only_needed=False, limit=0):
+        return [item_id for item_id, _ in self.iter_ids(context, only_needed=only_needed, limit=limit)]
+
+    def iter_ids(self, context, only_needed=False, limit=0, chunk_size=1000):
+        """
+        Streams the ids from a server side cursor, ids without a detail check come first,
+        the other ones ordered by the start of the run of their last detail check.
+        The cursor has its own connection (see `dedicated_connection`) until all ids are read or the generator is closed.
+        @param only_needed: Only ids without a detail check or where a detail check is needed
+        @param limit: The maximum number of ids, 0 for all ids
+        @param chunk_size: The number of ids fetched from the cursor at once
+        @return: Generator of tuples like (id, item_hash), with the hash of the latest successful detail item or None
+        """
         items = Table('available_items')
-        runs = Table('spider_runs')
-        no_detail_yet = PostgreSQLQuery \
-            .from_(items) \
-            .select(items.id) \
-            .where(items.context == context) \
-            .where(items.last_detail_check.isnull())
-        detail_available = PostgreSQLQuery \
+        latest_detail_items = Table('latest_detail_items')
+        # both orders are index range scans, see the indexes on available_items
+        q = PostgreSQLQuery \
             .from_(items) \
-            .select(items.id) \
-            .join(runs) \
-            .on(items.last_detail_check == runs.id) \
+            .select(items.id, latest_detail_items.item_hash) \
+            .left_join(latest_detail_items) \
+            .on((latest_detail_items.id == items.id)
+                & (latest_detail_items.context == items.context)
+                & (latest_detail_items.status == 'success')) \
             .where(items.context == context) \
-            .orderby(runs.run_started_at)
+            .orderby(items.detail_check_priority, items.id)
         if only_needed:
-            detail_available = detail_available.where(items.detail_check_needed)
-        q = no_detail_yet.union_all(detail_available)
+            q = q.where(items.detail_check_needed | (items.detail_check_priority == '-infinity'))
         if limit > 0:
             q = q.limit(limit)
-        results = self.execute_sql(q.get_sql(), fetch=True)
-        return [result[0] for result in results]
+        return self.iter_rows(q.get_sql(), chunk_size=chunk_size)
+
+    def iter_rows(self, sql, params=None, chunk_size=1000):
+        """
+        Streams the rows of the query from a server side cursor on its own connection (see `dedicated_connection`),
+        which is kept until all rows are read or the generator is closed.
+        @param chunk_size: The number of rows fetched from the cursor at once
+        @return: Generator of the rows
+        """
+        with self.dedicated_connection() as connection:
+            with connection.cursor(name='rows') as cursor:
+                cursor.itersize = chunk_size
+                cursor.execute(sql, params)
+                for row in cursor:
+                    yield row
+
+    def iter_smart_ids(self, context, limit, prior_days=180, finished_after_years=1, chunk_size=1000):
+        """
+        Chooses the ids, whose detail check most likely finds a change. Ids without a detail check
+        or where a detail check is needed (their search result changed) come first, the other ones are ordered
+        by the probability, that their item changed since their last detail check: 1 - exp(-rate * days since the check).
+        The rate of changes per day of an item is learned from its number of versions (`detail_versions` of
+        available_items, kept by the triggers on details_items_history), starting from the rate of its segment
+        (projekte that ended `finished_after_years` ago and all other items), which counts as observed for `prior_days`
+        days. So items with few observations get the rate of their segment.
+        The ids are streamed like in `iter_ids`.
+        @param limit: The maximum number of ids
+        @param chunk_size: The number of ids fetched from the cursor at once
+        @return: Generator of tuples like (id, item_hash, probability of a change),
+        with the hash of the latest successful detail item or None
+        """
+        return self.iter_rows("WITH features AS ("
+                              " SELECT a.id, l.item_hash,"
+                              " a.detail_check_needed OR a.detail_check_priority = '-infinity' AS needed,"
+                              " greatest(a.detail_versions - 1, 0) AS changes,"
+                              " coalesce(greatest(extract(EPOCH FROM a.detail_check_priority - a.first_detail_version_at)"
+                              " / 86400, 0), 0) AS observed_days,"
+                              " CASE WHEN a.detail_check_priority = '-infinity' THEN 0"
+                              " ELSE greatest(extract(EPOCH FROM CURRENT_TIMESTAMP - a.detail_check_priority)"
+                              " / 86400, 0) END AS unchecked_days,"
+                              " coalesce((l.item->'attributes'->>'foerderung_ende')::INT"
+                              " <= extract(YEAR FROM CURRENT_DATE) - %(finished_after_years)s, False) AS finished"
+                              " FROM available_items a"
+                              " LEFT JOIN latest_detail_items l"
+                              " ON l.id = a.id AND l.context = a.context AND l.status = 'success'"
+                              " WHERE a.context = %(context)s"
+                              "), segments AS ("
+                              " SELECT finished, sum(changes) / greatest(sum(observed_days), 1) AS rate"
+                              " FROM features GROUP BY finished"
+                              ")"
+                              ", scored AS ("
+                              " SELECT f.id, f.item_hash, f.needed,"
+                              # the exponent is limited, exp() fails on an underflow
+                              " CASE WHEN f.needed THEN 1 ELSE 1 - exp(-least((f.changes + s.rate * %(prior_days)s)"
+                              " / (f.observed_days + %(prior_days)s) * f.unchecked_days, 50)) END AS probability"
+                              " FROM features f JOIN segments s ON s.finished = f.finished"
+                              ")"
+                              " SELECT id, item_hash, probability::FLOAT8 FROM scored"
+                              " ORDER BY needed DESC, probability DESC, id"
+                              " LIMIT %(limit)s",
+                              params={'context': context, 'limit': limit, 'prior_days': prior_days,
+                                      'finished_after_years': finished_after_years},
+                              chunk_size=chunk_size)
+
+    def get_completed_detail_ids(self, spider):
+        """
+        @return: Set of the ids, that were already checked by the run resumed by the run of the spider
+        (or by the runs that one resumed)
+        """
+        rows = self.execute_sql("WITH RECURSIVE resumed_runs AS ("
+                                " SELECT resumed_run AS id FROM spider_runs"
+                                " WHERE id = %(run_id)s AND resumed_run IS NOT NULL"
+                                " UNION"
+                                " SELECT r.resumed_run FROM spider_runs r JOIN resumed_runs ON r.id = resumed_runs.id"
+                                " WHERE r.resumed_run IS NOT NULL"
+                                ")"
+                                " SELECT a.id FROM available_items a JOIN resumed_runs r ON a.last_detail_check = r.id"
+                                " WHERE a.context = %(context)s",
+                                params={'run_id': spider.run_id, 'context': spider.context}, fetch=True)
+        return {row[0] for row in rows}
+
+    def lease_ids(self, spider, only_needed=False, limit=100, lease_seconds=1800):
+        """
+        Leases the next ids of the context for the run of the spider, ids leased by other runs are skipped,
+        so any number of details runs can work on the same context without fetching an id twice.
+        A lease ends when the item is written, or when it expires (then the id can be leased again).
+        Without `only_needed`, the ids leased by any run since this run started are not leased again.
+        @param only_needed: Only ids without a detail check or where a detail check is needed
+        @param limit: The maximum number of ids
+        @param lease_seconds: The duration of the lease
+        @return: List of tuples like (id, item_hash), in the same order as `iter_ids`
+        """
+        sweep_condition = "" if only_needed else \
+            " AND NOT (a.lease_expires_at IS NULL AND a.leased_at IS NOT NULL" \
+            " AND a.leased_at >= (SELECT run_started_at FROM spider_runs WHERE id = %(run_id)s))"
+        needed_condition = " AND (a.detail_check_needed OR a.detail_check_priority = '-infinity')" \
+            if only_needed else ""
+        return self.execute_sql("WITH candidates AS ("
+                                " SELECT a.id FROM available_items a"
+                                " WHERE a.context = %(context)s"
+                                " AND (a.lease_expires_at IS NULL OR a.lease_expires_at < CURRENT_TIMESTAMP)" +
+                                needed_condition + sweep_condition +
+                                " ORDER BY a.detail_check_priority, a.id LIMIT %(limit)s"
+                                " FOR UPDATE SKIP LOCKED"
+                                "), leased AS ("
+                                " UPDATE available_items a SET lease_owner = %(run_id)s,"
+                                " leased_at = CURRENT_TIMESTAMP,"
+                                " lease_expires_at = CURRENT_TIMESTAMP + make_interval(secs => %(lease_seconds)s)"
+                                " FROM candidates c WHERE a.id = c.id AND a.context = %(context)s"
+                                " RETURNING a.id, a.detail_check_priority"
+                                ")"
+                                " SELECT l.id, d.item_hash FROM leased l LEFT JOIN latest_detail_items d"
+                                " ON (d.id = l.id AND d.context = %(context)s AND d.status = 'success')"
+                                " ORDER BY l.detail_check_priority, l.id",
+                                params={'context': spider.context, 'run_id': spider.run_id, 'limit': limit,
+                                        'lease_seconds': lease_seconds},
+                                fetch=True)
+
+    def release_leases(self, spider):
+        """
+        Ends the leases of the run that were not ended by writing their item, so other runs can lease these ids again
+        """
+        self.execute_sql("UPDATE available_items SET lease_expires_at = NULL, leased_at = NULL"
+                         " WHERE lease_owner = %s AND lease_expires_at IS NOT NULL",
+                         params=(spider.run_id,), idempotent=True)
 
     def upsert_available_item(self, item_id, search_result_item, spider):
         if spider.name == 'details':
-            items = Table('available_items')
-            upsert_item = PostgreSQLQuery.into(items) \
-                .columns(items.id, items.context, items.last_detail_check, items.detail_check_needed) \
-                .insert(item_id, spider.context, spider.run_id, False) \
-                .on_conflict(items.id, items.context) \
-                .do_update(items.last_detail_check, spider.run_id) \
-                .do_update(items.detail_check_needed, False) \
-                .get_sql()
-            self.execute_sql(upsert_item)
+            self.run_in_transaction(lambda cursor: self.execute_statement(
+                cursor, 'upsert_detail_available_item', dict(id=item_id, context=spider.context, run_id=spider.run_id)
+            ), idempotent=True)
         elif spider.name == 'search_results':
-            # doesn't seem to work with pypika yet because of missing distinct from
-            # TODO: this should work with pypika.CustomFunction...
-            upsert_item = "INSERT INTO available_items AS items" \
-                          " (id, context, last_available_seen, last_available_change," \
-                          " last_available_item, detail_check_needed)" \
-                          " VALUES(%s, %s, %s, %s, %s, True) ON CONFLICT (id, context) DO UPDATE" \
-                          " SET last_available_seen = EXCLUDED.last_available_seen," \
-                          " last_available_change = CASE " \
-                          " WHEN items.last_available_item IS DISTINCT FROM EXCLUDED.last_available_item" \
-                          " THEN EXCLUDED.last_available_change" \
-                          " ELSE items.last_available_change END," \
-                          " last_available_item = EXCLUDED.last_available_item," \
-                          " detail_check_needed = CASE " \
-                          " WHEN items.last_available_item IS DISTINCT FROM EXCLUDED.last_available_item" \
-                          " AND items.last_available_seen IS NOT NULL" \
-                          " THEN True" \
-                          " ELSE items.detail_check_needed END"
-            sql_params = (item_id, spider.context, spider.run_id, spider.run_id, Json(dict(search_result_item)))
-            self.execute_sql(upsert_item, params=sql_params)
+            self.run_in_transaction(lambda cursor: self.execute_statement(
+                cursor, 'upsert_search_result_available_item',
+                dict(id=item_id, context=spider.context, run_id=spider.run_id, item=Json(dict(search_result_item)),
+                     item_hash=hash_item(search_result_item))
+            ), idempotent=True)
         else:
             raise AttributeError(f'Spider has to be either "details" or "search_results", but was {spider.name}')
 
+    def stage_search_result_items(self, rows, spider, checkpoints=()):
+        """
+        Writes the items of the "search_results" spider to the search_results_staging table,
+        they are only merged into available_items by `merge_search_results` at the end of the run
+        @param rows: List of tuples like (item_id, search_result_item, page_index)
+        @param checkpoints: List of tuples like (page_index, items, total_items) of the completely parsed pages
+        """
+        if spider.name != 'search_results':
+            raise AttributeError(f'Only for "search_results" spider, but was "{spider.name}"')
+        batch = [(spider.run_id, item_id, json.dumps(dict(item)), hash_item(item), page_index)
+                 for item_id, item, page_index in rows]
+        checkpoints_batch = [(spider.run_id, *checkpoint) for checkpoint in checkpoints]
+
+        def stage(cursor):
+            self.copy_rows(cursor, 'search_results_staging', ['run_id', 'id', 'item', 'item_hash', 'page_index'],
+                           batch)
+            self.copy_rows(cursor, 'search_results_checkpoints', ['run_id', 'page_index', 'items', 'total_items'],
+                           checkpoints_batch)
+
+        # an id or checkpoint staged twice is merged only once, so writing a batch again does no harm
+        self.run_in_transaction(stage, idempotent=True)
+
+    def resume_search_results(self, spider):
+        """
+        Takes over the complete pages of the run, that is resumed by the run of the spider.
+        A page is complete, if all ids of its checkpoint are staged, the other staged items of the resumed run are removed.
+        @return: Tuple like (set of the start indexes of the complete pages, total items or None if there are none)
+        """
+        if spider.name != 'search_results':
+            raise AttributeError(f'Only for "search_results" spider, but was "{spider.name}"')
+        params = {'run_id': spider.run_id, 'resumed_run': spider.resumed_run}
+
+        def resume(cursor):
+            cursor.execute("WITH staged AS ("
+                           " SELECT page_index, count(DISTINCT id) AS items FROM search_results_staging"
+                           " WHERE run_id = %(resumed_run)s GROUP BY page_index"
+                           ")"
+                           " DELETE FROM search_results_checkpoints c WHERE c.run_id = %(resumed_run)s"
+                           " AND NOT EXISTS (SELECT FROM staged s WHERE s.page_index = c.page_index AND s.items = c.items)",
+                           params)
+            cursor.execute("UPDATE search_results_checkpoints SET run_id = %(run_id)s"
+                           " WHERE run_id = %(resumed_run)s RETURNING page_index, total_items", params)
+            pages = cursor.fetchall()
+            cursor.execute("UPDATE search_results_staging s SET run_id = %(run_id)s WHERE s.run_id = %(resumed_run)s"
+                           " AND EXISTS (SELECT FROM search_results_checkpoints c"
+                           " WHERE c.run_id = %(run_id)s AND c.page_index = s.page_index)", params)
+            cursor.execute("DELETE FROM search_results_staging WHERE run_id = %(resumed_run)s", params)
+            total_items = max((total for _, total in pages), default=None)
+            return {page_index for page_index, _ in pages}, total_items
+
+        return self.run_in_transaction(resume)
+
+    def merge_search_results(self, spider, mark_disappeared=True):
+        """
+        Merges the staged items of the run into available_items and removes them from the staging table.
+        Items that were not staged in this run are marked as not available anymore.
+        @param mark_disappeared: False for runs that did not fetch all pages (delta runs),
+        the items that were not staged are then kept as they are
+        @return: Tuple with the number of (new, changed, disappeared) items
+        """
+        if spider.name != 'search_results':
+            raise AttributeError(f'Only for "search_results" spider, but was "{spider.name}"')
+
+        def merge(cursor):
+            cursor.execute(MERGE_SEARCH_RESULTS, {'run_id': spider.run_id, 'context': spider.context,
+                                                  'mark_disappeared': mark_disappeared})
+            counts = cursor.fetchone()
+            cursor.execute("DELETE FROM search_results_staging WHERE run_id = %s", (spider.run_id,))
+            return counts
+
+        # not idempotent, after a lost commit the staged items are gone and all items would have disappeared
+        return self.run_in_transaction(merge)
+
+    def insert_detail_items(self, rows, spider, page_states=()):
+        """
+        Batched version of `upsert_available_item` and `insert_detail_item` for the "details" spider.
+        Everything is done in a single transaction.
+        @param rows: List of tuples like (item_id, item_or_none, status),
+                     rows with status None only update the available_items (the item is known to be unchanged)
+        @param page_states: List of tuples like (item_id, page_state) with the states of the german pages
+                            of the items in `rows`, see PAGE_STATE_FIELDS
+        """
+        if spider.name != 'details':
+            raise AttributeError(f'Only for "details" spider, but was "{spider.name}"')
+        for _, _, status in rows:
+            if status not in ['success', 'error', 'moved', None]:
+                raise AttributeError(f'Status has to be either "success", "error" or "moved", but was "{status}"')
+        ids = [item_id for item_id, _, _ in rows]
+        batch = []
+        blobs = []
+        for item_id, item_or_none, status in rows:
+            if status is not None:
+                item_json, item_blobs = split_item_blobs(item_or_none)
+                batch.append((item_id, item_json, status, hash_item(item_or_none)))
+                blobs.extend(item_blobs)
+
+        def write(cursor):
+            self.execute_statement(cursor, 'upsert_detail_available_items',
+                                   dict(context=spider.context, run_id=spider.run_id, ids=ids))
+            if len(page_states) > 0:
+                self.execute_statement(cursor, 'upsert_details_page_states',
+                                       dict(context=spider.context, run_id=spider.run_id,
+                                            ids=[item_id for item_id, _ in page_states],
+                                            **{field: [state.get(field) for _, state in page_states]
+                                               for field in PAGE_STATE_FIELDS}))
+            self.insert_item_blobs(cursor, blobs)
+            cursor.execute("CREATE TEMP TABLE detail_items_batch"
+                           " (id INTEGER, item JSONB, status DETAIL_STATUS_TYPE, item_hash TEXT) ON COMMIT DROP")
+            self.copy_rows(cursor, 'detail_items_batch', ['id', 'item', 'status', 'item_hash'], batch)
+            self.execute_statement(cursor, 'insert_detail_items', dict(context=spider.context, run_id=spider.run_id))
+
+        self.run_in_transaction(write, idempotent=True)
+
     def insert_detail_item(self, item_id, item_or_none, spider, status):
         if status not in ['success', 'error', 'moved']:
             raise AttributeError(f'Status has to be either "success", "error" or "moved", but was "{status}"')
-        if item_or_none is None:
-            json_item = None
-        else:
-            json_item = Json(dict(item_or_none))
-        sql = "INSERT INTO details_items_history (id, context, created_at, item, status)" \
-              " SELECT * FROM (VALUES" \
-              " (%s, %s::CONTEXT_TYPE, %s, %s::JSONB, %s::DETAIL_STATUS_TYPE)) AS v" \
-              " WHERE NOT EXISTS (SELECT * FROM latest_detail_items WHERE id = %s AND context = %s" \
-              " AND status = %s AND item IS NOT DISTINCT FROM %s)"
-        sql_params = (
-            item_id, spider.context, spider.run_id, json_item, status, item_id, spider.context, status, json_item)
-        with self.connection.cursor() as cursor:
-            cursor.execute(sql, sql_params)
-        self.connection.commit()
+        item_json, blobs = split_item_blobs(item_or_none)
+        sql_params = dict(id=item_id, context=spider.context, run_id=spider.run_id, item=item_json, status=status,
+                          item_hash=hash_item(item_or_none))
+
+        def write(cursor):
+            self.insert_item_blobs(cursor, blobs)
+            self.execute_statement(cursor, 'insert_detail_item', sql_params)
+
+        self.run_in_transaction(write, idempotent=True)
+
+    def insert_item_blobs(self, cursor, blobs):
+        """
+        Stores the contents of the large fields of items, contents that are already stored are skipped
+        @param cursor: The cursor of the currently open transaction
+        @param blobs: List of tuples like (hash, content json), as returned by `split_item_blobs`
+        """
+        if len(blobs) == 0:
+            return
+        cursor.execute("CREATE TEMP TABLE item_blobs_batch (hash TEXT, content JSONB) ON COMMIT DROP")
+        self.copy_rows(cursor, 'item_blobs_batch', ['hash', 'content'], blobs)
+        self.execute_statement(cursor, 'insert_item_blobs')
+
+    def get_available_item_hashes(self, context, ids):
+        """
+        @return: dict of the hashes of the latest search result items, by their id
+        """
+        results = self.execute_sql("SELECT id, last_available_item_hash FROM available_items"
+                                   " WHERE context = %s AND last_available_item_hash IS NOT NULL"
+                                   " AND id = ANY(%s)",
+                                   params=(context, list(ids)), fetch=True, idempotent=True)
+        return {item_id: item_hash for item_id, item_hash in results}
+
+    def count_available_items(self, context):
+        """
+        @return: The number of items of the context, that were in the search results of the latest runs
+        """
+        return self.execute_sql("SELECT count(*) FROM available_items"
+                                " WHERE context = %s AND last_available_item IS NOT NULL",
+                                params=(context,), fetch=True, idempotent=True)[0][0]
+
+    def get_latest_item_hashes(self, context, ids):
+        """
+        @return: dict of the item hashes of the latest successful detail items, by their id
+        """
+        results = self.execute_sql("SELECT id, item_hash FROM latest_detail_items"
+                                   " WHERE context = %s AND status = 'success' AND item_hash IS NOT NULL"
+                                   " AND id = ANY(%s)",
+                                   params=(context, list(ids)), fetch=True, idempotent=True)
+        return {item_id: item_hash for item_id, item_hash in results}
+
+    def get_page_states(self, context, ids):
+        """
+        @return: dict of the states of the german pages (dicts with the PAGE_STATE_FIELDS) by their id,
+        only for the ids whose latest detail item is a successful one (moved or broken items are always fetched again)
+        """
+        results = self.execute_sql("SELECT s.id, " + ", ".join(f"s.{field}" for field in PAGE_STATE_FIELDS) +
+                                   " FROM details_page_states s"
+                                   " JOIN latest_detail_items l ON l.id = s.id AND l.context = s.context"
+                                   " WHERE s.context = %s AND l.status = 'success' AND s.id = ANY(%s)",
+                                   params=(context, list(ids)), fetch=True, idempotent=True)
+        return {item_id: dict(zip(PAGE_STATE_FIELDS, state)) for item_id, *state in results}
 
     def create_personen_references_from_details_run(self, spider):
         available_items = Table('available_items')
         details_items_history = Table('details_items_history')
-        person_attributes = PostgreSQLQuery \
-            .select(PseudoColumn(f'UNNEST(enum_range(NULL::PERSON_PROJEKT_BEZIEHUNG_TYPE))::TEXT AS name')) \
-            .as_('attrs')
-        JsonbGet = CustomFunction('jsonb_object_field', ['json', 'key'])
-        JsonbExist = CustomFunction('jsonb_exists', ['json', 'key'])
+        references = Table('latest_person_projekt_references')
 
+        # the projekte changed in this run are the latest ones, so their references are in the references table
         not_yet_existing_persons = PostgreSQLQuery.select(
-            PseudoColumn("jsonb_array_elements_text(item->'attributes'->(name))::INT as id"),
+            references.person_id,
             Cast('person', 'CONTEXT_TYPE'),
             True) \
             .distinct() \
-            .from_(details_items_history) \
-            .join(person_attributes) \
-            .on(JsonbExist(JsonbGet(details_items_history.item, 'attributes'), person_attributes.name)) \
-            .where(details_items_history.context.eq('projekt')) \
+            .from_(references) \
+            .join(details_items_history) \
+            .on(details_items_history.id.eq(references.projekt_id)
+                & details_items_history.context.eq('projekt')) \
             .where(details_items_history.created_at.eq(spider.run_id)) \
             .except_of(PostgreSQLQuery.select(available_items.id, Cast('person', 'CONTEXT_TYPE'), True) \
                        .from_(available_items) \
@@ -142,23 +731,7 @@ class PostgresDatabase:
         q = PostgreSQLQuery.into(available_items).columns('id', 'context', 'detail_check_needed') \
             .insert().select(not_yet_existing_persons.star).from_(not_yet_existing_persons)
 
-        with self.connection.cursor() as cursor:
-            cursor.execute(q.get_sql())
-        self.connection.commit()
-
-    def mark_not_found_available_items(self, spider):
-        if spider.name != 'search_results':
-            raise AttributeError(f'Only for "search_results" spider, but was "{spider.name}"')
-        items = Table('available_items')
-        q = PostgreSQLQuery.update(items) \
-            .set(items.detail_check_needed, True) \
-            .set(items.last_available_item, None) \
-            .set(items.last_available_change, spider.run_id) \
-            .where(items.context.eq(spider.context)) \
-            .where(items.last_available_seen.ne(spider.run_id)) \
-            .where(items.last_available_seen.notnull()) \
-            .where(items.last_available_item.notnull())
-        self.execute_sql(q.get_sql())
+        self.execute_sql(q.get_sql(), idempotent=True)
 
     def mark_detail_check_needed_on_projekts_for_moved_person_institution(self, spider):
         if spider.context == 'person':
@@ -184,7 +757,7 @@ class PostgresDatabase:
         q = PostgreSQLQuery.update(available_items) \
             .set(available_items.detail_check_needed, True) \
             .where(available_items.id.isin(projects_with_moved_references))
-        self.execute_sql(q.get_sql())
+        self.execute_sql(q.get_sql(), idempotent=True)
 
     def mark_detail_check_needed_on_root_institutions_for_moved_sub_institution(self, spider):
         details_items_history = Table('details_items_history')
@@ -204,14 +777,117 @@ class PostgresDatabase:
         q = PostgreSQLQuery.update(available_items) \
             .set(available_items.detail_check_needed, True) \
             .where(available_items.id.isin(institutions_with_moved_subinstitutions))
-        self.execute_sql(q.get_sql())
+        self.execute_sql(q.get_sql(), idempotent=True)
+
+    def iter_history_versions(self, context, chunk_size=1000):
+        """
+        Reads the versions of the details_items_history chunk by chunk, each chunk has all versions of the next
+        `chunk_size` ids and is read in its own short transaction, so no connection or snapshot is kept
+        while the caller changes the history of the ids that were already read
+        @return: Generator of tuples like (id, created_at, item, status, item_hash), the items with expanded blobs,
+                 ordered by the id and the start of the run
+        """
+        last_id = -1
+        while True:
+            rows = self.execute_sql("WITH ids AS ("
+                                    " SELECT DISTINCT id FROM details_items_history"
+                                    " WHERE context = %(context)s AND id > %(last_id)s ORDER BY id LIMIT %(limit)s"
+                                    ")"
+                                    " SELECT h.id, h.created_at, expand_item_blobs(h.item), h.status, h.item_hash"
+                                    " FROM details_items_history h JOIN ids ON (h.id = ids.id)"
+                                    " JOIN spider_runs r ON (h.created_at = r.id)"
+                                    " WHERE h.context = %(context)s ORDER BY h.id, r.run_started_at",
+                                    params=dict(context=context, last_id=last_id, limit=chunk_size),
+                                    fetch=True, idempotent=True)
+            if len(rows) == 0:
+                return
+            yield from rows
+            last_id = rows[-1][0]
+
+    def collapse_history_versions(self, context, removed, rewritten):
+        """
+        Removes and rewrites versions of the details_items_history in a single transaction
+        @param removed: List of tuples like (id, created_at) of the versions that are removed
+        @param rewritten: List of tuples like (id, created_at, item) of the versions whose item is replaced
+        """
+        batch = []
+        blobs = []
+        for item_id, created_at, item in rewritten:
+            item_json, item_blobs = split_item_blobs(item)
+            batch.append((item_id, created_at, item_json, hash_item(item)))
+            blobs.extend(item_blobs)
+
+        def write(cursor):
+            cursor.execute("CREATE TEMP TABLE removed_versions (id INTEGER, created_at INTEGER) ON COMMIT DROP")
+            self.copy_rows(cursor, 'removed_versions', ['id', 'created_at'], removed)
+            cursor.execute("DELETE FROM details_items_history h USING removed_versions r"
+                           " WHERE h.id = r.id AND h.context = %s AND h.created_at = r.created_at", (context,))
+            self.insert_item_blobs(cursor, blobs)
+            cursor.execute("CREATE TEMP TABLE rewritten_versions"
+                           " (id INTEGER, created_at INTEGER, item JSONB, item_hash TEXT) ON COMMIT DROP")
+            self.copy_rows(cursor, 'rewritten_versions', ['id', 'created_at', 'item', 'item_hash'], batch)
+            cursor.execute("UPDATE details_items_history h SET item = r.item, item_hash = r.item_hash"
+                           " FROM rewritten_versions r"
+                           " WHERE h.id = r.id AND h.context = %s AND h.created_at = r.created_at", (context,))
+
+        self.run_in_transaction(write, idempotent=True)
+
+    def get_archivable_history_partitions(self, keep):
+        """
+        @param keep: The number of the newest partitions of each context that are kept, at least one
+        @return: The names of the not yet archived partitions of the details_items_history, oldest first
+        """
+        results = self.execute_sql("SELECT name FROM ("
+                                   " SELECT name, first_run,"
+                                   " row_number() OVER (PARTITION BY context ORDER BY first_run DESC) AS newest"
+                                   " FROM details_items_history_partitions WHERE archived_at IS NULL) p"
+                                   " WHERE newest > %s ORDER BY first_run, name",
+                                   params=(max(keep, 1),), fetch=True, idempotent=True)
+        return [result[0] for result in results]
+
+    def archive_history_partition(self, name, path):
+        """
+        Exports the partition of the details_items_history as gzip compressed csv file,
+        then the latest versions of its items are moved to the details_items_baseline and the partition is dropped.
+        The export is written to a temporary file, that is only renamed to `path` after the transaction was committed,
+        so the file exists only if the partition was dropped.
+        @param name: The name of the partition
+        @param path: The path of the file, an existing file is overwritten
+        """
+        part_path = f'{path}.part'
+
+        def archive(cursor):
+            with gzip.open(part_path, 'wt', encoding='utf-8', newline='') as f:
+                cursor.copy_expert(sql.SQL('COPY {} TO STDOUT WITH (FORMAT csv, HEADER)')
+                                   .format(sql.Identifier(name)).as_string(cursor), f)
+            cursor.execute('SELECT archive_details_items_history_partition(%s, %s)', (name, os.path.abspath(path)))
+
+        try:
+            self.run_in_transaction(archive)
+        except BaseException:
+            if os.path.exists(part_path):
+                os.remove(part_path)
+            raise
+        os.replace(part_path, path)
 
     def insert_data_monitor_run(self, item):
         dm = Table('data_monitor')
         q = PostgreSQLQuery.into(dm).columns('run_ended_at', *item.keys()).insert(CurTimestamp(), *item.values())
         self.execute_sql(q.get_sql())
 
-    def store_run(self, name, context):
+    def store_run(self, name, context, resumed_run=None):
+        """
+        @param resumed_run: The id of an earlier run of the same spider and context, that is resumed by the new run
+        @return: The id of the new run
+        """
+        if resumed_run is not None:
+            results = self.execute_sql("INSERT INTO spider_runs (spider, context, run_started_at, resumed_run)"
+                                       " SELECT spider, context, CURRENT_TIMESTAMP, id FROM spider_runs"
+                                       " WHERE id = %s AND spider = %s AND context = %s RETURNING id",
+                                       params=(resumed_run, name, context), fetch=True)
+            if len(results) == 0:
+                raise ValueError(f'There is no {name} run with id {resumed_run} and context {context} to resume')
+            return results[0][0]
         runs = Table('spider_runs')
         q = PostgreSQLQuery.into(runs) \
             .columns(runs.spider, runs.context, runs.run_started_at) \
@@ -221,12 +897,9 @@ class PostgresDatabase:
         return results[0][0]
 
     def update_run_result(self, run_id, total_items):
-        runs = Table('spider_runs')
-        q = PostgreSQLQuery.update(runs) \
-            .set(runs.run_ended_at, CurTimestamp()) \
-            .set(runs.total_scraped_items, total_items) \
-            .where(runs.id.eq(run_id))
-        self.execute_sql(q.get_sql())
+        self.run_in_transaction(lambda cursor: self.execute_statement(
+            cursor, 'update_run_result', dict(run_id=run_id, total_items=total_items)
+        ), idempotent=True)
 
     def get_latest_dm_stat(self, stat):
         dm = Table('data_monitor', alias='d1')
@@ -234,8 +907,8 @@ class PostgresDatabase:
         q = PostgreSQLQuery.select(dm.field(stat)).from_(dm).where(ExistsCriterion(
             PostgreSQLQuery.select(sub_dm.run_ended_at).from_(sub_dm).where(sub_dm.run_ended_at > dm.run_ended_at)
         ).negate())
-        result = self.execute_sql(q.get_sql(), fetch=True)
+        result = self.execute_sql(q.get_sql(), fetch=True, idempotent=True)
         if len(result) == 1:
-            return self.execute_sql(q.get_sql(), fetch=True)[0][0]
+            return result[0][0]
         else:
             return None
@@ -0,0 +1,187 @@
+import time
+
+from twisted.internet import defer, task, threads
+from twisted.python.threadpool import ThreadPool
+
+from .database import hash_item
+
+
+class DatabaseWriterThread:
+    """
+    Runs database calls in a single dedicated thread, so the twisted reactor is not blocked by them.
+    At most `max_pending` calls are queued, every further call waits until there is space in the queue again.
+    The calls take their connections from the pool of the database, like all other database calls.
+    """
+
+    def __init__(self, max_pending=2):
+        self.semaphore = defer.DeferredSemaphore(max(max_pending, 1))
+        self.pool = ThreadPool(minthreads=1, maxthreads=1, name='database-writer')
+
+    def run(self, func, *args):
+        """
+        Queues the call of `func` with `args` in the writer thread
+        @return: Deferred that fires with the result of the call
+        """
+        from twisted.internet import reactor
+        if not self.pool.started:
+            self.pool.start()
+        return self.semaphore.run(threads.deferToThreadPool, reactor, self.pool, func, *args)
+
+    def stop(self):
+        """
+        Stops the thread after all queued calls, without blocking the reactor
+        @return: Deferred that fires when the thread is stopped
+        """
+        if not self.pool.started:
+            return defer.succeed(None)
+        # the calls are run in the order they were queued, so all earlier calls are done when this one is
+        d = self.run(lambda: None)
+        d.addCallback(lambda _: threads.deferToThread(self.pool.stop))
+        return d
+
+
+class DatabaseWriteBuffer:
+    """
+    Collects the results of a spider run and writes them to the database in batches.
+    A batch is written if it reached `batch_size` items or if the last write is older than `flush_interval` seconds,
+    the age is checked with every new item and every `flush_interval` seconds (so no rows are kept while items stop coming).
+    If a `writer` is given, the batches are written by it, otherwise they are written directly.
+    This class currently only works for the "details" and "search_results" spider
+    """
+
+    def __init__(self, db, spider, batch_size=500, flush_interval=10, writer=None):
+        if spider.name not in ['details', 'search_results']:
+            raise AttributeError(f'Spider has to be either "details" or "search_results", but was {spider.name}')
+        self.db = db
+        self.spider = spider
+        self.batch_size = max(batch_size, 1)
+        self.flush_interval = flush_interval
+        self.writer = writer
+        # keyed by the id, so an id appearing twice in a batch is only written once (the last one wins)
+        self.rows = {}
+        # checkpoints of the completely parsed search results pages, they are written with the next batch
+        self.checkpoints = []
+        self.last_flush = time.monotonic()
+        # hashes of the latest stored items by their id, items with the same hash are not written to the history
+        self.known_hashes = {}
+        # states of the german details pages of the collected items by their id, written with their rows
+        self.page_states = {}
+        # the number of batches that could not be written, their items are lost
+        self.failed_batches = 0
+        # started with the first item, so buffers that are never used do not need a reactor
+        self.flush_loop = task.LoopingCall(self._flush_if_due)
+
+    @classmethod
+    def from_settings(cls, db, spider, settings):
+        writer = None
+        if settings.getbool('DATABASE_ASYNC_WRITES'):
+            writer = DatabaseWriterThread(max_pending=settings.getint('DATABASE_MAX_PENDING_BATCHES', 2))
+        return cls(db, spider,
+                   batch_size=settings.getint('DATABASE_BATCH_SIZE', 500),
+                   flush_interval=settings.getfloat('DATABASE_FLUSH_INTERVAL', 10),
+                   writer=writer)
+
+    def add_search_result_item(self, item, page_index=None):
+        """
+        @param page_index: The start index of the search results page of the item
+        @return: Deferred that fires right away, or after the batch is written if the item completed it (see `flush`)
+        """
+        return self._add(item['id'], (item['id'], item, page_index))
+
+    def add_page_checkpoint(self, page_index, items, total_items):
+        """
+        Adds the checkpoint of a completely parsed search results page, it is written with the next batch
+        @param items: The number of distinct ids on the page
+        """
+        self.checkpoints.append((page_index, items, total_items))
+
+    def add_detail_item(self, item_id, item_or_none, status, page_state=None):
+        """
+        @param page_state: dict with the state of the german page of the item (see PAGE_STATE_FIELDS), if it is known
+        @return: Deferred that fires right away, or after the batch is written if the item completed it (see `flush`)
+        """
+        if status not in ['success', 'error', 'moved']:
+            raise AttributeError(f'Status has to be either "success", "error" or "moved", but was "{status}"')
+        if page_state is not None:
+            self.page_states[item_id] = page_state
+        # each id is only checked once in a run, so its hash is not needed anymore
+        known_hash = self.known_hashes.pop(item_id, False)
+        if status == 'success' and known_hash == hash_item(item_or_none):
+            # the item did not change, so only the check itself is written
+            self.spider.crawler.stats.inc_value('database/unchanged_items_skipped')
+            return self._add(item_id, (item_id, None, None))
+        return self._add(item_id, (item_id, item_or_none, status))
+
+    def add_unchanged_detail_item(self, item_id, page_state=None):
+        """
+        Only writes the check of an item, whose german page did not change (so its item was not built at all)
+        @param page_state: The new state of the german page, if only parts of it changed that are not in the item
+        @return: Deferred that fires right away, or after the batch is written if the item completed it (see `flush`)
+        """
+        self.known_hashes.pop(item_id, None)
+        if page_state is not None:
+            self.page_states[item_id] = page_state
+        return self._add(item_id, (item_id, None, None))
+
+    def _add(self, item_id, row):
+        self.rows[item_id] = row
+        if not self.flush_loop.running and self.flush_interval > 0:
+            self.flush_loop.start(self.flush_interval, now=False)
+        if len(self.rows) >= self.batch_size or time.monotonic() - self.last_flush >= self.flush_interval:
+            return self.flush()
+        return defer.succeed(None)
+
+    def _flush_if_due(self):
+        if (len(self.rows) > 0 or len(self.checkpoints) > 0) \
+                and time.monotonic() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        """
+        Writes all collected rows.
+        If there is a writer, the returned Deferred fires after all previously queued batches are written as well.
+        @return: Deferred that fires when the rows are written
+        """
+        rows = list(self.rows.values())
+        checkpoints = self.checkpoints
+        page_states = list(self.page_states.items())
+        self.rows = {}
+        self.checkpoints = []
+        self.page_states = {}
+        self.last_flush = time.monotonic()
+        d = self.call(self._write, rows, checkpoints, page_states)
+        d.addErrback(self._write_failed, len(rows))
+        return d
+
+    def call(self, func, *args):
+        """
+        Calls `func` either in the writer thread or directly, if there is no writer
+        @return: Deferred that fires with the result of the call
+        """
+        if self.writer is None:
+            return defer.maybeDeferred(func, *args)
+        return self.writer.run(func, *args)
+
+    def close(self):
+        """
+        @return: Deferred that fires when all queued batches are written
+        """
+        if self.flush_loop.running:
+            self.flush_loop.stop()
+        if self.writer is not None:
+            return self.writer.stop()
+        return defer.succeed(None)
+
+    def _write(self, rows, checkpoints=(), page_states=()):
+        if len(rows) == 0 and len(checkpoints) == 0:
+            return
+        if self.spider.name == 'details':
+            self.db.insert_detail_items(rows, self.spider, page_states)
+        else:
+            self.db.stage_search_result_items(rows, self.spider, checkpoints)
+        self.spider.logger.debug(f'Wrote batch of {len(rows)} items to the database')
+
+    def _write_failed(self, failure, rows_count):
+        self.spider.logger.error(f'Writing batch of {rows_count} items to the database failed: {failure.value}')
+        self.failed_batches += 1
+        self.spider.had_error = True
@@ -0,0 +1,52 @@
+class DetailsItemAggregator:
+    """
+    Collects the parts of the details items (like the german and the english page of a projekt),
+    that are fetched concurrently. An item is complete when all of its expected parts arrived.
+    A retried part replaces its earlier result, a part that failed finally discards the whole item.
+    """
+
+    def __init__(self):
+        # by element_id: tuple like (set of the expected part names, dict of the arrived parts by their name)
+        self.open_items = {}
+
+    def __len__(self):
+        return len(self.open_items)
+
+    def open(self, element_id, parts):
+        self.open_items[element_id] = (set(parts), {})
+
+    def expect(self, element_id, *parts):
+        """
+        Adds parts, that were only discovered while the item is open (like the result pages of a projekt)
+        @return: True if the item is still open
+        """
+        if element_id not in self.open_items:
+            return False
+        self.open_items[element_id][0].update(parts)
+        return True
+
+    def expects(self, element_id, part):
+        """
+        @return: True if the item is open and the part is one of its expected parts
+        """
+        return element_id in self.open_items and part in self.open_items[element_id][0]
+
+    def add(self, element_id, part, data):
+        """
+        @return: dict with all parts by their name if the item is complete now, otherwise None
+        """
+        if element_id not in self.open_items:
+            # the item was discarded, because another part failed
+            return None
+        expected, arrived = self.open_items[element_id]
+        arrived[part] = data
+        if not expected.issubset(arrived.keys()):
+            return None
+        del self.open_items[element_id]
+        return arrived
+
+    def discard(self, element_id):
+        """
+        @return: True if the item was still open, so only the first failed part of an item returns True
+        """
+        return self.open_items.pop(element_id, None) is not None
@@ -0,0 +1,196 @@
+import logging
+import math
+
+from scrapy import signals
+from scrapy.exceptions import NotConfigured
+from twisted.internet import task
+
+from .middlewares import RETRY_REASON_LANGUAGE, RETRY_REASON_STRUCTURE
+
+logger = logging.getLogger(__name__)
+
+# responses with these status codes mean, that gepris (or the proxy) does not want to serve us that fast
+BAN_STATUS_CODES = [403, 429]
+# retries of the ExceptionHandlerMiddleware, that are caused by pages gepris serves when it is overloaded or blocks us
+BAN_RETRY_REASONS = [RETRY_REASON_LANGUAGE]
+ERROR_RETRY_REASONS = [RETRY_REASON_STRUCTURE]
+
+
+def percentile(values, p):
+    """
+    @param values: Sorted list of numbers
+    @param p: The percentile, between 0 and 100
+    @return: The value below which `p` percent of the values are (nearest rank), or None for an empty list
+    """
+    if len(values) == 0:
+        return None
+    return values[max(math.ceil(p / 100 * len(values)) - 1, 0)]
+
+
+class AdaptiveConcurrency:
+    """
+    Adjusts the concurrency of the download slots every ADAPTIVE_CONCURRENCY_INTERVAL seconds, based on the responses
+    of that interval (additive increase, multiplicative decrease):
+    * it is halved if the share of bans or errors is too high or the 90th latency percentile is too high
+    * it is increased by 1 if the median latency is below the target and there were no errors or bans
+    * otherwise it is kept
+    The concurrency stays between ADAPTIVE_CONCURRENCY_MIN and ADAPTIVE_CONCURRENCY_MAX (at most CONCURRENT_REQUESTS).
+    At the minimum concurrency, a decrease doubles the delay of the slots instead (starting at
+    ADAPTIVE_CONCURRENCY_BACKOFF_DELAY, up to ADAPTIVE_CONCURRENCY_MAX_DELAY), an increase halves it again
+    before the concurrency grows. The delay of a slot never goes below DOWNLOAD_DELAY (or the delay of a proxy slot).
+    Every decision is counted in the "adaptive_concurrency/..." stats.
+    """
+
+    def __init__(self, crawler):
+        settings = crawler.settings
+        if not settings.getbool('ADAPTIVE_CONCURRENCY_ENABLED'):
+            raise NotConfigured
+        self.crawler = crawler
+        self.stats = crawler.stats
+        self.interval = settings.getfloat('ADAPTIVE_CONCURRENCY_INTERVAL', 30)
+        self.min_concurrency = max(settings.getint('ADAPTIVE_CONCURRENCY_MIN', 1), 1)
+        self.max_concurrency = max(min(settings.getint('ADAPTIVE_CONCURRENCY_MAX', 8),
+                                       settings.getint('CONCURRENT_REQUESTS')), self.min_concurrency)
+        self.concurrency = min(max(settings.getint('ADAPTIVE_CONCURRENCY_START', 2), self.min_concurrency),
+                               self.max_concurrency)
+        self.target_latency = settings.getfloat('ADAPTIVE_CONCURRENCY_TARGET_LATENCY', 2)
+        self.max_latency = settings.getfloat('ADAPTIVE_CONCURRENCY_MAX_LATENCY', 10)
+        self.max_error_rate = settings.getfloat('ADAPTIVE_CONCURRENCY_MAX_ERROR_RATE', 0.05)
+        self.max_ban_rate = settings.getfloat('ADAPTIVE_CONCURRENCY_MAX_BAN_RATE', 0)
+        self.min_samples = settings.getint('ADAPTIVE_CONCURRENCY_MIN_SAMPLES', 5)
+        self.download_delay = settings.getfloat('DOWNLOAD_DELAY')
+        self.backoff_delay = settings.getfloat('ADAPTIVE_CONCURRENCY_BACKOFF_DELAY', 1)
+        self.max_delay = settings.getfloat('ADAPTIVE_CONCURRENCY_MAX_DELAY', 30)
+        # the delay added by the back off, 0 while the concurrency is enough to slow down
+        self.delay = 0
+        self.loop = None
+        # the values of the stats at the last adjustment
+        self.seen_stats = {}
+        self._reset_window()
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        extension = cls(crawler)
+        crawler.signals.connect(extension.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(extension.spider_closed, signal=signals.spider_closed)
+        crawler.signals.connect(extension.request_reached_downloader, signal=signals.request_reached_downloader)
+        crawler.signals.connect(extension.response_received, signal=signals.response_received)
+        return extension
+
+    def spider_opened(self, spider):
+        self.stats.set_value('adaptive_concurrency/concurrency', self.concurrency)
+        self.stats.max_value('adaptive_concurrency/max_concurrency', self.concurrency)
+        self.stats.min_value('adaptive_concurrency/min_concurrency', self.concurrency)
+        self.stats.set_value('adaptive_concurrency/delay', self.delay)
+        self.loop = task.LoopingCall(self.adjust)
+        self.loop.start(self.interval, now=False)
+
+    def spider_closed(self, spider):
+        if self.loop is not None and self.loop.running:
+            self.loop.stop()
+
+    def request_reached_downloader(self, request, spider):
+        # the slot of the request exists now, new slots start with the current concurrency
+        self.apply(request.meta.get('download_slot'))
+
+    def response_received(self, response, request, spider):
+        self.responses += 1
+        latency = request.meta.get('download_latency')
+        if latency is not None:
+            self.latencies.append(latency)
+        if response.status in BAN_STATUS_CODES:
+            self.bans += 1
+        elif response.status >= 500:
+            self.errors += 1
+
+    def adjust(self):
+        """
+        Decides on the concurrency for the responses since the last call and applies it to all download slots
+        """
+        failed_downloads = self._stats_delta('downloader/exception_count')
+        errors = self.errors + failed_downloads + \
+            sum(self._stats_delta(f'retry/reason_count/{reason}') for reason in ERROR_RETRY_REASONS)
+        bans = self.bans + sum(self._stats_delta(f'retry/reason_count/{reason}') for reason in BAN_RETRY_REASONS)
+        decision, reason = self.decide(self.responses + failed_downloads, sorted(self.latencies), errors, bans)
+        previous = self.concurrency
+        previous_delay = self.delay
+        if decision == 'increase':
+            if self.delay > 0:
+                # the back off of the delay is undone first
+                self.delay = self.delay / 2 if self.delay / 2 >= self.backoff_delay else 0
+            else:
+                self.concurrency = min(self.concurrency + 1, self.max_concurrency)
+        elif decision == 'decrease':
+            if self.concurrency > self.min_concurrency:
+                self.concurrency = max(self.concurrency // 2, self.min_concurrency)
+            else:
+                # with a single request at once, only a longer delay slows down
+                self.delay = min(max(self.delay * 2, self.backoff_delay), self.max_delay)
+        self.stats.inc_value(f'adaptive_concurrency/decisions/{decision}')
+        self.stats.set_value('adaptive_concurrency/concurrency', self.concurrency)
+        self.stats.max_value('adaptive_concurrency/max_concurrency', self.concurrency)
+        self.stats.min_value('adaptive_concurrency/min_concurrency', self.concurrency)
+        self.stats.set_value('adaptive_concurrency/delay', self.delay)
+        self.stats.max_value('adaptive_concurrency/max_delay', self.delay)
+        if previous != self.concurrency:
+            logger.info(f'Changed the concurrency from {previous} to {self.concurrency}: {reason}')
+        elif previous_delay != self.delay:
+            logger.info(f'Changed the back off delay from {previous_delay}s to {self.delay}s: {reason}')
+        else:
+            logger.debug(f'Kept the concurrency at {self.concurrency}: {reason}')
+        self._reset_window()
+        for slot_key in self._downloader_slots():
+            self.apply(slot_key)
+
+    def decide(self, samples, latencies, errors, bans):
+        """
+        @param samples: The number of responses and failed downloads
+        @param latencies: Sorted download latencies of the responses in seconds
+        @param errors: The number of failed downloads, server errors and retries because of broken pages
+        @param bans: The number of responses and retries, that show we are blocked
+        @return: Tuple like (decision, reason), where decision is either "increase", "decrease" or "hold"
+        """
+        if samples < self.min_samples:
+            return 'hold', f'only {samples} responses'
+        p50 = percentile(latencies, 50)
+        p90 = percentile(latencies, 90)
+        if p50 is not None:
+            self.stats.set_value('adaptive_concurrency/latency_p50', round(p50, 3))
+            self.stats.set_value('adaptive_concurrency/latency_p90', round(p90, 3))
+        if bans / samples > self.max_ban_rate:
+            return 'decrease', f'{bans} of {samples} responses were bans'
+        if errors / samples > self.max_error_rate:
+            return 'decrease', f'{errors} of {samples} responses were errors'
+        if p90 is not None and p90 > self.max_latency:
+            return 'decrease', f'90th latency percentile {p90:.2f}s is above {self.max_latency}s'
+        if errors == 0 and p50 is not None and p50 <= self.target_latency:
+            return 'increase', f'median latency {p50:.2f}s is below {self.target_latency}s'
+        return 'hold', f'median latency {p50:.2f}s with {errors} errors' if p50 is not None else f'{errors} errors'
+
+    def apply(self, slot_key):
+        slot = self._downloader_slots().get(slot_key)
+        if slot is not None:
+            # slots with their own concurrency (like the ones of the proxies) stay below it
+            slot_settings = self.crawler.engine.downloader.per_slot_settings.get(slot_key, {})
+            slot_concurrency = slot_settings.get('concurrency')
+            slot.concurrency = self.concurrency if slot_concurrency is None else min(self.concurrency, slot_concurrency)
+            # the back off never goes below the delay of the slot
+            slot.delay = max(slot_settings.get('delay', self.download_delay), self.delay)
+
+    def _downloader_slots(self):
+        engine = self.crawler.engine
+        if engine is None or engine.downloader is None:
+            return {}
+        return engine.downloader.slots
+
+    def _reset_window(self):
+        self.responses = 0
+        self.latencies = []
+        self.errors = 0
+        self.bans = 0
+
+    def _stats_delta(self, key):
+        value = self.stats.get_value(key, 0)
+        delta = value - self.seen_stats.get(key, 0)
+        self.seen_stats[key] = value
+        return delta
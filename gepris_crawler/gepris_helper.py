@@ -1,3 +1,6 @@
+import hashlib
+import re
+
 import scrapy
 
 BASE_URL = 'https://gepris.dfg.de/gepris'
@@ -25,6 +28,20 @@ DATA_MONITOR_KEYS = {
     'Forschungsinfrastruktur': 'research_infrastructure_count'
 }
 GOOGLE_CACHE_BASE_URL = 'https://webcache.googleusercontent.com/search?q=cache:'
+# parts of the pages, that change with every request, they are removed before the digest of a page is computed
+VOLATILE_PAGE_PARTS = [
+    # script nonces of the content security policy
+    (re.compile(rb'nonce="[^"]*"'), b'nonce=""'),
+    # the random number of the matomo tracking pixel
+    (re.compile(rb'(\?|&|&amp;)rand=\d+'), b''),
+    # session ids in links
+    (re.compile(rb';jsessionid=[^"\'?#&;\s]*', re.IGNORECASE), b''),
+    # the time of the request in the search history entries of the page scripts
+    (re.compile(rb'(historyEntry\w*\s*=\s*\{[^\n]*?"date":")[^"]*"'), rb'\1"'),
+    # the indentation of the templates between the tags, whitespace in the text is content
+    # a single space is kept, as it separates inline tags like "<b>Foo</b> <i>Bar</i>"
+    (re.compile(rb'>\s+<'), b'> <'),
+]
 
 
 def check_valid_context(context):
@@ -55,7 +72,7 @@ def data_monitor_request():
     )
 
 
-def search_results_request(context, results_per_site, current_index, expected_items_on_page):
+def search_results_request(context, results_per_site, current_index, expected_items_on_page, **kwargs):
     # It is important to use dont_filter=True,
     # because the first request is redirected to itself, which makes scrapy filter this second request
     # see: https://stackoverflow.com/questions/59705305/scrapy-thinks-redirects-are-duplicate-requests
@@ -64,25 +81,60 @@ def search_results_request(context, results_per_site, current_index, expected_it
         method='GET',
         formdata=search_list_params(context=context, results_per_site=results_per_site, index=current_index),
         dont_filter=True,
-        cb_kwargs=dict(items_on_page=expected_items_on_page),
-        meta=dict(expected_language='de')
+        cb_kwargs=dict(items_on_page=expected_items_on_page, page_index=current_index),
+        meta=dict(expected_language='de'),
+        **kwargs
     )
 
 
-def details_request(url, language, refresh_cache=False, **kwargs):
+def details_request(url, language, refresh_cache=False, known_state=None, **kwargs):
+    """
+    @param known_state: The stored state of the page (see `page_validators`), the request is then conditional
+    and the response is checked against it by the DetailsPageUnchangedCheckMiddleware
+    """
     if language not in ['de', 'en']:
         raise ValueError(f'Language must be either "de" or "en", but was "{language}"')
     meta = dict(expected_language=language)
     if refresh_cache:
         meta = dict(meta, refresh_cache=True)
+    headers = {}
+    if known_state is not None:
+        meta = dict(meta, known_page_state=known_state, handle_httpstatus_list=[304])
+        if known_state.get('etag') is not None:
+            headers['If-None-Match'] = known_state['etag']
+        if known_state.get('last_modified') is not None:
+            headers['If-Modified-Since'] = known_state['last_modified']
     return scrapy.FormRequest(url,
                               method='GET',
                               formdata=dict(language=language),
                               dont_filter=True,
                               meta=meta,
+                              headers=headers,
                               **kwargs)
 
 
+def page_validators(response):
+    """
+    @return: dict with the validators of the response for conditional requests (or None if it has none)
+    and the digest of its body, to detect unchanged pages if the server ignores the validators
+    """
+    etag = response.headers.get('ETag')
+    last_modified = response.headers.get('Last-Modified')
+    return dict(etag=etag.decode('latin-1') if etag is not None else None,
+                last_modified=last_modified.decode('latin-1') if last_modified is not None else None,
+                body_hash=body_digest(response.body))
+
+
+def body_digest(body):
+    """
+    @param body: The body of a response as bytes
+    @return: sha256 of the body without its VOLATILE_PAGE_PARTS, so it is the same for every request of an unchanged page
+    """
+    for pattern, replacement in VOLATILE_PAGE_PARTS:
+        body = pattern.sub(replacement, body)
+    return hashlib.sha256(body).hexdigest()
+
+
 def details_url(element_id, context):
     if context not in CONTEXTS:
         raise ValueError(f'Context must be one of {CONTEXTS}, but was "{context}"')
@@ -3,14 +3,24 @@
 # See documentation in:
 # https://docs.scrapy.org/en/latest/topics/spider-middleware.html
 
+import time
+from urllib.parse import urlsplit
+
 from scrapy.downloadermiddlewares.retry import get_retry_request
 from scrapy.exceptions import NotConfigured
 from scrapy.utils.httpobj import urlparse_cached
-from .custom_exceptions import UnexpectedLanguageError, PageDoesNotExistAnymoreError, UnexpectedDetailsPageStructure
+from .custom_exceptions import UnexpectedLanguageError, PageDoesNotExistAnymoreError, UnexpectedDetailsPageStructure, \
+    PageUnchangedError
+from .gepris_helper import page_validators
 
 # useful for handling different item types with a single interface
 from itemadapter import is_item, ItemAdapter
 
+# the reasons of the retries of the ExceptionHandlerMiddleware, they are counted in the "retry/reason_count/..." stats
+RETRY_REASON_LANGUAGE = 'Received Language did not fit expectation'
+RETRY_REASON_FIELD = 'Unexpected Field found'
+RETRY_REASON_STRUCTURE = 'Unexpected DetailsPageStructure'
+
 
 class ExceptionHandlerMiddleware:
 
@@ -20,39 +30,44 @@ class ExceptionHandlerMiddleware:
             new_request_or_none = get_retry_request(
                 response.request.replace(meta=meta),
                 spider=spider,
-                reason='Received Language did not fit expectation'
+                reason=RETRY_REASON_LANGUAGE
             )
         elif isinstance(exception, ValueError) and "error='UnexpectedFieldError:" in exception.args[0]:
             new_request_or_none = get_retry_request(
                 response.request.replace(meta=meta),
                 spider=spider,
-                reason='Unexpected Field found'
+                reason=RETRY_REASON_FIELD
             )
         elif isinstance(exception, PageDoesNotExistAnymoreError):
-            spider.logger.warning(f'{exception} - Marking it as moved in the database')
-            spider.crawler.stats.inc_value('item_moved_count')
-            if self._insert_details_error(spider):
-                spider.db.upsert_available_item(response.cb_kwargs['element_id'], None, spider)
-                spider.db.insert_detail_item(response.cb_kwargs['element_id'], None, spider, 'moved')
+            # all pages of the item are gone, only the first one marks it as moved
+            if self._discard_item(response, spider):
+                spider.logger.warning(f'{exception} - Marking it as moved in the database')
+                spider.crawler.stats.inc_value('item_moved_count')
+                if self._insert_details_error(spider):
+                    spider.db_buffer.add_detail_item(response.cb_kwargs['element_id'], None, 'moved')
             # this does quietly discard the further processing
             return []
+        elif isinstance(exception, PageUnchangedError):
+            # the item did not change since it was written the last time, only the check is recorded
+            return spider.page_unchanged(response.cb_kwargs['element_id'])
         elif isinstance(exception, UnexpectedDetailsPageStructure):
             new_request_or_none = get_retry_request(
                 response.request.replace(meta=meta),
                 spider=spider,
-                reason='Unexpected DetailsPageStructure'
+                reason=RETRY_REASON_STRUCTURE
             )
             if new_request_or_none is None:
                 spider.logger.error(f'{exception}')
-                spider.crawler.stats.inc_value('item_unexpected_structure_count')
                 spider.had_error = True
-                if self._insert_details_error(spider):
-                    spider.db.upsert_available_item(response.cb_kwargs['element_id'], None, spider)
-                    spider.db.insert_detail_item(response.cb_kwargs['element_id'], None, spider, 'error')
+                if self._discard_item(response, spider):
+                    spider.crawler.stats.inc_value('item_unexpected_structure_count')
+                    if self._insert_details_error(spider):
+                        spider.db_buffer.add_detail_item(response.cb_kwargs['element_id'], None, 'error')
                 return []
         # throw other errors immediately
         else:
             spider.had_error = True
+            self._discard_item(response, spider)
             return None
         # retry the request if limit is not reached yet
         if new_request_or_none is not None:
@@ -60,11 +75,59 @@ class ExceptionHandlerMiddleware:
         # throw error
         else:
             spider.had_error = True
+            self._discard_item(response, spider)
             return None
 
     def _insert_details_error(self, spider):
         return not spider.settings.getbool('NO_DB') and spider.name == 'details'
 
+    def _discard_item(self, response, spider):
+        """
+        The other parts of a details item are not needed anymore, if one of them failed
+        @return: True if this is the first failed part of the item (or the spider does not aggregate items)
+        """
+        discard_item = getattr(spider, 'discard_item', None)
+        if discard_item is None or 'element_id' not in response.cb_kwargs:
+            return True
+        return discard_item(response.cb_kwargs['element_id'])
+
+
+class DetailsPageUnchangedCheckMiddleware:
+    """
+    Checks the details pages, that were requested with the stored state of the page (see `details_request`).
+    A 304 response or a body with the stored sha256 (if the server ignores the validators) means the page is unchanged,
+    it is then not parsed at all. The "conditional_requests/..." stats show, whether gepris honours the validators.
+    """
+
+    def __init__(self, stats):
+        self.stats = stats
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if crawler.spider.name != 'details':
+            raise NotConfigured
+        else:
+            return cls(crawler.stats)
+
+    def process_spider_input(self, response, spider):
+        known_state = response.meta.get('known_page_state')
+        if known_state is None:
+            return None
+        if known_state.get('etag') is not None or known_state.get('last_modified') is not None:
+            self.stats.inc_value('conditional_requests/sent')
+            if response.status == 304:
+                self.stats.inc_value('conditional_requests/not_modified')
+            self.stats.set_value('conditional_requests/hit_rate',
+                                 round(self.stats.get_value('conditional_requests/not_modified', 0) /
+                                       self.stats.get_value('conditional_requests/sent'), 3))
+        if response.status == 304:
+            raise PageUnchangedError(f'Page {response.url} was not modified')
+        if page_validators(response)['body_hash'] == known_state.get('body_hash'):
+            self.stats.inc_value('page_digest/unchanged')
+            raise PageUnchangedError(f'Page {response.url} has the same body as before')
+        self.stats.inc_value('page_digest/changed')
+        return None
+
 
 class DetailsPageExpectedStructureCheckMiddleware:
 
@@ -114,6 +177,73 @@ class LanguageCheckMiddleware:
             return None
 
 
+class ProxySlotMiddleware:
+    """
+    Gives each proxy of the RotatingProxyMiddleware its own download slot (by host and port),
+    with at most PROXY_SLOT_CONCURRENCY requests at once and a PROXY_SLOT_DELAY between them.
+    After a ban, the slot of the proxy pauses for PROXY_SLOT_BAN_COOLDOWN seconds, doubled for every further ban
+    up to PROXY_SLOT_MAX_COOLDOWN, so the requests already waiting in the slot do not run into the ban as well.
+    It has to be between the RotatingProxyMiddleware and the BanDetectionMiddleware.
+    """
+
+    def __init__(self, crawler):
+        settings = crawler.settings
+        if not settings.getlist('ROTATING_PROXY_LIST'):
+            raise NotConfigured
+        self.crawler = crawler
+        self.concurrency = settings.getint('PROXY_SLOT_CONCURRENCY', 2)
+        # the cooldown only works with a delay, the downloader only waits for slots with one
+        self.delay = max(settings.getfloat('PROXY_SLOT_DELAY', 1), 0.001)
+        self.cooldown = settings.getfloat('PROXY_SLOT_BAN_COOLDOWN', 60)
+        self.max_cooldown = settings.getfloat('PROXY_SLOT_MAX_COOLDOWN', 900)
+        # the number of bans in a row by slot
+        self.bans = {}
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(crawler)
+
+    @staticmethod
+    def slot_key(proxy):
+        proxy_url = urlsplit(proxy)
+        return f'proxy:{proxy_url.hostname}:{proxy_url.port}'
+
+    def process_request(self, request, spider):
+        if request.meta.get('proxy') is None or not request.meta.get('_rotating_proxy'):
+            return None
+        slot_key = self.slot_key(request.meta['proxy'])
+        request.meta['download_slot'] = slot_key
+        # the downloader creates the slot with these settings
+        self.crawler.engine.downloader.per_slot_settings.setdefault(
+            slot_key, {'concurrency': self.concurrency, 'delay': self.delay})
+        return None
+
+    def process_response(self, request, response, spider):
+        self._handle_result(request, spider)
+        return response
+
+    def process_exception(self, request, exception, spider):
+        self._handle_result(request, spider)
+        return None
+
+    def _handle_result(self, request, spider):
+        slot_key = request.meta.get('download_slot')
+        if not request.meta.get('_rotating_proxy') or slot_key is None:
+            return
+        if request.meta.get('_ban') is True:
+            bans = self.bans.get(slot_key, 0) + 1
+            self.bans[slot_key] = bans
+            cooldown = min(self.cooldown * 2 ** (bans - 1), self.max_cooldown)
+            slot = self.crawler.engine.downloader.slots.get(slot_key)
+            if slot is not None:
+                # the downloader sends the next request of the slot only `delay` seconds after `lastseen`
+                slot.lastseen = max(slot.lastseen, time.monotonic() + cooldown)
+            spider.logger.debug(f'Pausing download slot {slot_key} for {cooldown} seconds after {bans} bans')
+            self.crawler.stats.inc_value('proxies/slot_cooldowns')
+        elif request.meta.get('_ban') is False:
+            self.bans.pop(slot_key, None)
+
+
 # idea from https://stackoverflow.com/a/41774157
 class RefreshHttpCachePolicy:
 
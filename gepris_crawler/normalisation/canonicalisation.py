@@ -0,0 +1,33 @@
+from collections.abc import Mapping
+
+from .project_attributes import PERSONEN_REFERENCES, INSTITUTIONEN_REFERENCES
+
+# the order of these id lists has no meaning, so they are sorted
+SORTED_LIST_KEYS = set(PERSONEN_REFERENCES + INSTITUTIONEN_REFERENCES + ['male_personen', 'female_personen'])
+
+
+def normalise_whitespace(text):
+    """
+    Collapses all whitespace inside of each line to single spaces and strips the lines and the text
+    """
+    return '\n'.join(' '.join(line.split()) for line in text.strip().splitlines())
+
+
+def canonicalise(value, key=None):
+    """
+    Brings an item (or any of its values) into a canonical form, so equal pages always result in equal items:
+    keys are sorted, the id lists of SORTED_LIST_KEYS are sorted and the whitespace of all strings is normalised
+    @param value: The item or value
+    @param key: The key of the value in its parent
+    @return: The canonical value, dicts for mappings and lists for tuples
+    """
+    if isinstance(value, Mapping):
+        return {k: canonicalise(value[k], k) for k in sorted(value)}
+    elif isinstance(value, (list, tuple)):
+        values = [canonicalise(v) for v in value]
+        if key in SORTED_LIST_KEYS:
+            values.sort(key=lambda v: (type(v).__name__, v))
+        return values
+    elif isinstance(value, str):
+        return normalise_whitespace(value)
+    return value
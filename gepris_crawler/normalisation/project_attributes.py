@@ -399,6 +399,6 @@ def normalise(unstructured_attributes_dict):
                 male_personen.update(item[normalised_key])
             elif _parse_for_gender(key) == FEMALE:
                 female_personen.update(item[normalised_key])
-    item['male_personen'] = list(male_personen)
-    item['female_personen'] = list(female_personen)
+    item['male_personen'] = sorted(male_personen)
+    item['female_personen'] = sorted(female_personen)
     return item
@@ -0,0 +1,73 @@
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from scrapy.http import HtmlResponse
+from twisted.internet import defer
+from twisted.python.failure import Failure
+
+# the spiders of a worker process, by their class and context, they are only created once per process
+_worker_spiders = {}
+
+
+def _init_worker(log_level, log_format):
+    # the workers are spawned, so they do not inherit the logging configuration of scrapy
+    logging.basicConfig(level=log_level, format=log_format)
+
+
+def _extract_in_worker(spider_cls, context, method_name, url, body, encoding, kwargs):
+    spider = _worker_spiders.get((spider_cls, context))
+    if spider is None:
+        spider = spider_cls.for_parsing(context)
+        _worker_spiders[(spider_cls, context)] = spider
+    response = HtmlResponse(url=url, body=body, encoding=encoding)
+    return getattr(spider, method_name)(response, **kwargs)
+
+
+class ParserPool:
+    """
+    Runs extraction methods of a spider in a pool of worker processes, so the parsing is not limited to one core.
+    The spider class needs a `for_parsing(context)` class method, that creates a spider without database.
+    The extraction methods get the response and keyword arguments and have to return picklable values (like dicts).
+    The processes are spawned instead of forked, because the crawler process already runs threads.
+    """
+
+    def __init__(self, processes, log_level='INFO', log_format=None):
+        self.executor = ProcessPoolExecutor(max_workers=processes,
+                                            mp_context=multiprocessing.get_context('spawn'),
+                                            initializer=_init_worker,
+                                            initargs=(log_level, log_format))
+
+    @classmethod
+    def from_settings(cls, settings):
+        """
+        @return: A ParserPool with PARSER_PROCESSES processes, or None if it is not enabled
+        """
+        processes = settings.getint('PARSER_PROCESSES', 0)
+        if processes <= 0:
+            return None
+        return cls(processes, log_level=settings.get('LOG_LEVEL'), log_format=settings.get('LOG_FORMAT'))
+
+    def extract(self, spider, method_name, response, **kwargs):
+        """
+        Calls the extraction method `method_name` of the spider in a worker process with a copy of the response
+        @return: Deferred that fires with the result of the method in the reactor thread
+        """
+        from twisted.internet import reactor
+        d = defer.Deferred()
+        future = self.executor.submit(_extract_in_worker, type(spider), spider.context, method_name,
+                                      response.url, response.body, response.encoding, kwargs)
+        future.add_done_callback(lambda f: reactor.callFromThread(self._fire, d, f))
+        return d
+
+    @staticmethod
+    def _fire(d, future):
+        if future.cancelled():
+            d.cancel()
+        elif future.exception() is not None:
+            d.errback(Failure(future.exception()))
+        else:
+            d.callback(future.result())
+
+    def close(self):
+        self.executor.shutdown(wait=True, cancel_futures=True)
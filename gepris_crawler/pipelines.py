@@ -10,6 +10,20 @@ import pprint
 from scrapy.mail import MailSender
 from scrapy.exceptions import NotConfigured
 
+from .normalisation.canonicalisation import canonicalise
+
+
+class CanonicalisationPipeline:
+    """
+    Brings the items of the "details" and "search_results" spider into their canonical form,
+    so unchanged pages result in equal items (and equal hashes) and are not stored again
+    """
+
+    def process_item(self, item, spider):
+        if spider.name not in ['details', 'search_results']:
+            return item
+        return type(item)(canonicalise(item))
+
 
 class DatabaseInsertionPipeline:
     """
@@ -31,9 +45,29 @@ class DatabaseInsertionPipeline:
             return
 
         spider.logger.info(f'Finishing run {spider.run_id} of {spider.name}, doing last database operations')
+        # the last operations have to wait for all remaining items to be written
+        d = spider.db_buffer.flush()
+        d.addCallback(lambda _: spider.db_buffer.call(self._finish_run, spider))
+        d.addCallback(lambda _: self._store_statement_stats(spider))
+        return d
+
+    def _store_statement_stats(self, spider):
+        for name, (count, duration) in spider.db.get_statement_stats().items():
+            spider.crawler.stats.set_value(f'database/statements/{name}/count', count)
+            spider.crawler.stats.set_value(f'database/statements/{name}/seconds', round(duration, 3))
+
+    def _finish_run(self, spider):
         scraped_items = spider.crawler.stats.get_value('item_scraped_count', 0)
+        # the items of batches that could not be written are lost, such a run is not marked as ended
+        lost_items = spider.db_buffer.failed_batches > 0
+        if lost_items:
+            spider.logger.error(f'{spider.db_buffer.failed_batches} batches of run {spider.run_id} were not written,'
+                                f' resume it with the argument "resume={spider.run_id}"')
         if spider.name == 'details':
-            spider.db.update_run_result(spider.run_id, scraped_items)
+            if not lost_items:
+                spider.db.update_run_result(spider.run_id, scraped_items)
+            # leased ids that were not written (e.g. the run was stopped early) can be leased by other runs again
+            spider.db.release_leases(spider)
             if spider.context == 'projekt':
                 # TODO: also create non existing institutionen references from details run
                 spider.db.create_personen_references_from_details_run(spider)
@@ -42,19 +76,34 @@ class DatabaseInsertionPipeline:
                 if spider.context == 'institution':
                     spider.db.mark_detail_check_needed_on_root_institutions_for_moved_sub_institution(spider)
         elif spider.name == 'search_results':
+            if lost_items or spider.had_error:
+                # the items of the lost batches or failed pages would be marked as disappeared
+                spider.logger.error(f'Not merging the search results of run {spider.run_id}, it had errors')
+                return
             spider.db.update_run_result(spider.run_id, scraped_items)
-            spider.db.mark_not_found_available_items(spider)
+            # a delta run does not see the items behind the page it stopped at
+            new_items, changed_items, disappeared_items = spider.db.merge_search_results(
+                spider, mark_disappeared=not spider.delta)
+            spider.crawler.stats.set_value('database/new_items', new_items)
+            spider.crawler.stats.set_value('database/changed_items', changed_items)
+            spider.crawler.stats.set_value('database/disappeared_items', disappeared_items)
         spider.logger.info('Database operations done')
 
     def process_item(self, item, spider):
+        """
+        For the "details" and "search_results" spider this returns a Deferred,
+        that fires after the batch is written if the item completed one, so the items wait for the database writer
+        """
         if spider.name == 'search_results':
-            spider.db.upsert_available_item(item['id'], item, spider)
+            d = spider.db_buffer.add_search_result_item(item, spider.item_pages.get(item['id']))
         elif spider.name == 'details':
-            spider.db.upsert_available_item(item['id'], None, spider)
-            spider.db.insert_detail_item(item['id'], item, spider, 'success')
-        elif spider.name == 'data_monitor':
-            spider.db.insert_data_monitor_run(item)
-        return item
+            d = spider.db_buffer.add_detail_item(item['id'], item, 'success', spider.page_states.pop(item['id'], None))
+        else:
+            if spider.name == 'data_monitor':
+                spider.db.insert_data_monitor_run(item)
+            return item
+        d.addCallback(lambda _: item)
+        return d
 
 
 class EmailNotifierPipeline:
@@ -90,7 +139,8 @@ class EmailNotifierPipeline:
 
     def close_spider(self, spider):
         scraped_items = spider.crawler.stats.get_value('item_scraped_count', 0) + \
-                        spider.crawler.stats.get_value('item_moved_count', 0)
+                        spider.crawler.stats.get_value('item_moved_count', 0) + \
+                        spider.crawler.stats.get_value('item_unchanged_count', 0)
         expected_items = self._get_expected_items(spider)
         if spider.had_error:
             subject = self._build_subject(spider, 'Error', scraped_items, expected_items)
@@ -128,6 +178,9 @@ class EmailNotifierPipeline:
         if spider.name == 'data_monitor':
             return 1
         elif spider.name == 'search_results':
+            if spider.delta:
+                # a delta run stops once the pages do not change anymore, only the items of its pages are expected
+                return spider.requested_items_count
             if spider.context == 'projekt':
                 items = spider.db.get_latest_dm_stat('project_count')
                 if items is not None:
@@ -136,7 +189,7 @@ class EmailNotifierPipeline:
             # or there is no dm run yet
             return spider.total_items
         elif spider.name == 'details':
-            return len(spider.ids)
+            return spider.requested_ids_count
 
     def _send(self, subject, body):
         self.mailer.send(to=[self.receiver], subject=subject, body=body)
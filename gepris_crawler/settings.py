@@ -13,6 +13,7 @@ BOT_NAME = 'gepris_crawler'
 
 SPIDER_MODULES = ['gepris_crawler.spiders']
 NEWSPIDER_MODULE = 'gepris_crawler.spiders'
+COMMANDS_MODULE = 'gepris_crawler.commands'
 
 # Database specific credentials
 DATABASE_NAME = os.environ.get('POSTGRES_DB')
@@ -20,6 +21,50 @@ DATABASE_USER = os.environ.get('POSTGRES_USER')
 DATABASE_PASSWORD = os.environ.get('POSTGRES_PASSWORD')
 DATABASE_HOST = os.environ.get('POSTGRES_HOST')
 DATABASE_PORT = os.environ.get('POSTGRES_PORT')
+# the connections are shared by the spider and the writer thread, so the pool needs at least two with async writes
+# (the server side cursors of the details ids have their own connection)
+DATABASE_POOL_SIZE = 2
+# transactions that can safely be run again are retried DATABASE_RETRIES times if the connection was lost
+DATABASE_RETRIES = 3
+# connections that were not used for DATABASE_HEALTH_CHECK_AFTER seconds are checked before they are used again
+DATABASE_HEALTH_CHECK_AFTER = 60
+# Items of the details and search_results spider are written in batches,
+# a batch is written when it has DATABASE_BATCH_SIZE items or after DATABASE_FLUSH_INTERVAL seconds
+DATABASE_BATCH_SIZE = 500
+DATABASE_FLUSH_INTERVAL = 10
+# The batches are written by a separate thread, so the crawling is not blocked by the database
+# If there are already DATABASE_MAX_PENDING_BATCHES batches waiting to be written, new items have to wait
+DATABASE_ASYNC_WRITES = True
+DATABASE_MAX_PENDING_BATCHES = 2
+
+# Details runs with ids like "lease:needed:N" lease DETAILS_LEASE_BATCH_SIZE ids at a time for DETAILS_LEASE_SECONDS,
+# ids that are not written within that time can be leased by other runs again
+DETAILS_LEASE_BATCH_SIZE = 100
+DETAILS_LEASE_SECONDS = 1800
+
+# The details spider stores a fingerprint of the german page of each item, if a page has the same fingerprint again,
+# only the check is recorded and the other pages of the item (english and results) are not fetched.
+# The german pages of these items are requested with their stored ETag and Last-Modified, a 304 response
+# (or the same body, if gepris ignores them) is not parsed at all.
+# Disable it after changes to the parsing, so all items are built again
+DETAILS_SKIP_UNCHANGED_PAGES = True
+
+# Details runs with ids like "db:smart:N" fetch the N ids, whose items most likely changed since their last check.
+# The rate of changes of an item is learned from its versions, starting from the rate of its segment
+# (projekte that ended at least DETAILS_SMART_FINISHED_AFTER_YEARS ago and all others),
+# which counts as observed for DETAILS_SMART_PRIOR_DAYS days
+DETAILS_SMART_PRIOR_DAYS = 180
+DETAILS_SMART_FINISHED_AFTER_YEARS = 1
+
+# search_results runs with the argument "mode=delta" fetch the pages one after another and compare their items
+# with the stored ones, they stop after SEARCH_RESULTS_DELTA_UNCHANGED_PAGES pages in a row without changes
+SEARCH_RESULTS_DELTA_UNCHANGED_PAGES = 2
+
+# The details_items_history is partitioned by context and blocks of 1000 runs,
+# `scrapy archive_history` exports all but the newest HISTORY_ARCHIVE_KEEP_PARTITIONS partitions of each context
+# to HISTORY_ARCHIVE_DIRECTORY and drops them, only the latest version of each item is kept in the database
+HISTORY_ARCHIVE_KEEP_PARTITIONS = 2
+HISTORY_ARCHIVE_DIRECTORY = 'volumes/history-archive'
 
 LOG_LEVEL = 'INFO'
 
@@ -50,6 +95,7 @@ if os.environ.get('WEBSHARE_PROXY_LIST_URL'):
     ROTATING_PROXY_LIST = get_formatted_proxy_list(os.environ.get('WEBSHARE_PROXY_LIST_URL'))
     PROXY_MIDDLEWARES = {
         'rotating_proxies.middlewares.RotatingProxyMiddleware': 610,
+        'gepris_crawler.middlewares.ProxySlotMiddleware': 615,
         'rotating_proxies.middlewares.BanDetectionMiddleware': 620,
     }
     DOWNLOADER_MIDDLEWARES.update(PROXY_MIDDLEWARES)
@@ -67,11 +113,26 @@ ROBOTSTXT_OBEY = True
 
 # Configure maximum concurrent requests performed by Scrapy (default: 16)
 CONCURRENT_REQUESTS = 16
+# With rotating proxies, each proxy has its own download slot with at most PROXY_SLOT_CONCURRENCY requests at once
+# and PROXY_SLOT_DELAY seconds between them. After a ban the slot pauses for PROXY_SLOT_BAN_COOLDOWN seconds,
+# doubled for each further ban in a row up to PROXY_SLOT_MAX_COOLDOWN.
+# The total concurrency then grows with the number of proxies.
+PROXY_SLOT_CONCURRENCY = 2
+PROXY_SLOT_DELAY = 1
+PROXY_SLOT_BAN_COOLDOWN = 60
+PROXY_SLOT_MAX_COOLDOWN = 900
+if os.environ.get('WEBSHARE_PROXY_LIST_URL'):
+    CONCURRENT_REQUESTS = max(CONCURRENT_REQUESTS, PROXY_SLOT_CONCURRENCY * len(ROTATING_PROXY_LIST))
+
+# The pages of the details spider are parsed in PARSER_PROCESSES worker processes, 0 parses them in the crawler process
+PARSER_PROCESSES = 0
 
 # Configure a delay for requests for the same website (default: 0)
 # See https://docs.scrapy.org/en/latest/topics/settings.html#download-delay
 # See also autothrottle settings and docs
-#DOWNLOAD_DELAY = 3
+# The AutoThrottle extension is disabled, this is the minimum delay between the requests of a download slot,
+# the AdaptiveConcurrency extension only backs off above it
+DOWNLOAD_DELAY = 0.5
 # The download delay setting will honor only one of:
 # CONCURRENT_REQUESTS_PER_DOMAIN = 16
 CONCURRENT_REQUESTS_PER_IP = 8
@@ -96,6 +157,7 @@ COOKIES_ENABLED = True
 # Higher: Nearer to Spider: process_output is executed earlier
 SPIDER_MIDDLEWARES = {
     'gepris_crawler.middlewares.ExceptionHandlerMiddleware': 501,
+    'gepris_crawler.middlewares.DetailsPageUnchangedCheckMiddleware': 530,
     'gepris_crawler.middlewares.DetailsPageExpectedStructureCheckMiddleware': 541,
     'gepris_crawler.middlewares.DetailsPageExistsCheckMiddleware': 542,
     'gepris_crawler.middlewares.LanguageCheckMiddleware': 543,
@@ -103,20 +165,45 @@ SPIDER_MIDDLEWARES = {
 
 # Enable or disable extensions
 # See https://docs.scrapy.org/en/latest/topics/extensions.html
-#EXTENSIONS = {
-#    'scrapy.extensions.telnet.TelnetConsole': None,
-#}
+EXTENSIONS = {
+    'gepris_crawler.extensions.AdaptiveConcurrency': 500,
+}
 
 # Configure item pipelines
 # See https://docs.scrapy.org/en/latest/topics/item-pipeline.html
 ITEM_PIPELINES = {
+    'gepris_crawler.pipelines.CanonicalisationPipeline': 298,
     'gepris_crawler.pipelines.DatabaseInsertionPipeline': 299,
     'gepris_crawler.pipelines.EmailNotifierPipeline': 300,
 }
 
+# The AdaptiveConcurrency extension adjusts the concurrency of the download slots every ADAPTIVE_CONCURRENCY_INTERVAL
+# seconds, between ADAPTIVE_CONCURRENCY_MIN and ADAPTIVE_CONCURRENCY_MAX (at most CONCURRENT_REQUESTS).
+# It is halved if more than ADAPTIVE_CONCURRENCY_MAX_BAN_RATE of the responses were bans (403, 429, wrong language),
+# more than ADAPTIVE_CONCURRENCY_MAX_ERROR_RATE were errors (download errors, 5xx, broken pages)
+# or the 90th latency percentile is above ADAPTIVE_CONCURRENCY_MAX_LATENCY seconds.
+# It is increased by 1 if the median latency is below ADAPTIVE_CONCURRENCY_TARGET_LATENCY seconds without errors.
+# Intervals with less than ADAPTIVE_CONCURRENCY_MIN_SAMPLES responses do not change it.
+# At ADAPTIVE_CONCURRENCY_MIN, a decrease doubles the delay of the download slots instead (starting at
+# ADAPTIVE_CONCURRENCY_BACKOFF_DELAY seconds, up to ADAPTIVE_CONCURRENCY_MAX_DELAY), an increase halves it again
+# before the concurrency grows. The delay never goes below DOWNLOAD_DELAY (or PROXY_SLOT_DELAY for proxy slots).
+ADAPTIVE_CONCURRENCY_ENABLED = True
+ADAPTIVE_CONCURRENCY_INTERVAL = 30
+ADAPTIVE_CONCURRENCY_START = 2
+ADAPTIVE_CONCURRENCY_MIN = 1
+ADAPTIVE_CONCURRENCY_MAX = 8
+ADAPTIVE_CONCURRENCY_TARGET_LATENCY = 2
+ADAPTIVE_CONCURRENCY_MAX_LATENCY = 10
+ADAPTIVE_CONCURRENCY_MAX_ERROR_RATE = 0.05
+ADAPTIVE_CONCURRENCY_MAX_BAN_RATE = 0
+ADAPTIVE_CONCURRENCY_MIN_SAMPLES = 5
+ADAPTIVE_CONCURRENCY_BACKOFF_DELAY = 1
+ADAPTIVE_CONCURRENCY_MAX_DELAY = 30
+
 # Enable and configure the AutoThrottle extension (disabled by default)
 # See https://docs.scrapy.org/en/latest/topics/autothrottle.html
-AUTOTHROTTLE_ENABLED = True
+# It is replaced by the AdaptiveConcurrency extension, its delays would limit the concurrency to its target
+AUTOTHROTTLE_ENABLED = False
 # The initial download delay
 AUTOTHROTTLE_START_DELAY = 2
 # The maximum download delay to be set in case of high latencies
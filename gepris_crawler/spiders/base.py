@@ -2,8 +2,10 @@ from abc import ABC
 from collections.abc import Iterable
 
 import scrapy
+from twisted.internet import defer
 
 from ..database import PostgresDatabase
+from ..database_buffer import DatabaseWriteBuffer
 from ..data_transformations import clean_string
 from ..gepris_helper import check_valid_context
 from datetime import datetime
@@ -19,10 +21,13 @@ class BaseSpider(scrapy.Spider, ABC):
     This class contains a collection of methods used in spiders for the gepris crawler
     """
 
-    def __init__(self, context=None, settings=None, *args, **kwargs):
+    def __init__(self, context=None, settings=None, resume=None, *args, **kwargs):
         super(BaseSpider, self).__init__(*args, **kwargs)
         self.had_error = False
+        # the id of an earlier run, whose completed work is skipped
+        self.resumed_run = int(resume) if resume is not None else None
         self.db = None
+        self.db_buffer = None
         if not settings.getbool('NO_DB'):
             self.db = PostgresDatabase(settings)
             self.db.open()
@@ -31,7 +36,9 @@ class BaseSpider(scrapy.Spider, ABC):
             self.context = context
             check_valid_context(self.context)
             if self.db is not None:
-                self.run_id = self.db.store_run(self.name, self.context)
+                self.run_id = self.db.store_run(self.name, self.context, resumed_run=self.resumed_run)
+                if self.name in ['details', 'search_results']:
+                    self.db_buffer = DatabaseWriteBuffer.from_settings(self.db, self, settings)
 
     @classmethod
     def from_crawler(cls, crawler, *args, **kwargs):
@@ -242,6 +249,27 @@ class BaseSpider(scrapy.Spider, ABC):
         else:
             return selector.root.base_url
 
+    def call_db(self, func, *args):
+        """
+        Calls `func` in the writer thread of the database buffer (after the queued writes), so it does not block
+        the reactor, or directly if there is no buffer
+        @return: Deferred that fires with the result of the call
+        """
+        if self.db_buffer is None:
+            return defer.maybeDeferred(func, *args)
+        return self.db_buffer.call(func, *args)
+
     def closed(self, spider):
+        """
+        @return: Deferred that fires when the queued database writes are done and the database is closed
+        """
+        d = self.db_buffer.close() if self.db_buffer is not None else defer.succeed(None)
+        d.addCallback(lambda _: self.close_database_reads())
         if self.db is not None:
-            self.db.close()
+            d.addCallback(lambda _: self.db.close())
+        return d
+
+    def close_database_reads(self):
+        """
+        Ends the reads of the spider, that may still use the database, after the writer thread stopped
+        """
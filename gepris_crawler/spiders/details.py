@@ -1,8 +1,17 @@
+import hashlib
 import json
 import re
+from itertools import islice
+
+import scrapy
+from scrapy.utils.defer import maybe_deferred_to_future
 
 from .base import BaseSpider
-from ..gepris_helper import details_request, details_url
+from ..custom_exceptions import UnexpectedLanguageError, PageDoesNotExistAnymoreError, UnexpectedDetailsPageStructure, \
+    PageUnchangedError
+from ..gepris_helper import details_request, details_url, page_validators, check_valid_context
+from ..details_aggregator import DetailsItemAggregator
+from ..parser_pool import ParserPool
 from ..items import ProjectItem, ProjectDetailsLoader, ProjectResultLoader, PersonDetailsLoader, \
     InstitutionDetailsLoader, ProjectResultItem
 from w3lib.url import url_query_cleaner
@@ -13,8 +22,27 @@ class DetailsSpider(BaseSpider):
     name = 'details'
     allowed_domains = ['gepris.dfg.de']
 
-    def __init__(self, ids, context, *args, **kwargs):
-        super().__init__(context, *args, **kwargs)
+    def __init__(self, ids, context, settings=None, *args, **kwargs):
+        super().__init__(context, *args, settings=settings, **kwargs)
+        self._set_context_loader()
+        # stored states of the german pages by their id, if a page did not change its item did not change either
+        self.skip_unchanged_pages = self.db is not None and settings.getbool('DETAILS_SKIP_UNCHANGED_PAGES', True)
+        self.known_page_states = {}
+        # states of the german pages of this run by their id, they are written with their items
+        self.page_states = {}
+        # the ids that were already checked by the resumed run are not requested again
+        self.completed_ids = set()
+        if self.resumed_run is not None and self.db is not None:
+            self.completed_ids = self.db.get_completed_detail_ids(self)
+        # the ids are only read while the requests are created
+        self.ids = self._parse_ids(ids)
+        self.requested_ids_count = 0
+        # the pages are parsed in worker processes, if PARSER_PROCESSES is set
+        self.parser_pool = ParserPool.from_settings(settings)
+        # collects the concurrently fetched pages of each item
+        self.aggregator = DetailsItemAggregator()
+
+    def _set_context_loader(self):
         if self.context == 'person':
             self.context_loader_cls = PersonDetailsLoader
             self.context_load_function = self.load_person
@@ -24,42 +52,341 @@ class DetailsSpider(BaseSpider):
         elif self.context == 'projekt':
             self.context_loader_cls = ProjectDetailsLoader
             self.context_load_function = self.load_project
-        self.ids = self._parse_ids(ids)
 
     def _parse_ids(self, ids_str):
         if isinstance(ids_str, str) and ids_str.startswith('[') and ids_str.endswith(']'):
             # ids like "[1,2,3]"
-            return {int(element_id) for element_id in ids_str[1:-1].split(',')}
+            return self._with_known_hashes(int(element_id) for element_id in ids_str[1:-1].split(','))
         elif isinstance(ids_str, str) and ids_str.endswith('.json'):
             # ids like "projekts.json", a json file, that is an array where each child object has key 'id'
-            with open(ids_str) as f:
-                return {p['id'] for p in json.load(f)}
-        elif isinstance(ids_str, str) and re.match(r'db:(all|needed):\d+', ids_str) and self.db is not None:
-            limit = ids_str.split(':')[2]
+            return self._with_known_hashes(self._ids_from_json(ids_str))
+        elif isinstance(ids_str, str) and re.match(r'db:(all|needed|smart):\d+', ids_str) and self.db is not None:
+            limit = self._remaining_limit(int(ids_str.split(':')[2]))
+            if limit is None:
+                return self._ids_with_item_hashes([])
             if ids_str.startswith('db:all'):
                 # all ids of the context from the scrapy items table in the database
-                return set(self.db.get_ids(self.context, limit=int(limit)))
+                return self._ids_from_db(only_needed=False, limit=limit)
             elif ids_str.startswith('db:needed'):
                 # all ids of the context from the scrapy items table in the database, that should be rescraped based on heuristics
-                return set(self.db.get_ids(self.context, only_needed=True, limit=int(limit)))
+                return self._ids_from_db(only_needed=True, limit=limit)
+            elif ids_str.startswith('db:smart'):
+                # the ids of the context, whose items most likely changed since their last detail check
+                return self._ids_from_smart_ranking(limit=limit)
             else:
-                raise ValueError('If you want the ids from the database please provide either "db:all:{NUMBER}" or '
-                                 '"db:needed:{NUMBER}"')
+                raise ValueError('If you want the ids from the database please provide either "db:all:{NUMBER}", '
+                                 '"db:needed:{NUMBER}" or "db:smart:{NUMBER}"')
+        elif isinstance(ids_str, str) and re.match(r'lease:(all|needed):\d+$', ids_str) and self.db is not None:
+            # like "db:...", but the ids are leased in batches, so several details runs can share the work
+            _, mode, limit = ids_str.split(':')
+            return self._ids_from_leases(only_needed=mode == 'needed', limit=int(limit))
         else:
             raise ValueError(
                 f"Wrong format of the 'ids_str' argument, was {ids_str}, of type {type(ids_str)}, if you want to access "
                 "the db, do not enable setting 'NO_DB'")
 
+    def _remaining_limit(self, limit):
+        """
+        The ids checked by the resumed runs were part of their selection, but now they come last in the order
+        (or are not needed anymore), so a resumed run only selects as many ids as are left of the limit
+        @param limit: The limit of the ids argument, 0 means no limit
+        @return: The limit for the selection of the ids, None if there are no ids left
+        """
+        if limit == 0 or len(self.completed_ids) == 0:
+            return limit
+        remaining = limit - len(self.completed_ids)
+        self.logger.info(f'{len(self.completed_ids)} of the {limit} ids were checked by the resumed run,'
+                         f' selecting the remaining {max(remaining, 0)}')
+        return remaining if remaining > 0 else None
+
+    @staticmethod
+    def _ids_from_json(path):
+        with open(path) as f:
+            for p in json.load(f):
+                yield p['id']
+
+    def _ids_from_db(self, only_needed, limit):
+        # the ids are unique in the database, the hashes of their latest items come with them
+        return self._ids_with_item_hashes(self.db.iter_ids(self.context, only_needed=only_needed, limit=limit))
+
+    def _ids_from_smart_ranking(self, limit):
+        rows = self.db.iter_smart_ids(self.context, limit,
+                                      prior_days=self.settings.getfloat('DETAILS_SMART_PRIOR_DAYS', 180),
+                                      finished_after_years=self.settings.getint('DETAILS_SMART_FINISHED_AFTER_YEARS', 1))
+        expected_changes = 0
+
+        def with_hashes():
+            nonlocal expected_changes
+            try:
+                for element_id, item_hash, probability in rows:
+                    expected_changes += probability
+                    # compared with the actually changed items, this shows how good the ranking is
+                    self.crawler.stats.set_value('smart_ids/expected_changes', round(expected_changes, 1))
+                    yield element_id, item_hash
+            finally:
+                rows.close()
+
+        yield from self._ids_with_item_hashes(with_hashes())
+
+    def _ids_with_item_hashes(self, rows):
+        """
+        @param rows: Iterable of tuples like (id, hash of the latest item or None)
+        """
+        rows = iter(rows)
+        try:
+            while True:
+                chunk = list(islice(rows, 1000))
+                if len(chunk) == 0:
+                    return
+                self._remember_page_states([element_id for element_id, _ in chunk])
+                for element_id, item_hash in chunk:
+                    if self.db_buffer is not None and item_hash is not None:
+                        self.db_buffer.known_hashes[element_id] = item_hash
+                    yield element_id
+        finally:
+            # ends the server side cursor (and its connection) of rows that were not read to the end
+            if hasattr(rows, 'close'):
+                rows.close()
+
+    def _ids_from_leases(self, only_needed, limit):
+        """
+        Leases the ids batch by batch while the requests are created, until `limit` ids were leased (0 means no limit)
+        or there are no ids left. The leases end when the items are written, the remaining ones at the end of the run.
+        """
+        batch_size = self.settings.getint('DETAILS_LEASE_BATCH_SIZE', 100)
+        lease_seconds = self.settings.getint('DETAILS_LEASE_SECONDS', 1800)
+        leased_count = 0
+        while limit == 0 or leased_count < limit:
+            batch_limit = batch_size if limit == 0 else min(batch_size, limit - leased_count)
+            leased = self.db.lease_ids(self, only_needed=only_needed, limit=batch_limit, lease_seconds=lease_seconds)
+            if len(leased) == 0:
+                return
+            leased_count += len(leased)
+            self._remember_page_states([element_id for element_id, _ in leased])
+            for element_id, item_hash in leased:
+                if self.db_buffer is not None and item_hash is not None:
+                    self.db_buffer.known_hashes[element_id] = item_hash
+                yield element_id
+
+    def _with_known_hashes(self, ids, chunk_size=1000):
+        """
+        Skips duplicated ids and gets the hashes of the latest items for each chunk of ids
+        """
+        seen = set()
+        unique_ids = (element_id for element_id in ids if not (element_id in seen or seen.add(element_id)))
+        while True:
+            chunk = list(islice(unique_ids, chunk_size))
+            if len(chunk) == 0:
+                return
+            if self.db_buffer is not None:
+                # unchanged items can then be detected without asking the database
+                self.db_buffer.known_hashes.update(self.db.get_latest_item_hashes(self.context, chunk))
+                self._remember_page_states(chunk)
+            yield from chunk
+
+    def _remember_page_states(self, ids):
+        if self.skip_unchanged_pages:
+            self.known_page_states.update(self.db.get_page_states(self.context, ids))
+
+    @classmethod
+    def for_parsing(cls, context):
+        """
+        Creates the spider without running its constructor, so no ids are resolved and there is no database,
+        cursor, aggregator or parser pool
+        @return: A spider, that is only used for the extraction methods (in the workers of the pool)
+        """
+        check_valid_context(context)
+        spider = cls.__new__(cls)
+        scrapy.Spider.__init__(spider)
+        spider.had_error = False
+        spider.db = None
+        spider.db_buffer = None
+        spider.context = context
+        spider._set_context_loader()
+        return spider
+
+    async def start(self):
+        """
+        The ids are read chunk by chunk in the writer thread of the database buffer,
+        so reading them (and the hashes and page states that come with them) does not block the reactor
+        """
+        while True:
+            chunk = await maybe_deferred_to_future(self._read_ids())
+            if len(chunk) == 0:
+                return
+            for request in self._requests(chunk):
+                yield request
+
     def start_requests(self):
-        for element_id in self.ids:
-            yield details_request(details_url(element_id, self.context), 'de',
-                                  refresh_cache=self.settings.getbool('HTTPCACHE_FORCE_REFRESH'),
-                                  callback=self.parse_german, cb_kwargs=dict(element_id=element_id))
+        # only used by scrapy versions without `start`, they read the ids in the reactor thread
+        return self._requests(self.ids)
+
+    def _read_ids(self, chunk_size=1000):
+        """
+        @return: Deferred that fires with the next `chunk_size` ids, an empty list if there are none left
+        """
+        def read():
+            return list(islice(self.ids, chunk_size))
+
+        return self.call_db(read)
+
+    def _requests(self, ids):
+        for element_id in ids:
+            if element_id in self.completed_ids:
+                self.crawler.stats.inc_value('resume/skipped_ids')
+                continue
+            self.requested_ids_count += 1
+            url = details_url(element_id, self.context)
+            refresh_cache = self.settings.getbool('HTTPCACHE_FORCE_REFRESH')
+            # the pages of both languages are fetched at once, the aggregator puts them together
+            # if the german page is known, the english one is only fetched when the german one changed
+            known_state = self.known_page_states.get(element_id)
+            if self.context == 'projekt' and known_state is None:
+                self.aggregator.open(element_id, ['de', 'en'])
+                yield details_request(url, 'de', refresh_cache=refresh_cache, callback=self._callback('parse_german'),
+                                      errback=self.part_failed, cb_kwargs=dict(element_id=element_id))
+                yield details_request(url, 'en', refresh_cache=refresh_cache,
+                                      callback=self._callback('parse_english_project'),
+                                      errback=self.part_failed, cb_kwargs=dict(element_id=element_id))
+            else:
+                self.aggregator.open(element_id, ['de'])
+                yield details_request(url, 'de', refresh_cache=refresh_cache, known_state=known_state,
+                                      callback=self._callback('parse_german'), errback=self.part_failed,
+                                      cb_kwargs=dict(element_id=element_id))
+
+    def closed(self, spider):
+        if self.parser_pool is not None:
+            self.parser_pool.close()
+        if len(self.aggregator) > 0:
+            self.logger.warning(f'{len(self.aggregator)} items were not complete when the spider closed')
+        return super().closed(spider)
+
+    def close_database_reads(self):
+        # closes the connection of a not yet finished database cursor,
+        # the writer thread is stopped, so it is not reading the ids anymore
+        self.ids.close()
+
+    def _callback(self, name):
+        """
+        @return: The callback with this name, or its variant that extracts in the parser pool if there is one
+        """
+        if self.parser_pool is not None:
+            return getattr(self, f'{name}_in_pool')
+        return getattr(self, name)
+
+    def part_failed(self, failure):
+        """
+        Errback of the requests of the parts, the item can not be completed anymore
+        """
+        if failure.check(UnexpectedLanguageError, PageDoesNotExistAnymoreError, UnexpectedDetailsPageStructure,
+                         PageUnchangedError):
+            # raised by the checks of the spider middlewares, the ExceptionHandlerMiddleware retries or records them
+            return failure
+        element_id = failure.request.cb_kwargs['element_id']
+        if self.discard_item(element_id):
+            self.logger.error(f'Fetching {failure.request.url} failed, discarding item {element_id}: {failure.value}')
+            self.crawler.stats.inc_value('item_discarded_count')
+
+    def discard_item(self, element_id):
+        """
+        Drops the arrived parts and the page states of an item, that can not be completed anymore
+        @return: True if the item was still open, so only the first failed part of an item returns True
+        """
+        self.page_states.pop(element_id, None)
+        self.known_page_states.pop(element_id, None)
+        return self.aggregator.discard(element_id)
+
+    def part_arrived(self, element_id, part, data, requests=()):
+        """
+        @return: List of the given requests and the item, if this was its last missing part
+        """
+        parts = self.aggregator.add(element_id, part, data)
+        if parts is None:
+            return list(requests)
+        return [*requests, self.build_item(parts)]
+
+    def build_item(self, parts):
+        """
+        @param parts: dict of the extracted parts of an item by their name
+        """
+        if self.context != 'projekt':
+            return self.context_loader_cls.default_item_class(parts['de'])
+        project_item = ProjectItem({**parts['de'], **parts['en']})
+        if 'result_de' in parts:
+            project_item['result'] = dict(ProjectResultItem(**parts['result_de'], **parts['result_en']))
+        return project_item
 
     def parse_german(self, response, element_id):
+        german, result_url, page_hash = self.extract_german(response, element_id)
+        return self.german_extracted(element_id, german, result_url,
+                                     dict(page_validators(response), page_hash=page_hash))
+
+    async def parse_german_in_pool(self, response, element_id):
+        german, result_url, page_hash = await maybe_deferred_to_future(
+            self.parser_pool.extract(self, 'extract_german', response, element_id=element_id))
+        return self.german_extracted(element_id, german, result_url,
+                                     dict(page_validators(response), page_hash=page_hash))
+
+    def extract_german(self, response, element_id):
+        """
+        @return: Tuple of the dict of the item (for projekte only the part of the german page),
+        the url of the result page of a projekt or None and the fingerprint of the page
+        """
         loader = self.context_loader_cls()
         loader.add_value('id', element_id)
-        return self.context_load_function(response, loader)
+        german = dict(self.context_load_function(response, loader))
+        result_url = None
+        if self.context == 'projekt':
+            result_list = self.get_content_div(response).xpath('.//li[@id="tabbutton2"]/a')
+            if len(result_list) == 1:
+                result_url = urljoin(url_query_cleaner(response.url), result_list.attrib['href'])
+        return german, result_url, self.page_fingerprint(response)
+
+    def page_fingerprint(self, response):
+        """
+        @return: sha256 of the html of the content div, the rest of the page (like the navigation) is not part of the item
+        """
+        return hashlib.sha256((self.get_content_div(response).get() or '').encode('utf-8')).hexdigest()
+
+    def german_extracted(self, element_id, german, result_url, page_state):
+        """
+        @param page_state: dict with the fingerprint and the validators of the german page
+        """
+        known_state = self.known_page_states.get(element_id)
+        if self.skip_unchanged_pages and known_state is not None \
+                and known_state['page_hash'] == page_state['page_hash']:
+            # the validators of the page may have changed anyway
+            return self.page_unchanged(element_id, page_state)
+        if self.db is not None:
+            self.page_states[element_id] = page_state
+        requests = []
+        if self.context == 'projekt' and not self.aggregator.expects(element_id, 'en') \
+                and self.aggregator.expect(element_id, 'en'):
+            # the german page changed, so the english one is needed as well
+            requests.append(details_request(details_url(element_id, self.context), 'en',
+                                            refresh_cache=self.settings.getbool('HTTPCACHE_FORCE_REFRESH'),
+                                            callback=self._callback('parse_english_project'),
+                                            errback=self.part_failed, cb_kwargs=dict(element_id=element_id)))
+        # both languages of the result page are fetched at once as well
+        if result_url is not None and self.aggregator.expect(element_id, 'result_de', 'result_en'):
+            requests += [details_request(result_url, language, callback=self._callback('parse_project_result'),
+                                         errback=self.part_failed,
+                                         cb_kwargs=dict(element_id=element_id, english=language == 'en'))
+                         for language in ['de', 'en']]
+        return self.part_arrived(element_id, 'de', german, requests)
+
+    def page_unchanged(self, element_id, page_state=None):
+        """
+        The german page did not change since the item was written the last time, so only the check is recorded
+        and the other pages of the item are not fetched
+        @param page_state: The new state of the page, if it was parsed
+        @return: Empty list, there is no new item
+        """
+        self.discard_item(element_id)
+        self.crawler.stats.inc_value('item_unchanged_count')
+        if self.db_buffer is not None:
+            self.db_buffer.add_unchanged_detail_item(element_id, page_state)
+        return []
 
     # Project Stuff
     def load_project(self, response, loader):
@@ -74,11 +401,19 @@ class DetailsSpider(BaseSpider):
         attributes_div = content.xpath('./div[@class="details"]')
         for row in attributes_div.xpath('./div'):
             loader.add_value('attributes', self.attributes_pairs_list(row.xpath('./span')))
+        return loader.load_item()
 
-        return details_request(url_query_cleaner(response.url), 'en',
-                               callback=self.parse_english_project, cb_kwargs=dict(project_item=loader.load_item()))
+    def parse_english_project(self, response, element_id):
+        return self.part_arrived(element_id, 'en', self.extract_english_project(response))
 
-    def parse_english_project(self, response, project_item):
+    async def parse_english_project_in_pool(self, response, element_id):
+        english = await maybe_deferred_to_future(self.parser_pool.extract(self, 'extract_english_project', response))
+        return self.part_arrived(element_id, 'en', english)
+
+    def extract_english_project(self, response):
+        """
+        @return: dict with the english fields of the projekt
+        """
         project_loader = ProjectDetailsLoader()
         project_loader.add_value('name_en', self.get_name(response, accept_none=True, accept_mult=True))
         content = self.get_content_div(response)
@@ -86,35 +421,33 @@ class DetailsSpider(BaseSpider):
                                  self.non_empty_text(
                                      content.xpath('.//div[@id="projektbeschreibung"]/div[@id="projekttext"]'),
                                      err_mult=False))
-        new_project_item = ProjectItem({**dict(project_item), **dict(project_loader.load_item())})
-        result_list = content.xpath('.//li[@id="tabbutton2"]/a')
-        if len(result_list) == 1:
-            return details_request(urljoin(url_query_cleaner(response.url), result_list.attrib['href']), 'de',
-                                   callback=self.parse_project_result,
-                                   cb_kwargs=dict(project_item=new_project_item))
-        else:
-            return new_project_item
+        return dict(project_loader.load_item())
+
+    def parse_project_result(self, response, element_id, english=False):
+        result = self.extract_project_result(response, english=english)
+        return self.part_arrived(element_id, 'result_en' if english else 'result_de', result)
+
+    async def parse_project_result_in_pool(self, response, element_id, english=False):
+        result = await maybe_deferred_to_future(
+            self.parser_pool.extract(self, 'extract_project_result', response, english=english))
+        return self.part_arrived(element_id, 'result_en' if english else 'result_de', result)
 
-    def parse_project_result(self, response, project_item, result_item=None):
+    def extract_project_result(self, response, english):
+        """
+        @return: dict with the fields of the result page, only the summary for the english page
+        """
         result_loader = ProjectResultLoader()
         result_content = response.css('#projektbeschreibung')
         summary = self.non_empty_text(result_content.xpath('./p'), err_mult=False)
-        # this is the request for the english page, add the english summary to the result_loader
-        # and set the result_item in the project_loader
-        if result_item is not None:
+        if english:
             result_loader.add_value('ergebnis_zusammenfassung_en', summary)
-            project_item['result'] = dict(ProjectResultItem(**dict(result_item), **dict(result_loader.load_item())))
-            return project_item
         else:
-            result_content = response.css('#projektbeschreibung')
             result_loader.add_value('ergebnis_zusammenfassung_de', summary)
             for div in result_content.xpath('./div'):
                 result_loader.add_value('attributes', self.attributes_pairs_list(div.xpath('./span')))
             for publication in result_content.xpath('./ul[@class="publications"]/li'):
                 result_loader.add_value('ergebnis_publikationen', self.extract_text_and_links(publication))
-            # do the request for the english result page
-            return details_request(url_query_cleaner(response.url), 'en', callback=self.parse_project_result,
-                                   cb_kwargs=dict(project_item=project_item, result_item=result_loader.load_item()))
+        return dict(result_loader.load_item())
 
     # Person Stuff
     def load_person(self, response, loader):
@@ -1,22 +1,44 @@
 import math
+
+from scrapy.utils.defer import maybe_deferred_to_future
+
 from .base import BaseSpider
+from ..database import hash_item
 from ..gepris_helper import search_results_request
 from ..items import SearchResultLoader
+from ..normalisation.canonicalisation import canonicalise
+
+# the data_monitor stats with the number of items of a context,
+# only the one of projekt matches the search results (not all persons and institutions can be found there)
+DATA_MONITOR_COUNT_STATS = {'projekt': 'project_count'}
 
 
 class SearchResultsSpider(BaseSpider):
     name = 'search_results'
     allowed_domains = ['gepris.dfg.de']
-    # 2 Concurrent Request is fast enough, if we use a lot of items per page
+    # the pages with a lot of items are slow, the AdaptiveConcurrency extension goes up to 4 concurrent requests
     custom_settings = dict(
-        CONCURRENT_REQUESTS=2,
+        CONCURRENT_REQUESTS=4,
+        ADAPTIVE_CONCURRENCY_START=2,
     )
     items_per_page = 1000
     total_items = math.inf
 
-    def __init__(self, context, items=1000, *args, **kwargs):
-        super(SearchResultsSpider, self).__init__(context, *args, **kwargs)
+    def __init__(self, context, items=1000, resume=None, mode='full', *args, **kwargs):
+        super(SearchResultsSpider, self).__init__(context, *args, resume=resume, **kwargs)
         self.items_per_page = int(items)
+        if mode not in ['full', 'delta']:
+            raise ValueError(f'Mode must be either "full" or "delta", but was "{mode}"')
+        # a delta run fetches the pages one after another, from the last one (with the newest items) backwards,
+        # and stops after some pages without changes (see `next_delta_request`),
+        # it needs the stored items to compare them and can not take over the pages of a resumed run
+        self.delta = mode == 'delta'
+        if self.delta and (self.db is None or self.resumed_run is not None):
+            raise ValueError('A delta run requires the database and can not resume another run')
+        # the number of pages in a row without changes
+        self.unchanged_pages = 0
+        # the number of items on the pages requested by a delta run
+        self.requested_items_count = 0
         if self.context == 'person':
             self.context_load_function = self.load_person
         elif context == 'institution':
@@ -24,17 +46,56 @@ class SearchResultsSpider(BaseSpider):
         elif context == 'projekt':
             self.context_load_function = self.load_project
         self.seen_ids = set()
+        # the start index of the page of each id, it is staged together with the item
+        self.item_pages = {}
+        # the start indexes of the pages, that were completed by the resumed run (read by `prepare_run`)
+        self.completed_pages = set()
+
+    async def start(self):
+        """
+        The resumed run and the counts of the delta mode are read in the writer thread of the database buffer,
+        so the queries do not block the reactor
+        """
+        await maybe_deferred_to_future(self.call_db(self.prepare_run))
+        for request in self._requests():
+            yield request
 
     def start_requests(self):
+        # only used by scrapy versions without `start`, they read from the database in the reactor thread
+        self.prepare_run()
+        return self._requests()
+
+    def prepare_run(self):
+        """
+        Takes over the completed pages of the resumed run and checks if a delta run can be done
+        """
+        if self.resumed_run is not None and self.db is not None:
+            self.completed_pages, total_items = self.db.resume_search_results(self)
+            if total_items is not None:
+                self.total_items = total_items
+        if self.delta and not self.counts_agree():
+            self.delta = False
+
+    def _requests(self):
+        self.crawler.stats.set_value('search_results/mode', 'delta' if self.delta else 'full')
+        if self.delta:
+            # the next page is only requested, once this one was compared with the stored items
+            yield search_results_request(self.context, self.items_per_page, 0, self.items_per_page,
+                                         callback=self.parse_delta)
+            return
         current_index = 0
         while current_index < self.total_items:
             items_on_this_page = min(self.items_per_page, self.total_items - current_index)
-            self.logger.info(
-                f'Starting Request for items {current_index} to {current_index + items_on_this_page} of total {self.total_items} items')
-            yield search_results_request(self.context, self.items_per_page, current_index, items_on_this_page)
+            if current_index in self.completed_pages:
+                self.logger.info(
+                    f'Skipping items {current_index} to {current_index + items_on_this_page}, the resumed run completed them')
+            else:
+                self.logger.info(
+                    f'Starting Request for items {current_index} to {current_index + items_on_this_page} of total {self.total_items} items')
+                yield search_results_request(self.context, self.items_per_page, current_index, items_on_this_page)
             current_index += self.items_per_page
 
-    def parse(self, response, items_on_page):
+    def parse(self, response, items_on_page, page_index=None):
         # set total items if not set before
         # TODO: this should be done in a middleware
         # if it is not there the first time, stop the spider
@@ -42,9 +103,14 @@ class SearchResultsSpider(BaseSpider):
             self.set_total_items(response)
             if self.had_error:
                 return
+            if self.delta:
+                # the first page was requested before the number of items was known
+                self.requested_items_count = min(self.items_per_page, self.total_items)
         results_on_page = response.xpath('//*[@id="liste"]/div[@class!="pagination"]')
         # iterate over all results on page
         loaded_items = 0
+        page_ids = set()
+        page_items = []
         for result in results_on_page:
             result_link = result.xpath('.//h2/a')
             if result_link.attrib['href'] == f"/gepris/{self.context}/null":
@@ -61,10 +127,89 @@ class SearchResultsSpider(BaseSpider):
                         self.logger.warning(f'Found ID {item_id} second time on page: {response.url}')
                     else:
                         self.seen_ids.add(item_id)
+                    page_ids.add(item_id)
+                    self.item_pages[item_id] = page_index
+                    page_items.append(item)
                     yield item
         if loaded_items != items_on_page:
             self.logger.warning(
                 f'Expected {items_on_page} items on page but loaded {loaded_items} on url {response.url}')
+        if page_index is not None and self.db_buffer is not None:
+            # a resumed run can skip the page, once all its items are staged
+            self.db_buffer.add_page_checkpoint(page_index, len(page_ids), self.total_items)
+
+    async def parse_delta(self, response, items_on_page, page_index=None):
+        """
+        Parses a page of a delta run and requests the next page, once the items are compared with the stored ones
+        """
+        items = []
+        for item in self.parse(response, items_on_page, page_index):
+            items.append(item)
+            yield item
+        if page_index is not None and self.total_items > 0:
+            for request in await maybe_deferred_to_future(self.next_delta_request(page_index, items)):
+                yield request
+
+    def counts_agree(self):
+        """
+        Items that disappeared from the search results are only found by a full run,
+        so delta runs are only done while the data_monitor counts as many items as there are stored
+        @return: False if the latest data_monitor run counted another number of items
+        """
+        stat = DATA_MONITOR_COUNT_STATS.get(self.context)
+        expected_items = self.db.get_latest_dm_stat(stat) if stat is not None else None
+        if expected_items is None:
+            return True
+        stored_items = self.db.count_available_items(self.context)
+        if expected_items != stored_items:
+            self.logger.info(f'The data_monitor counts {expected_items} items, but there are {stored_items} stored,'
+                             f' doing a full run instead of a delta run')
+            return False
+        return True
+
+    def next_delta_request(self, page_index, items):
+        """
+        Compares the items of the page with the stored ones and requests the next page of the delta run.
+        Gepris can not sort the search results by their last change, they are ordered by id (see
+        test_search_results_order), so the new and the running projekte are on the last pages.
+        After the first page, which tells the number of items, the pages are requested from the last one backwards,
+        until SEARCH_RESULTS_DELTA_UNCHANGED_PAGES pages in a row did not change.
+        The stored items are read in the writer thread of the database buffer.
+        @param page_index: The start index of the page
+        @param items: The items of the page
+        @return: Deferred that fires with a list with the request of the next page, if there is one
+        """
+        d = self.call_db(self.db.get_available_item_hashes, self.context, [item['id'] for item in items])
+        d.addCallback(self._next_delta_requests, page_index, items)
+        return d
+
+    def _next_delta_requests(self, stored_hashes, page_index, items):
+        # the stored hashes are the ones of the canonical items, see the CanonicalisationPipeline
+        changed_items = sum(1 for item in items if stored_hashes.get(item['id']) != hash_item(canonicalise(item)))
+        if changed_items == 0:
+            self.crawler.stats.inc_value('delta/unchanged_pages')
+        else:
+            self.crawler.stats.inc_value('delta/changed_pages')
+            self.crawler.stats.inc_value('delta/changed_items', changed_items)
+        if page_index == 0:
+            # the first page has the oldest items, it does not count for the end of the run
+            next_index = (max(self.total_items, 1) - 1) // self.items_per_page * self.items_per_page
+        else:
+            self.unchanged_pages = self.unchanged_pages + 1 if changed_items == 0 else 0
+            next_index = page_index - self.items_per_page
+        if self.unchanged_pages >= self.settings.getint('SEARCH_RESULTS_DELTA_UNCHANGED_PAGES', 2):
+            self.logger.info(f'Stopping the delta run at item {page_index} of total {self.total_items} items,'
+                             f' the last {self.unchanged_pages} pages did not change')
+            self.crawler.stats.set_value('delta/stopped_at_index', page_index)
+            return []
+        if next_index > 0:
+            items_on_page = min(self.items_per_page, self.total_items - next_index)
+            self.requested_items_count += items_on_page
+            self.logger.info(f'Starting Request for items {next_index} to {next_index + items_on_page}'
+                             f' of total {self.total_items} items')
+            return [search_results_request(self.context, self.items_per_page, next_index, items_on_page,
+                                           callback=self.parse_delta)]
+        return []
 
     def set_total_items(self, response):
         self.logger.info('Trying to find total items')
@@ -47,7 +47,9 @@ def get_settings(database=False, mail=False):
 def get_test_database(settings):
     db = PostgresDatabase(settings)
     db.open()
-    db.execute_sql('TRUNCATE spider_runs, data_monitor, projekte, personen, institutionen CASCADE')
+    db.execute_sql('TRUNCATE spider_runs, data_monitor, projekte, personen, institutionen, '
+                   'latest_person_projekt_references, latest_institution_projekt_references, '
+                   'latest_person_gender_references CASCADE')
     db.execute_sql('ALTER SEQUENCE spider_runs_id RESTART')
     return db
 
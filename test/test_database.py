@@ -1,12 +1,22 @@
+import gzip
+import os
+import tempfile
 from unittest import TestCase
 from unittest.mock import Mock
 from pypika import Query, Table
+import psycopg2
 from psycopg2.extras import Json
-from datetime import datetime
+from datetime import datetime, timedelta
 
+from gepris_crawler.commands.collapse_history import Command as CollapseHistoryCommand
+from gepris_crawler.database import PostgresDatabase, hash_item
 from gepris_crawler.items import SearchResultItem, ProjectItem
 from test.resources import get_settings, get_test_database, get_sample_dm_item
 
+# the columns of available_items that are set by the crawler
+AVAILABLE_ITEMS_COLUMNS = ['id', 'context', 'last_available_seen', 'last_available_change', 'last_available_item',
+                           'last_detail_check', 'detail_check_needed']
+
 
 class DatabaseTest(TestCase):
 
@@ -17,6 +27,46 @@ class DatabaseTest(TestCase):
     def tearDown(self):
         self.db.close()
 
+    def terminate_other_connections(self):
+        db = PostgresDatabase(self.settings)
+        db.open()
+        db.execute_sql('SELECT pg_terminate_backend(pid) FROM pg_stat_activity'
+                       ' WHERE datname = current_database() AND pid != pg_backend_pid()')
+        db.close()
+
+    def test_idempotent_statement_is_retried(self):
+        # setup
+        self.db.execute_sql('SELECT 1')
+        self.terminate_other_connections()
+        # test
+        result = self.db.execute_sql('SELECT 1', fetch=True, idempotent=True)
+        # assertion
+        self.assertListEqual([(1,)], result)
+
+    def test_statement_is_not_retried(self):
+        # setup
+        self.db.execute_sql('SELECT 1')
+        self.terminate_other_connections()
+        # test and assertion
+        self.assertRaises(psycopg2.OperationalError, self.db.execute_sql, 'SELECT 1')
+        self.assertListEqual([(1,)], self.db.execute_sql('SELECT 1', fetch=True))
+
+    def test_health_check_replaces_broken_connection(self):
+        # setup
+        self.db.health_check_after = 0
+        self.db.execute_sql('SELECT 1')
+        self.terminate_other_connections()
+        # test
+        result = self.db.execute_sql('SELECT 1', fetch=True)
+        # assertion
+        self.assertListEqual([(1,)], result)
+
+    def test_pool_size_with_async_writes(self):
+        settings = self.settings.copy()
+        settings.set('DATABASE_ASYNC_WRITES', True)
+        settings.set('DATABASE_POOL_SIZE', 1)
+        self.assertRaises(ValueError, PostgresDatabase, settings)
+
     def test_get_ids(self):
         self.db.execute_sql(Query.into('spider_runs')
                             .insert(1, 'search_results', 'projekt', datetime.now(), datetime.now(), 4)
@@ -54,39 +104,310 @@ class DatabaseTest(TestCase):
         item = SearchResultItem(id=1, name_de='p1')
 
         self.db.upsert_available_item(1, item, spider)
-        results = self.db.execute_sql(Query.from_(items).select(items.star).get_sql(), fetch=True)
+        results = self.db.execute_sql(Query.from_(items).select(*AVAILABLE_ITEMS_COLUMNS).get_sql(), fetch=True)
         self.assertListEqual(results, [(1, 'projekt', 1, 1, dict(item), None, True)])
 
         spider.run_id = 2
         self.db.upsert_available_item(1, item, spider)
-        results = self.db.execute_sql(Query.from_(items).select(items.star).get_sql(), fetch=True)
+        results = self.db.execute_sql(Query.from_(items).select(*AVAILABLE_ITEMS_COLUMNS).get_sql(), fetch=True)
         self.assertListEqual(results, [(1, 'projekt', 2, 1, dict(item), None, True)])
 
         spider.run_id = 3
         item['name_de'] = 'p3'
         self.db.upsert_available_item(1, item, spider)
-        results = self.db.execute_sql(Query.from_(items).select(items.star).get_sql(), fetch=True)
+        results = self.db.execute_sql(Query.from_(items).select(*AVAILABLE_ITEMS_COLUMNS).get_sql(), fetch=True)
         self.assertListEqual(results, [(1, 'projekt', 3, 3, dict(item), None, True)])
 
         spider.run_id = 4
         spider.name = 'details'
         detail_item = ProjectItem(id=1, name_de='details_p1')
         self.db.upsert_available_item(1, detail_item, spider)
-        results = self.db.execute_sql(Query.from_(items).select(items.star).get_sql(), fetch=True)
+        results = self.db.execute_sql(Query.from_(items).select(*AVAILABLE_ITEMS_COLUMNS).get_sql(), fetch=True)
         self.assertListEqual(results, [(1, 'projekt', 3, 3, dict(item), 4, False)])
 
         detail_item['id'] = 2
         self.db.upsert_available_item(2, detail_item, spider)
-        results = self.db.execute_sql(Query.from_(items).select(items.star).where(items.id.eq(2)).get_sql(), fetch=True)
+        results = self.db.execute_sql(Query.from_(items).select(*AVAILABLE_ITEMS_COLUMNS).where(items.id.eq(2)).get_sql(), fetch=True)
         self.assertListEqual(results, [(2, 'projekt', None, None, None, 4, False)])
 
         spider.run_id = 5
         spider.name = 'search_results'
         item['id'] = 2
         self.db.upsert_available_item(2, item, spider)
-        results = self.db.execute_sql(Query.from_(items).select(items.star).where(items.id.eq(2)).get_sql(), fetch=True)
+        results = self.db.execute_sql(Query.from_(items).select(*AVAILABLE_ITEMS_COLUMNS).where(items.id.eq(2)).get_sql(), fetch=True)
         self.assertListEqual(results, [(2, 'projekt', 5, 5, dict(item), 4, False)])
 
+    def test_merge_search_results(self):
+        # set up
+        self.db.execute_sql(Query.into('spider_runs')
+                            .insert(1, 'search_results', 'projekt', datetime.now(), datetime.now(), 2)
+                            .insert(2, 'search_results', 'projekt', datetime.now(), datetime.now(), 2)
+                            .get_sql()
+                            )
+        items = Table('available_items')
+        spider = Mock(context='projekt', run_id=1)
+        spider.name = 'search_results'
+        item1 = SearchResultItem(id=1, name_de='p1')
+        item2 = SearchResultItem(id=2, name_de='p2')
+        self.db.stage_search_result_items([(1, item1, 0), (2, item2, 0)], spider)
+        first_counts = self.db.merge_search_results(spider)
+
+        # test
+        spider.run_id = 2
+        changed_item2 = SearchResultItem(id=2, name_de='p2 changed')
+        self.db.stage_search_result_items([(1, item1, 0), (2, item2, 0)], spider)
+        self.db.stage_search_result_items([(2, changed_item2, 0)], spider)
+        staged = self.db.execute_sql('SELECT count(*) FROM search_results_staging', fetch=True)
+        second_counts = self.db.merge_search_results(spider)
+
+        # assertion
+        results = self.db.execute_sql(Query.from_(items).select(*AVAILABLE_ITEMS_COLUMNS, 'last_available_item_hash')
+                                      .orderby(items.id).get_sql(), fetch=True)
+        self.assertEqual((2, 0, 0), first_counts)
+        self.assertListEqual([(3,)], staged)
+        self.assertEqual((0, 1, 0), second_counts)
+        self.assertListEqual(results, [(1, 'projekt', 2, 1, dict(item1), None, True, hash_item(item1)),
+                                       (2, 'projekt', 2, 2, dict(changed_item2), None, True, hash_item(changed_item2))])
+        self.assertListEqual([(0,)], self.db.execute_sql('SELECT count(*) FROM search_results_staging', fetch=True))
+
+    def test_insert_detail_items(self):
+        # set up
+        self.db.execute_sql(Query.into('spider_runs')
+                            .insert(1, 'details', 'projekt', datetime.now(), datetime.now(), 3)
+                            .insert(2, 'details', 'projekt', datetime.now(), datetime.now(), 3)
+                            .get_sql()
+                            )
+        spider = Mock(context='projekt', run_id=1)
+        spider.name = 'details'
+        self.db.insert_detail_items([(1, ProjectItem(id=1, name_de='p1'), 'success'),
+                                     (2, ProjectItem(id=2, name_de='p2'), 'success'),
+                                     (3, None, 'error')], spider)
+
+        # test
+        spider.run_id = 2
+        self.db.insert_detail_items([(1, ProjectItem(id=1, name_de='p1'), 'success'),
+                                     (2, ProjectItem(id=2, name_de='p2 changed'), 'success'),
+                                     (3, None, 'moved')], spider)
+
+        # assertions
+        available_items = self.db.execute_sql('SELECT id, last_detail_check, detail_check_needed FROM available_items'
+                                              ' ORDER BY id', fetch=True)
+        self.assertListEqual(available_items, [(1, 2, False), (2, 2, False), (3, 2, False)])
+        history = self.db.execute_sql('SELECT id, created_at, item, status FROM details_items_history'
+                                      ' ORDER BY id, created_at', fetch=True)
+        self.assertListEqual(history, [(1, 1, {'id': 1, 'name_de': 'p1'}, 'success'),
+                                       (2, 1, {'id': 2, 'name_de': 'p2'}, 'success'),
+                                       (2, 2, {'id': 2, 'name_de': 'p2 changed'}, 'success'),
+                                       (3, 1, None, 'error'),
+                                       (3, 2, None, 'moved')])
+
+    def test_statement_stats(self):
+        # set up
+        self.db.execute_sql(Query.into('spider_runs')
+                            .insert(1, 'details', 'projekt', datetime.now(), datetime.now(), 3)
+                            .get_sql()
+                            )
+        spider = Mock(context='projekt', run_id=1)
+        spider.name = 'details'
+
+        # test
+        self.db.insert_detail_items([(1, ProjectItem(id=1, name_de='p1'), 'success')], spider)
+        self.db.insert_detail_items([(2, ProjectItem(id=2, name_de='p2'), 'success')], spider)
+        self.db.update_run_result(1, 2)
+
+        # assertions
+        stats = self.db.get_statement_stats()
+        self.assertCountEqual(['upsert_detail_available_items', 'insert_detail_items', 'update_run_result'],
+                              stats.keys())
+        self.assertEqual(2, stats['insert_detail_items'][0])
+        self.assertEqual(1, stats['update_run_result'][0])
+        history = self.db.execute_sql('SELECT id FROM details_items_history ORDER BY id', fetch=True)
+        self.assertListEqual([(1,), (2,)], history)
+
+    def test_get_latest_item_hashes(self):
+        # set up
+        self.db.execute_sql(Query.into('spider_runs')
+                            .insert(1, 'details', 'projekt', datetime.now(), datetime.now(), 3)
+                            .get_sql()
+                            )
+        spider = Mock(context='projekt', run_id=1)
+        spider.name = 'details'
+        item = ProjectItem(id=1, name_de='p1')
+        self.db.insert_detail_items([(1, item, 'success'), (2, None, 'moved'), (3, item, None)], spider)
+
+        # test
+        hashes = self.db.get_latest_item_hashes('projekt', [1, 2, 3, 4])
+
+        # assertions
+        self.assertDictEqual(hashes, {1: hash_item(item)})
+        self.assertEqual(len(self.db.execute_sql('SELECT * FROM details_items_history', fetch=True)), 2)
+
+    def test_get_page_states(self):
+        # set up
+        self.db.execute_sql(Query.into('spider_runs')
+                            .insert(1, 'details', 'projekt', datetime.now(), datetime.now(), 3)
+                            .insert(2, 'details', 'projekt', datetime.now(), datetime.now(), 3)
+                            .get_sql()
+                            )
+        spider = Mock(context='projekt', run_id=1)
+        spider.name = 'details'
+        self.db.insert_detail_items([(1, ProjectItem(id=1, name_de='p1'), 'success'),
+                                     (2, ProjectItem(id=2, name_de='p2'), 'success'),
+                                     (3, ProjectItem(id=3, name_de='p3'), 'success')], spider,
+                                    [(1, dict(page_hash='page1', etag='"e1"')), (2, dict(page_hash='page2')),
+                                     (3, dict(page_hash='page3', last_modified='Mon, 03 Jan 2022 10:00:00 GMT',
+                                              body_hash='body3'))])
+
+        # test
+        spider.run_id = 2
+        self.db.insert_detail_items([(1, None, None), (2, None, 'moved')], spider,
+                                    [(1, dict(page_hash='page1', etag='"e2"'))])
+        states = self.db.get_page_states('projekt', [1, 2, 3, 4])
+
+        # assertions
+        # the page of a moved item has to be fetched again
+        self.assertDictEqual({1: dict(page_hash='page1', etag='"e2"', last_modified=None, body_hash=None),
+                              3: dict(page_hash='page3', etag=None, last_modified='Mon, 03 Jan 2022 10:00:00 GMT',
+                                      body_hash='body3')}, states)
+        created = self.db.execute_sql('SELECT id, created_at FROM details_page_states ORDER BY id', fetch=True)
+        self.assertListEqual([(1, 2), (2, 1), (3, 1)], created)
+
+    def test_insert_detail_items_with_blobs(self):
+        # set up
+        self.db.execute_sql(Query.into('spider_runs')
+                            .insert(1, 'details', 'projekt', datetime(2022, 1, 1), datetime(2022, 1, 1), 2)
+                            .insert(2, 'details', 'projekt', datetime(2022, 1, 2), datetime(2022, 1, 2), 2)
+                            .get_sql()
+                            )
+        spider = Mock(context='projekt', run_id=1)
+        spider.name = 'details'
+        description = 'Eine lange Projektbeschreibung. ' * 10
+        publications = [{'text': f'Publikation {i}, Journal of Testing', 'links': []} for i in range(5)]
+        item = ProjectItem(id=1, name_de='p1', beschreibung_de=description, beschreibung_en='short',
+                           result={'ergebnis_publikationen': publications})
+        self.db.insert_detail_items([(1, item, 'success')], spider)
+
+        # test
+        spider.run_id = 2
+        changed_item = ProjectItem(id=1, name_de='p1 changed', beschreibung_de=description, beschreibung_en='short',
+                                   result={'ergebnis_publikationen': publications})
+        self.db.insert_detail_item(1, changed_item, spider, 'success')
+        stored_items = self.db.execute_sql('SELECT item FROM details_items_history ORDER BY created_at', fetch=True)
+        blobs_count = self.db.execute_sql('SELECT count(*) FROM item_blobs', fetch=True)
+        latest_items = self.db.execute_sql('SELECT item FROM latest_items', fetch=True)
+        items_as_of_run_1 = self.db.execute_sql('SELECT item FROM detail_items_as_of(1)', fetch=True)
+
+        # assertions
+        self.assertEqual(2, len(stored_items))
+        self.assertIn('$blob', stored_items[1][0]['beschreibung_de'])
+        self.assertEqual('short', stored_items[1][0]['beschreibung_en'])
+        self.assertIn('$blob', stored_items[1][0]['result']['ergebnis_publikationen'])
+        self.assertListEqual([(2,)], blobs_count)
+        self.assertListEqual([(dict(changed_item),)], latest_items)
+        self.assertListEqual([(dict(item),)], items_as_of_run_1)
+        # the stored items are not changed
+        self.assertEqual(description, item['beschreibung_de'])
+
+    def test_iter_ids(self):
+        # set up
+        self.db.execute_sql(Query.into('spider_runs')
+                            .insert(1, 'details', 'projekt', datetime.now(), datetime.now(), 3)
+                            .get_sql()
+                            )
+        self.db.execute_sql(Query.into('available_items')
+                            .insert(3, 'projekt', None, None, None, None, True)
+                            .get_sql()
+                            )
+        spider = Mock(context='projekt', run_id=1)
+        spider.name = 'details'
+        item = ProjectItem(id=1, name_de='p1')
+        self.db.insert_detail_items([(1, item, 'success'), (2, None, 'moved')], spider)
+
+        # test
+        ids = list(self.db.iter_ids('projekt', chunk_size=1))
+
+        # assertions
+        self.assertListEqual(ids, [(3, None), (1, hash_item(item)), (2, None)])
+
+    def test_iter_smart_ids(self):
+        # set up
+        now = datetime.now()
+        self.db.execute_sql(Query.into('spider_runs')
+                            .insert(1, 'details', 'projekt', now - timedelta(days=60), now - timedelta(days=60), 4)
+                            .insert(2, 'details', 'projekt', now - timedelta(days=30), now - timedelta(days=30), 4)
+                            .insert(3, 'details', 'projekt', now - timedelta(days=10), now - timedelta(days=10), 3)
+                            .get_sql()
+                            )
+        spider = Mock(context='projekt', run_id=1)
+        spider.name = 'details'
+        finished = ProjectItem(id=3, name_de='p3', attributes={'foerderung_ende': 2010})
+        self.db.insert_detail_items([(1, ProjectItem(id=1, name_de='p1'), 'success'),
+                                     (2, ProjectItem(id=2, name_de='p2'), 'success'),
+                                     (3, finished, 'success'),
+                                     (4, ProjectItem(id=4, name_de='p4'), 'success')], spider)
+        spider.run_id = 2
+        self.db.insert_detail_items([(1, ProjectItem(id=1, name_de='p1 changed'), 'success'),
+                                     (2, ProjectItem(id=2, name_de='p2'), 'success'),
+                                     (3, finished, 'success'),
+                                     (4, ProjectItem(id=4, name_de='p4'), 'success')], spider)
+        spider.run_id = 3
+        self.db.insert_detail_items([(1, ProjectItem(id=1, name_de='p1 changed again'), 'success'),
+                                     (2, ProjectItem(id=2, name_de='p2'), 'success'),
+                                     (3, finished, 'success')], spider)
+        self.db.execute_sql(Query.into('available_items')
+                            .columns('id', 'context', 'detail_check_needed')
+                            .insert(5, 'projekt', True)
+                            .get_sql()
+                            )
+
+        # test
+        smart_ids = list(self.db.iter_smart_ids('projekt', limit=4, chunk_size=2))
+        versions = self.db.execute_sql("SELECT id, detail_versions FROM available_items ORDER BY id", fetch=True)
+
+        # assertions
+        # 5 was never checked, 4 was not checked for the longest time, 1 changes more often than 2,
+        # 3 has ended and there are no changes of ended projekte
+        self.assertListEqual([5, 4, 1, 2], [item_id for item_id, _, _ in smart_ids])
+        self.assertEqual(1, smart_ids[0][2])
+        self.assertIsNone(smart_ids[0][1])
+        self.assertEqual(hash_item(ProjectItem(id=4, name_de='p4')), smart_ids[1][1])
+        self.assertTrue(0 < smart_ids[3][2] < smart_ids[2][2] < smart_ids[1][2] < 1)
+        self.assertListEqual([(1, 3), (2, 1), (3, 1), (4, 1), (5, 0)], versions)
+
+    def test_lease_ids(self):
+        # set up
+        self.db.execute_sql(Query.into('spider_runs')
+                            .insert(1, 'details', 'projekt', datetime.now(), None, None)
+                            .insert(2, 'details', 'projekt', datetime.now(), None, None)
+                            .get_sql()
+                            )
+        self.db.execute_sql(Query.into('available_items')
+                            .insert(1, 'projekt', None, None, None, None, True)
+                            .insert(2, 'projekt', None, None, None, None, True)
+                            .insert(3, 'projekt', None, None, None, None, True)
+                            .get_sql()
+                            )
+        first_run = Mock(context='projekt', run_id=1)
+        first_run.name = 'details'
+        second_run = Mock(context='projekt', run_id=2)
+        second_run.name = 'details'
+
+        # test
+        first_leased = self.db.lease_ids(first_run, only_needed=True, limit=2)
+        second_leased = self.db.lease_ids(second_run, only_needed=True, limit=5)
+        # writing the item ends the lease
+        self.db.insert_detail_items([(1, ProjectItem(id=1, name_de='p1'), 'success')], first_run)
+        first_leased_again = self.db.lease_ids(first_run, only_needed=False, limit=5)
+        self.db.release_leases(first_run)
+        second_leased_again = self.db.lease_ids(second_run, only_needed=True, limit=5)
+
+        # assertions
+        self.assertListEqual([(1, None), (2, None)], first_leased)
+        self.assertListEqual([(3, None)], second_leased)
+        # 1 was already checked since the first run started, 2 and 3 are still leased
+        self.assertListEqual([], first_leased_again)
+        self.assertListEqual([(2, None)], second_leased_again)
+
     def test_create_personen_references_from_details_run(self):
         # set up
         self.db.execute_sql(Query.into('spider_runs')
@@ -110,20 +431,20 @@ class DatabaseTest(TestCase):
         # assertion
         available_items = Table('available_items')
         created_person = self.db.execute_sql(Query.from_(available_items)
-                                             .select(available_items.star)
+                                             .select(*AVAILABLE_ITEMS_COLUMNS)
                                              .where(available_items.id.eq(200))
                                              .get_sql(),
                                              fetch=True)
         self.assertEqual([(200, 'person', None, None, None, None, True)], created_person)
 
         not_created_person = self.db.execute_sql(Query.from_(available_items)
-                                                 .select(available_items.star)
+                                                 .select(*AVAILABLE_ITEMS_COLUMNS)
                                                  .where(available_items.id.eq(201))
                                                  .get_sql(),
                                                  fetch=True)
         self.assertEqual([(201, 'person', 2, 2, {'id': 201, 'name_de': 'test'}, None, True)], not_created_person)
 
-    def test_mark_not_found_available_items(self):
+    def test_merge_search_results_disappeared(self):
         # set up
         self.db.execute_sql(Query.into('spider_runs')
                             .insert(1, 'search_results', 'projekt', datetime.now(), datetime.now(), 1)
@@ -136,13 +457,90 @@ class DatabaseTest(TestCase):
         spider.run_id = 1
         spider.name = 'search_results'
         item = SearchResultItem(id=1, name_de='p1')
-        self.db.upsert_available_item(1, item, spider)
+        # stored without hash, like the items from before the staging table
+        self.db.execute_sql(Query.into(items)
+                            .insert(1, 'projekt', 1, 1, Json(dict(item)), None, False)
+                            .insert(2, 'projekt', None, None, None, None, True)
+                            .get_sql()
+                            )
 
         # test
         spider.run_id = 2
-        self.db.mark_not_found_available_items(spider)
-        results = self.db.execute_sql(Query.from_(items).select(items.star).get_sql(), fetch=True)
-        self.assertListEqual(results, [(1, 'projekt', 1, 2, None, None, True)])
+        counts = self.db.merge_search_results(spider)
+        results = self.db.execute_sql(Query.from_(items).select(*AVAILABLE_ITEMS_COLUMNS).orderby(items.id).get_sql(),
+                                      fetch=True)
+
+        # assertion
+        self.assertEqual((0, 0, 1), counts)
+        self.assertListEqual(results, [(1, 'projekt', 1, 2, None, None, True),
+                                       (2, 'projekt', None, None, None, None, True)])
+
+    def test_merge_search_results_delta(self):
+        # set up
+        self.db.execute_sql(Query.into('spider_runs')
+                            .insert(1, 'search_results', 'projekt', datetime.now(), datetime.now(), 2)
+                            .insert(2, 'search_results', 'projekt', datetime.now(), datetime.now(), 1)
+                            .get_sql()
+                            )
+        spider = Mock(context='projekt', run_id=1)
+        spider.name = 'search_results'
+        item1 = SearchResultItem(id=1, name_de='p1')
+        self.db.stage_search_result_items([(1, item1, 0), (2, SearchResultItem(id=2, name_de='p2'), 0)], spider)
+        self.db.merge_search_results(spider)
+
+        # test
+        # the delta run stopped before the page with the item 2
+        spider.run_id = 2
+        self.db.stage_search_result_items([(1, item1, 0)], spider)
+        counts = self.db.merge_search_results(spider, mark_disappeared=False)
+
+        # assertions
+        self.assertEqual((0, 0, 0), counts)
+        self.assertEqual(2, self.db.count_available_items('projekt'))
+        self.assertDictEqual({1: hash_item(item1)}, self.db.get_available_item_hashes('projekt', [1, 3]))
+
+    def test_resume_search_results(self):
+        # set up
+        resumed_run = self.db.store_run('search_results', 'projekt')
+        spider = Mock(context='projekt', run_id=resumed_run)
+        spider.name = 'search_results'
+        # the second page is not complete, one of its items was not staged
+        self.db.stage_search_result_items([(1, SearchResultItem(id=1, name_de='p1'), 0),
+                                           (2, SearchResultItem(id=2, name_de='p2'), 0),
+                                           (3, SearchResultItem(id=3, name_de='p3'), 2)],
+                                          spider, [(0, 2, 4), (2, 2, 4)])
+        run_id = self.db.store_run('search_results', 'projekt', resumed_run=resumed_run)
+        spider = Mock(context='projekt', run_id=run_id, resumed_run=resumed_run)
+        spider.name = 'search_results'
+
+        # test
+        completed_pages, total_items = self.db.resume_search_results(spider)
+
+        # assertions
+        self.assertSetEqual({0}, completed_pages)
+        self.assertEqual(4, total_items)
+        staged = self.db.execute_sql('SELECT run_id, id FROM search_results_staging ORDER BY id', fetch=True)
+        self.assertListEqual([(run_id, 1), (run_id, 2)], staged)
+        checkpoints = self.db.execute_sql('SELECT run_id, page_index FROM search_results_checkpoints', fetch=True)
+        self.assertListEqual([(run_id, 0)], checkpoints)
+
+    def test_get_completed_detail_ids(self):
+        # set up
+        first_run = self.db.store_run('details', 'projekt')
+        spider = Mock(context='projekt', run_id=first_run)
+        spider.name = 'details'
+        self.db.insert_detail_items([(1, ProjectItem(id=1, name_de='p1'), 'success'), (2, None, 'error')], spider)
+        spider.run_id = self.db.store_run('details', 'projekt', resumed_run=first_run)
+        self.db.insert_detail_items([(3, ProjectItem(id=3, name_de='p3'), 'success')], spider)
+        spider.run_id = self.db.store_run('details', 'projekt', resumed_run=spider.run_id)
+
+        # test
+        completed_ids = self.db.get_completed_detail_ids(spider)
+
+        # assertions
+        self.assertSetEqual({1, 2, 3}, completed_ids)
+        # only runs of the same spider and context can be resumed
+        self.assertRaises(ValueError, self.db.store_run, 'details', 'person', resumed_run=first_run)
 
     def test_mark_detail_check_needed_on_projekts_for_moved_person_institution(self):
         # set up
@@ -244,6 +642,128 @@ class DatabaseTest(TestCase):
                                                                 fetch=True)[0][0]
         self.assertFalse(i101_available_items_detail_check)
 
+    def test_collapse_history_versions(self):
+        # setup
+        self.db.execute_sql(Query.into('spider_runs')
+                            .insert(1, 'details', 'projekt', datetime(2022, 1, 1), datetime(2022, 1, 1), 1)
+                            .insert(2, 'details', 'projekt', datetime(2022, 1, 2), datetime(2022, 1, 2), 1)
+                            .insert(3, 'details', 'projekt', datetime(2022, 1, 3), datetime(2022, 1, 3), 1)
+                            .insert(4, 'details', 'projekt', datetime(2022, 1, 4), datetime(2022, 1, 4), 1)
+                            .get_sql()
+                            )
+        self.db.execute_sql(Query.into('available_items')
+                            .insert(1, 'projekt', None, None, None, 4, False)
+                            .get_sql()
+                            )
+        self.db.execute_sql(Query.into('details_items_history')
+                            .insert(1, 'projekt', 1, Json({'attributes': {'male_personen': [2, 1]}}), 'success')
+                            .insert(1, 'projekt', 2, Json({'attributes': {'male_personen': [1, 2]}}), 'success')
+                            .insert(1, 'projekt', 3, Json({'attributes': {'male_personen': [1, 3]}}), 'success')
+                            .insert(1, 'projekt', 4, Json({'attributes': {'male_personen': [3, 1]}}), 'success')
+                            .get_sql()
+                            )
+
+        # test
+        counts = CollapseHistoryCommand.collapse(self.db, 'projekt', 1)
+        versions = self.db.execute_sql('SELECT created_at, item, item_hash FROM details_items_history'
+                                       ' ORDER BY created_at', fetch=True)
+        latest = self.db.execute_sql('SELECT created_at FROM latest_detail_items', fetch=True)
+
+        # assertions
+        self.assertEqual((2, 2), counts)
+        self.assertListEqual([(1, {'attributes': {'male_personen': [1, 2]}},
+                               hash_item({'attributes': {'male_personen': [1, 2]}})),
+                              (3, {'attributes': {'male_personen': [1, 3]}},
+                               hash_item({'attributes': {'male_personen': [1, 3]}}))], versions)
+        self.assertListEqual([(3,)], latest)
+
+    def test_iter_history_versions(self):
+        # setup
+        self.db.execute_sql(Query.into('spider_runs')
+                            .insert(1, 'details', 'projekt', datetime(2022, 1, 2), datetime(2022, 1, 2), 1)
+                            .insert(2, 'details', 'projekt', datetime(2022, 1, 1), datetime(2022, 1, 1), 1)
+                            .get_sql()
+                            )
+        self.db.execute_sql(Query.into('available_items')
+                            .insert(1, 'projekt', None, None, None, 1, False)
+                            .insert(2, 'projekt', None, None, None, 1, False)
+                            .insert(3, 'projekt', None, None, None, 1, False)
+                            .get_sql()
+                            )
+        self.db.execute_sql(Query.into('details_items_history')
+                            .insert(1, 'projekt', 1, Json({'name_de': 'p1 v1'}), 'success')
+                            .insert(1, 'projekt', 2, Json({'name_de': 'p1 v2'}), 'success')
+                            .insert(2, 'projekt', 1, None, 'error')
+                            .insert(3, 'projekt', 2, Json({'name_de': 'p3 v2'}), 'success')
+                            .get_sql()
+                            )
+
+        # test
+        # each chunk has the versions of one id
+        versions = list(self.db.iter_history_versions('projekt', chunk_size=1))
+
+        # assertions
+        # the versions of an id are ordered by the start of their run, not by the run id
+        self.assertListEqual([(1, 2, {'name_de': 'p1 v2'}, 'success', None),
+                              (1, 1, {'name_de': 'p1 v1'}, 'success', None),
+                              (2, 1, None, 'error', None),
+                              (3, 2, {'name_de': 'p3 v2'}, 'success', None)], versions)
+
+    def test_archive_history_partition(self):
+        # setup
+        self.db.execute_sql(Query.into('spider_runs')
+                            .insert(1, 'details', 'projekt', datetime(2022, 1, 1), datetime(2022, 1, 1), 1)
+                            .insert(1000, 'details', 'projekt', datetime(2022, 1, 2), datetime(2022, 1, 2), 1)
+                            .get_sql()
+                            )
+        self.db.execute_sql(Query.into('available_items')
+                            .insert(1, 'projekt', None, None, None, 1000, False)
+                            .get_sql()
+                            )
+        self.db.execute_sql(Query.into('details_items_history')
+                            .insert(1, 'projekt', 1, Json({'name_de': 'v1'}), 'success')
+                            .insert(1, 'projekt', 1000, Json({'name_de': 'v1000'}), 'success')
+                            .get_sql()
+                            )
+
+        # test
+        archivable = self.db.get_archivable_history_partitions(1)
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'details_items_history_projekt_0.csv.gz')
+            self.db.archive_history_partition('details_items_history_projekt_0', path)
+            with gzip.open(path, 'rt') as f:
+                archive_lines = f.read().splitlines()
+        archivable_after_archive = self.db.get_archivable_history_partitions(1)
+        history = self.db.execute_sql('SELECT id, created_at FROM details_items_history', fetch=True)
+
+        # assertions
+        self.assertListEqual(['details_items_history_institution_0',
+                              'details_items_history_person_0',
+                              'details_items_history_projekt_0'], archivable)
+        self.assertEqual('id,context,created_at,item,status,item_hash', archive_lines[0])
+        self.assertEqual(2, len(archive_lines))
+        self.assertTrue(archive_lines[1].startswith('1,projekt,1,'))
+        self.assertListEqual(['details_items_history_institution_0',
+                              'details_items_history_person_0'], archivable_after_archive)
+        self.assertListEqual([(1, 1000)], history)
+
+    def test_archive_history_partition_failed(self):
+        # test
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'details_items_history_projekt_0.csv.gz')
+            with open(path, 'w') as f:
+                f.write('older archive')
+            with self.assertRaises(psycopg2.Error):
+                self.db.archive_history_partition('details_items_history_unknown_0', path)
+            with open(path) as f:
+                archive = f.read()
+            files = os.listdir(directory)
+
+        # assertions
+        # the existing file is kept and the temporary file is removed
+        self.assertEqual('older archive', archive)
+        self.assertListEqual(['details_items_history_projekt_0.csv.gz'], files)
+
     def test_insert_data_monitor_run(self):
         dm = Table('data_monitor')
         spider = Mock()
@@ -0,0 +1,134 @@
+from unittest import TestCase
+from unittest.mock import Mock
+
+from twisted.internet.task import Clock
+
+from gepris_crawler.database import hash_item
+from gepris_crawler.database_buffer import DatabaseWriteBuffer, DatabaseWriterThread
+from gepris_crawler.items import SearchResultItem, ProjectItem
+
+
+class DatabaseWriteBufferTest(TestCase):
+
+    def mock_spider(self, name):
+        spider = Mock(context='projekt', run_id=1)
+        spider.name = name
+        return spider
+
+    def test_flush_on_batch_size(self):
+        # setup
+        db = Mock()
+        spider = self.mock_spider('search_results')
+        buffer = DatabaseWriteBuffer(db, spider, batch_size=2, flush_interval=3600)
+        item1 = SearchResultItem(id=1, name_de='p1')
+        item2 = SearchResultItem(id=2, name_de='p2')
+        # test
+        buffer.add_search_result_item(item1, 0)
+        buffer.add_page_checkpoint(0, 1, 2)
+        db.stage_search_result_items.assert_not_called()
+        buffer.add_search_result_item(item2, 1)
+        # assertion
+        db.stage_search_result_items.assert_called_once_with([(1, item1, 0), (2, item2, 1)], spider, [(0, 1, 2)])
+
+    def test_flush_on_interval(self):
+        # setup
+        db = Mock()
+        spider = self.mock_spider('details')
+        buffer = DatabaseWriteBuffer(db, spider, batch_size=100, flush_interval=0)
+        item = ProjectItem(id=1, name_de='p1')
+        # test
+        buffer.add_detail_item(1, item, 'success')
+        # assertion
+        db.insert_detail_items.assert_called_once_with([(1, item, 'success')], spider, [])
+
+    def test_flush_without_new_items(self):
+        # setup
+        db = Mock()
+        spider = self.mock_spider('details')
+        buffer = DatabaseWriteBuffer(db, spider, batch_size=100, flush_interval=10)
+        clock = Clock()
+        buffer.flush_loop.clock = clock
+        item = ProjectItem(id=1, name_de='p1')
+        # test
+        buffer.add_detail_item(1, item, 'success')
+        clock.advance(5)
+        not_due = db.insert_detail_items.call_count
+        buffer.last_flush -= 10
+        clock.advance(5)
+        buffer.close()
+        # assertion
+        # the partial batch is written although no further item arrived
+        self.assertEqual(0, not_due)
+        db.insert_detail_items.assert_called_once_with([(1, item, 'success')], spider, [])
+        self.assertFalse(buffer.flush_loop.running)
+
+    def test_same_id_is_written_once(self):
+        # setup
+        db = Mock()
+        spider = self.mock_spider('details')
+        buffer = DatabaseWriteBuffer(db, spider, batch_size=100, flush_interval=3600)
+        # test
+        buffer.add_detail_item(1, None, 'error')
+        buffer.add_detail_item(1, None, 'moved')
+        buffer.flush()
+        buffer.flush()
+        # assertion
+        db.insert_detail_items.assert_called_once_with([(1, None, 'moved')], spider, [])
+
+    def test_unchanged_item_is_only_checked(self):
+        # setup
+        db = Mock()
+        spider = self.mock_spider('details')
+        buffer = DatabaseWriteBuffer(db, spider, batch_size=100, flush_interval=3600)
+        unchanged_item = ProjectItem(id=1, name_de='p1')
+        changed_item = ProjectItem(id=2, name_de='p2 changed')
+        buffer.known_hashes = {1: hash_item(ProjectItem(id=1, name_de='p1')),
+                               2: hash_item(ProjectItem(id=2, name_de='p2'))}
+        # test
+        buffer.add_detail_item(1, unchanged_item, 'success')
+        buffer.add_detail_item(2, changed_item, 'success')
+        buffer.flush()
+        # assertion
+        db.insert_detail_items.assert_called_once_with([(1, None, None), (2, changed_item, 'success')], spider, [])
+        spider.crawler.stats.inc_value.assert_called_once_with('database/unchanged_items_skipped')
+
+    def test_unchanged_page_is_only_checked(self):
+        # setup
+        db = Mock()
+        spider = self.mock_spider('details')
+        buffer = DatabaseWriteBuffer(db, spider, batch_size=100, flush_interval=3600)
+        item = ProjectItem(id=2, name_de='p2')
+        # test
+        buffer.add_unchanged_detail_item(1)
+        buffer.add_detail_item(2, item, 'success', dict(page_hash='page2'))
+        buffer.flush()
+        buffer.flush()
+        # assertion
+        db.insert_detail_items.assert_called_once_with([(1, None, None), (2, item, 'success')], spider,
+                                                       [(2, dict(page_hash='page2'))])
+
+    def test_wrong_status(self):
+        buffer = DatabaseWriteBuffer(Mock(), self.mock_spider('details'))
+        self.assertRaises(AttributeError, buffer.add_detail_item, 1, None, 'unknown')
+
+    def test_failed_write_sets_error(self):
+        # setup
+        db = Mock()
+        db.insert_detail_items.side_effect = Exception('connection lost')
+        spider = self.mock_spider('details')
+        spider.had_error = False
+        buffer = DatabaseWriteBuffer(db, spider, batch_size=1)
+        # test
+        buffer.add_detail_item(1, None, 'error')
+        # assertion
+        self.assertTrue(spider.had_error)
+        self.assertEqual(1, buffer.failed_batches)
+
+    def test_close_without_writes(self):
+        # setup
+        buffer = DatabaseWriteBuffer(Mock(), self.mock_spider('details'), writer=DatabaseWriterThread())
+        # test
+        d = buffer.close()
+        # assertion
+        # the writer thread was never started, so there is nothing to wait for
+        self.assertTrue(d.called)
@@ -0,0 +1,48 @@
+from unittest import TestCase
+
+from gepris_crawler.details_aggregator import DetailsItemAggregator
+
+
+class DetailsItemAggregatorTest(TestCase):
+
+    def test_complete_item(self):
+        # setup
+        aggregator = DetailsItemAggregator()
+        aggregator.open(1, ['de', 'en'])
+        # test
+        first = aggregator.add(1, 'en', {'name_en': 'p1'})
+        # a retried part replaces the earlier one
+        retried = aggregator.add(1, 'en', {'name_en': 'p1 retried'})
+        complete = aggregator.add(1, 'de', {'name_de': 'p1'})
+        # assertions
+        self.assertIsNone(first)
+        self.assertIsNone(retried)
+        self.assertDictEqual({'de': {'name_de': 'p1'}, 'en': {'name_en': 'p1 retried'}}, complete)
+        self.assertEqual(0, len(aggregator))
+
+    def test_expect_more_parts(self):
+        # setup
+        aggregator = DetailsItemAggregator()
+        aggregator.open(1, ['de'])
+        # test
+        expected = aggregator.expect(1, 'result_de')
+        first = aggregator.add(1, 'de', {})
+        complete = aggregator.add(1, 'result_de', {})
+        # assertions
+        self.assertTrue(expected)
+        self.assertIsNone(first)
+        self.assertDictEqual({'de': {}, 'result_de': {}}, complete)
+        self.assertFalse(aggregator.expect(1, 'result_en'))
+
+    def test_discard(self):
+        # setup
+        aggregator = DetailsItemAggregator()
+        aggregator.open(1, ['de', 'en'])
+        # test
+        first_discard = aggregator.discard(1)
+        second_discard = aggregator.discard(1)
+        late_part = aggregator.add(1, 'de', {})
+        # assertions
+        self.assertTrue(first_discard)
+        self.assertFalse(second_discard)
+        self.assertIsNone(late_part)
@@ -1,9 +1,15 @@
+import asyncio
+from itertools import islice
 from unittest import TestCase, skip
+from unittest.mock import Mock
 
 import scrapy
+from twisted.python.failure import Failure
 from psycopg2.extras import Json
 from pypika import Query
 
+from gepris_crawler.custom_exceptions import PageDoesNotExistAnymoreError
+from gepris_crawler.parser_pool import _extract_in_worker
 from gepris_crawler.spiders.details import DetailsSpider
 from test.resources import responses, get_settings, get_test_database
 
@@ -27,17 +33,73 @@ class DetailsSpiderTest(TestCase):
         self.db.close()
 
         # parsing test
-        spider = DetailsSpider(context='person', ids='[0,1]', settings=self.settings)
-        self.assertIsInstance(spider.ids, set)
+        spider = DetailsSpider(context='person', ids='[0,1,0]', settings=self.settings)
         self.assertListEqual(list(spider.ids),  [0, 1])
+        spider.closed(spider)
 
         spider = DetailsSpider(context='projekt', ids='db:needed:4', settings=self.settings)
-        self.assertIsInstance(spider.ids, set)
         self.assertListEqual(list(spider.ids),  [1, 2])
+        spider.closed(spider)
 
         spider = DetailsSpider(context='projekt', ids='db:all:4', settings=self.settings)
-        self.assertIsInstance(spider.ids, set)
         self.assertListEqual(list(spider.ids),  [1, 2, 3, 4])
+        spider.closed(spider)
+
+        spider = DetailsSpider(context='projekt', ids='db:all:4', settings=self.settings)
+        self.assertListEqual([1, 2], list(islice(spider.ids, 2)))
+        spider.closed(spider)
+
+    def test_closing_ids_closes_rows(self):
+        # setup
+        closed_rows = []
+
+        def rows():
+            try:
+                yield from [(1, None), (2, 'hash2'), (3, None)]
+            finally:
+                closed_rows.append(True)
+
+        spider = DetailsSpider(context='projekt', ids='[1]', settings=get_settings(database=False))
+        spider.ids = spider._ids_with_item_hashes(rows())
+
+        # test
+        first_id = next(spider.ids)
+        spider.closed(spider)
+
+        # assertions
+        # the rows (like the server side cursor of the database ids) end with the ids, not when they are collected
+        self.assertEqual(1, first_id)
+        self.assertListEqual([True], closed_rows)
+
+    def test_resume_db_ids(self):
+        # setup
+        settings = get_settings(database=True)
+        db = get_test_database(settings)
+        db.store_run('search_results', 'person')
+        resumed_run = db.store_run('details', 'person')
+        items = Query.into('available_items')
+        for element_id in range(1, 7):
+            # the resumed run of "db:all:4" checked the ids 1 and 2, then it was killed
+            last_detail_check = resumed_run if element_id <= 2 else None
+            items = items.insert(element_id, 'person', 1, 1, None, last_detail_check, False)
+        db.execute_sql(items.get_sql())
+        db.close()
+
+        # test
+        spider = DetailsSpider(context='person', ids='db:all:4', resume=str(resumed_run), settings=settings)
+        spider.settings = settings
+        spider.crawler = Mock()
+        requests = list(spider.start_requests())
+        spider.closed(spider)
+        completed_spider = DetailsSpider(context='person', ids='db:all:2', resume=str(resumed_run), settings=settings)
+        ids_after_all_completed = list(completed_spider.ids)
+        completed_spider.closed(completed_spider)
+
+        # assertions
+        # only the 2 ids left of the 4 are requested
+        self.assertListEqual([3, 4], [request.cb_kwargs['element_id'] for request in requests])
+        self.assertEqual(2, spider.requested_ids_count)
+        self.assertListEqual([], ids_after_all_completed)
 
     def test_projekt_without_result(self):
         expected_item = {
@@ -58,39 +120,38 @@ class DetailsSpiderTest(TestCase):
                 'female_personen': []
             }
         }
-        request = self._test_parse_german_projekt('projekt', 289879542, 'details/projekt_289879542_de_22102021.html')
-        item = request.cb_kwargs['project_item']
-        self.assertIsInstance(item, scrapy.Item)
+        item = self._test_parse_german_projekt('projekt', 289879542, 'details/projekt_289879542_de_22102021.html')
         self.assertEqual(dict(item), expected_item)
-        self.assertEqual(request.url, 'https://gepris.dfg.de/gepris/projekt/289879542?language=en')
 
-        item = self._test_parse_german_projekt('projekt', 289879542, 'details/projekt_289879542_en_22102021.html',
-                                               request=request)
-        self.assertIsInstance(item, scrapy.Item)
+        # the item is complete, when both pages arrived
+        spider = DetailsSpider(context='projekt', ids='[289879542]', settings=get_settings(database=False))
+        spider.aggregator.open(289879542, ['de', 'en'])
+        german = spider.parse_german(responses.fake_response_from_file('details/projekt_289879542_de_22102021.html'),
+                                     289879542)
+        english_response = responses.fake_response_from_file('details/projekt_289879542_en_22102021.html')
+        self.assertEqual(english_response.meta['expected_language'], 'en')
+        result = spider.parse_english_project(english_response, 289879542)
+        self.assertListEqual([], german)
+        self.assertEqual(1, len(result))
+        self.assertIsInstance(result[0], scrapy.Item)
         expected_item['name_en'] = 'Integrated Research Training Group (MGK)'
         expected_item['beschreibung_en'] = expected_item['beschreibung_de']
-        self.assertEqual(dict(item), expected_item)
+        self.assertEqual(dict(result[0]), expected_item)
 
     def test_project_with_mitverantwortliche(self):
-        request = self._test_parse_german_projekt('projekt', 491343583, 'details/projekt_491343583_de_12122021.html')
-        item = request.cb_kwargs['project_item']
-        self.assertIsInstance(item, scrapy.Item)
+        item = self._test_parse_german_projekt('projekt', 491343583, 'details/projekt_491343583_de_12122021.html')
         self.assertCountEqual([134389277, 1395277], item['attributes']['female_personen'])
         self.assertEqual([1395277], item['attributes']['mit_verantwortliche_personen'])
 
     def test_projekt_with_igk_attributes(self):
-        request = self._test_parse_german_projekt('projekt', 317513741, 'details/projekt_317513741_de_15122021.html')
-        item = request.cb_kwargs['project_item']
-        self.assertIsInstance(item, scrapy.Item)
+        item = self._test_parse_german_projekt('projekt', 317513741, 'details/projekt_317513741_de_15122021.html')
         attributes = item['attributes']
         self.assertCountEqual([35982322, 20753636, 361115666], attributes['igk_institutionen'])
         self.assertEqual([242325003], attributes['igk_personen'])
         self.assertIn(242325003, attributes['female_personen'])
 
     def test_projekt_with_attribute_without_key(self):
-        request = self._test_parse_german_projekt('projekt', 443011404, 'details/projekt_443011404_de_15122021.html')
-        item = request.cb_kwargs['project_item']
-        self.assertIsInstance(item, scrapy.Item)
+        item = self._test_parse_german_projekt('projekt', 443011404, 'details/projekt_443011404_de_15122021.html')
         # just to make sure the attribute is not added
         self.assertEqual(7, len(item['attributes']))
 
@@ -98,6 +159,118 @@ class DetailsSpiderTest(TestCase):
     def test_projekt_with_result(self):
         self.fail()
 
+    def test_projekt_result_parts(self):
+        # setup
+        spider = DetailsSpider(context='projekt', ids='[1]', settings=get_settings(database=False))
+        spider.aggregator.open(1, ['de', 'en'])
+
+        # test
+        requests = spider.german_extracted(1, {'id': 1, 'name_de': 'p1'},
+                                           'https://gepris.dfg.de/gepris/projekt/1/ergebnisse',
+                                           dict(page_hash='page1'))
+        english = spider.part_arrived(1, 'en', {'name_en': 'p1 en'})
+        result_de = spider.part_arrived(1, 'result_de', {'ergebnis_zusammenfassung_de': 'Zusammenfassung'})
+        result_en = spider.part_arrived(1, 'result_en', {'ergebnis_zusammenfassung_en': 'Summary'})
+
+        # assertions
+        self.assertListEqual(['de', 'en'], [request.meta['expected_language'] for request in requests])
+        self.assertListEqual([dict(element_id=1, english=False), dict(element_id=1, english=True)],
+                             [request.cb_kwargs for request in requests])
+        self.assertListEqual([], english)
+        self.assertListEqual([], result_de)
+        self.assertDictEqual({'id': 1, 'name_de': 'p1', 'name_en': 'p1 en',
+                              'result': {'ergebnis_zusammenfassung_de': 'Zusammenfassung',
+                                         'ergebnis_zusammenfassung_en': 'Summary'}}, dict(result_en[0]))
+        self.assertEqual(0, len(spider.aggregator))
+
+    def test_unchanged_german_page(self):
+        # setup
+        settings = get_settings(database=False)
+        spider = DetailsSpider(context='projekt', ids='[1,2]', settings=settings)
+        spider.settings = settings
+        spider.crawler = Mock()
+        spider.skip_unchanged_pages = True
+        spider.known_page_states = {1: dict(page_hash='page1', etag='"e1"', last_modified=None, body_hash='b1'),
+                                    2: dict(page_hash='page2', etag=None, last_modified=None, body_hash='b2')}
+
+        # test
+        requests = list(spider.start_requests())
+        unchanged = spider.german_extracted(1, {'id': 1, 'name_de': 'p1'}, None, dict(page_hash='page1'))
+        changed = spider.german_extracted(2, {'id': 2, 'name_de': 'p2 changed'},
+                                          'https://gepris.dfg.de/gepris/projekt/2/ergebnisse',
+                                          dict(page_hash='page2 changed'))
+
+        # assertions
+        # the english pages are only fetched if the german page changed
+        self.assertListEqual(['de', 'de'], [request.meta['expected_language'] for request in requests])
+        self.assertEqual(b'"e1"', requests[0].headers.get('If-None-Match'))
+        self.assertListEqual([304], requests[0].meta['handle_httpstatus_list'])
+        self.assertListEqual([], unchanged)
+        self.assertListEqual(['en', 'de', 'en'], [request.meta['expected_language'] for request in changed])
+        self.assertEqual(1, len(spider.aggregator))
+        spider.crawler.stats.inc_value.assert_called_once_with('item_unchanged_count')
+
+    def test_start_reads_ids_in_chunks(self):
+        # setup
+        settings = get_settings(database=False)
+        spider = DetailsSpider(context='person', ids='[1,2,3]', settings=settings)
+        spider.settings = settings
+        spider.crawler = Mock()
+        chunks = []
+        read_ids = spider._read_ids
+
+        def read_chunk(chunk_size=1000):
+            d = read_ids(chunk_size=2)
+            d.addCallback(lambda chunk: chunks.append(chunk) or chunk)
+            return d
+        spider._read_ids = read_chunk
+
+        async def collect():
+            return [request async for request in spider.start()]
+
+        # test
+        requests = asyncio.run(collect())
+
+        # assertions
+        self.assertListEqual([[1, 2], [3], []], chunks)
+        self.assertListEqual([1, 2, 3], [request.cb_kwargs['element_id'] for request in requests])
+
+    def test_page_fingerprint(self):
+        spider = DetailsSpider(context='person', ids='[215969423]', settings=get_settings(database=False))
+        response = responses.fake_response_from_file('details/person_215969423_de_22102021.html')
+        # only the content of the page is part of the fingerprint
+        changed_navigation = response.replace(body=response.body.replace(b'</head>', b'<!-- 1 --></head>'))
+        self.assertEqual(spider.page_fingerprint(response), spider.page_fingerprint(changed_navigation))
+
+    def test_part_failed(self):
+        # setup
+        spider = DetailsSpider(context='projekt', ids='[1]', settings=get_settings(database=False))
+        spider.crawler = Mock()
+        spider.aggregator.open(1, ['de', 'en'])
+        spider.known_page_states[1] = dict(page_hash='page1')
+        spider.page_states[1] = dict(page_hash='page1 changed')
+        request = scrapy.Request('https://gepris.dfg.de/gepris/projekt/1', cb_kwargs=dict(element_id=1))
+        moved = Failure(PageDoesNotExistAnymoreError('moved'))
+        moved.request = request
+        timeout = Failure(TimeoutError('timeout'))
+        timeout.request = request
+
+        # test
+        moved_result = spider.part_failed(moved)
+        still_open = len(spider.aggregator)
+        timeout_result = spider.part_failed(timeout)
+
+        # assertions
+        # the failures of the page checks are handled by the ExceptionHandlerMiddleware
+        self.assertIs(moved, moved_result)
+        self.assertEqual(1, still_open)
+        self.assertIsNone(timeout_result)
+        self.assertEqual(0, len(spider.aggregator))
+        # the page state of a discarded item is never written
+        self.assertDictEqual({}, spider.page_states)
+        self.assertDictEqual({}, spider.known_page_states)
+        spider.crawler.stats.inc_value.assert_called_once_with('item_discarded_count')
+
     def test_person(self):
         item = {
             'id': 215969423,
@@ -225,24 +398,58 @@ class DetailsSpiderTest(TestCase):
                                                           'details/institution_12957_de_22102021.html')
         self.assertDictEqual(result_dict, item)
 
+    def test_extract_in_worker(self):
+        # setup
+        spider = DetailsSpider(context='person', ids='[215969423]', settings=get_settings(database=False))
+        response = responses.fake_response_from_file('details/person_215969423_de_22102021.html')
+
+        # test
+        extracted = _extract_in_worker(DetailsSpider, 'person', 'extract_german', response.url, response.body,
+                                       response.encoding, dict(element_id=215969423))
+
+        # assertions
+        german, result_url, page_hash = extracted
+        self.assertIs(type(german), dict)
+        self.assertIsNone(result_url)
+        self.assertTupleEqual(spider.extract_german(response, 215969423), extracted)
+        spider.aggregator.open(215969423, ['de'])
+        self.assertIsInstance(spider.german_extracted(215969423, german, result_url, dict(page_hash=page_hash))[0],
+                              scrapy.Item)
+
+    def test_for_parsing(self):
+        # setup
+        response = responses.fake_response_from_file('details/person_215969423_de_22102021.html')
+
+        # test
+        spider = DetailsSpider.for_parsing('person')
+        german, result_url, _ = spider.extract_german(response, 215969423)
+
+        # assertions
+        # the spider has no ids and no state of a run
+        self.assertIsNone(spider.db)
+        self.assertFalse(hasattr(spider, 'ids'))
+        self.assertFalse(hasattr(spider, 'aggregator'))
+        self.assertEqual(215969423, german['id'])
+        self.assertIsNone(result_url)
+        self.assertRaises(ValueError, DetailsSpider.for_parsing, 'unknown')
+
     def _test_parse_german_non_projekt(self, context, element_id, file):
         spider = DetailsSpider(context=context, ids=f'[{element_id}]', settings=get_settings(database=False))
         response = responses.fake_response_from_file(file)
         self.assertEqual(response.meta['expected_language'], 'de')
+        spider.aggregator.open(element_id, ['de'])
         result = spider.parse_german(response, element_id)
-        self.assertIsInstance(result, scrapy.Item)
-        return dict(result)
+        self.assertEqual(1, len(result))
+        self.assertIsInstance(result[0], scrapy.Item)
+        return dict(result[0])
 
-    def _test_parse_german_projekt(self, context, element_id, file, request=None):
+    def _test_parse_german_projekt(self, context, element_id, file):
+        """
+        @return: dict of the german part of the projekt
+        """
         spider = DetailsSpider(context=context, ids=f'[{element_id}]', settings=get_settings(database=False))
-        response = responses.fake_response_from_file(file, request=request)
-        if request is None:
-            result = spider.parse_german(response, element_id)
-            self.assertIsInstance(result, scrapy.Request)
-            # current lang is de
-            self.assertEqual(response.meta['expected_language'], 'de')
-            # next lang is en
-            self.assertEqual(result.meta['expected_language'], 'en')
-        else:
-            result = spider.parse_english_project(response, response.cb_kwargs['project_item'])
-        return result
+        response = responses.fake_response_from_file(file)
+        self.assertEqual(response.meta['expected_language'], 'de')
+        german, result_url, _ = spider.extract_german(response, element_id)
+        self.assertIsNone(result_url)
+        return german
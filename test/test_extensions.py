@@ -0,0 +1,118 @@
+from unittest import TestCase
+from unittest.mock import Mock
+
+from scrapy.http import HtmlResponse, Request
+from scrapy.utils.test import get_crawler
+
+from gepris_crawler.extensions import AdaptiveConcurrency, percentile
+from gepris_crawler.middlewares import RETRY_REASON_LANGUAGE
+
+
+class AdaptiveConcurrencyTest(TestCase):
+
+    def test_percentile(self):
+        self.assertIsNone(percentile([], 50))
+        self.assertEqual(2, percentile([1, 2, 3], 50))
+        self.assertEqual(8, percentile(list(range(10)), 90))
+        self.assertEqual(0, percentile(list(range(10)), 0))
+
+    def test_increase_on_low_latency(self):
+        # setup
+        extension, slot = self._get_extension(ADAPTIVE_CONCURRENCY_START=2)
+        self._receive(extension, [0.5] * 5)
+        # test
+        extension.adjust()
+        # assertion
+        self.assertEqual(3, extension.concurrency)
+        self.assertEqual(3, slot.concurrency)
+        self.assertEqual(1, extension.stats.get_value('adaptive_concurrency/decisions/increase'))
+        self.assertEqual(3, extension.stats.get_value('adaptive_concurrency/max_concurrency'))
+
+    def test_increase_is_bounded(self):
+        # setup
+        extension, slot = self._get_extension(ADAPTIVE_CONCURRENCY_START=4, ADAPTIVE_CONCURRENCY_MAX=8,
+                                              CONCURRENT_REQUESTS=4)
+        self._receive(extension, [0.5] * 5)
+        # test
+        extension.adjust()
+        # assertion
+        self.assertEqual(4, extension.concurrency)
+
+    def test_hold_with_few_responses(self):
+        # setup
+        extension, slot = self._get_extension(ADAPTIVE_CONCURRENCY_START=2)
+        self._receive(extension, [0.5] * 2)
+        # test
+        extension.adjust()
+        # assertion
+        self.assertEqual(2, extension.concurrency)
+        self.assertEqual(1, extension.stats.get_value('adaptive_concurrency/decisions/hold'))
+
+    def test_decrease_on_ban_status(self):
+        # setup
+        extension, slot = self._get_extension(ADAPTIVE_CONCURRENCY_START=6)
+        self._receive(extension, [0.5] * 9)
+        self._receive(extension, [0.5], status=429)
+        # test
+        extension.adjust()
+        # assertion
+        self.assertEqual(3, extension.concurrency)
+        self.assertEqual(3, slot.concurrency)
+        self.assertEqual(1, extension.stats.get_value('adaptive_concurrency/decisions/decrease'))
+        self.assertEqual(3, extension.stats.get_value('adaptive_concurrency/min_concurrency'))
+
+    def test_decrease_on_retry_reason(self):
+        # setup
+        extension, slot = self._get_extension(ADAPTIVE_CONCURRENCY_START=2)
+        self._receive(extension, [0.5] * 10)
+        extension.stats.inc_value(f'retry/reason_count/{RETRY_REASON_LANGUAGE}')
+        # test
+        extension.adjust()
+        decreased = extension.concurrency
+        # the retry is only counted once
+        self._receive(extension, [0.5] * 10)
+        extension.adjust()
+        # assertion
+        self.assertEqual(1, decreased)
+        self.assertEqual(2, extension.concurrency)
+
+    def test_decrease_on_high_latency(self):
+        # setup
+        extension, slot = self._get_extension(ADAPTIVE_CONCURRENCY_START=2, ADAPTIVE_CONCURRENCY_MAX_LATENCY=10)
+        self._receive(extension, [1] * 8 + [20] * 2)
+        # test
+        extension.adjust()
+        # assertion
+        self.assertEqual(1, extension.concurrency)
+        self.assertEqual(20, extension.stats.get_value('adaptive_concurrency/latency_p90'))
+
+    def test_delay_backoff_at_min_concurrency(self):
+        # setup
+        extension, slot = self._get_extension(ADAPTIVE_CONCURRENCY_START=1, ADAPTIVE_CONCURRENCY_MIN=1,
+                                              ADAPTIVE_CONCURRENCY_BACKOFF_DELAY=1, DOWNLOAD_DELAY=0.25)
+        delays = []
+        # test
+        for status in [429, 429, 200, 200, 200]:
+            self._receive(extension, [0.5] * 5, status=status)
+            extension.adjust()
+            delays.append(slot.delay)
+        # assertion
+        # the delay is doubled on bans, then halved down to the DOWNLOAD_DELAY before the concurrency grows
+        self.assertListEqual([1, 2, 1, 0.25, 0.25], delays)
+        self.assertEqual(2, extension.concurrency)
+        self.assertEqual(2, extension.stats.get_value('adaptive_concurrency/max_delay'))
+
+    def _get_extension(self, **settings):
+        crawler = get_crawler(settings_dict=dict(ADAPTIVE_CONCURRENCY_ENABLED=True, **settings))
+        crawler._apply_settings()
+        slot = Mock(concurrency=8)
+        extension = AdaptiveConcurrency(Mock(settings=crawler.settings, stats=crawler.stats,
+                                             engine=Mock(downloader=Mock(slots={'gepris.dfg.de': slot},
+                                                                         per_slot_settings={}))))
+        return extension, slot
+
+    def _receive(self, extension, latencies, status=200):
+        for latency in latencies:
+            request = Request('https://gepris.dfg.de/gepris/projekt/1',
+                              meta=dict(download_latency=latency, download_slot='gepris.dfg.de'))
+            extension.response_received(HtmlResponse(request.url, status=status, request=request), request, None)
@@ -15,6 +15,113 @@ class DatabaseTest(TestCase):
     def tearDown(self):
         self.db.close()
 
+    def test_detail_check_priority(self):
+        # setup
+        self.db.execute_sql(Query.into('spider_runs')
+                            .insert(1, 'details', 'projekt', datetime(2022, 1, 1), datetime(2022, 1, 1), 1)
+                            .insert(2, 'details', 'projekt', datetime(2022, 1, 2), datetime(2022, 1, 2), 1)
+                            .get_sql()
+                            )
+
+        # test
+        self.db.execute_sql(Query.into('available_items')
+                            .columns('id', 'context', 'last_detail_check', 'detail_check_needed')
+                            .insert(1, 'projekt', None, True)
+                            .insert(2, 'projekt', 1, False)
+                            .get_sql()
+                            )
+        priorities_after_insert = self.db.execute_sql('SELECT id, detail_check_priority = \'-infinity\','
+                                                      ' detail_check_priority FROM available_items ORDER BY id',
+                                                      fetch=True)
+        self.db.execute_sql('UPDATE available_items SET last_detail_check = 2')
+        priorities_after_update = self.db.execute_sql('SELECT id, detail_check_priority FROM available_items'
+                                                      ' ORDER BY id', fetch=True)
+
+        # assertions
+        self.assertListEqual([1, 2], [row[0] for row in priorities_after_insert])
+        self.assertTrue(priorities_after_insert[0][1])
+        self.assertEqual(datetime(2022, 1, 1), priorities_after_insert[1][2].replace(tzinfo=None))
+        self.assertListEqual([datetime(2022, 1, 2), datetime(2022, 1, 2)],
+                             [row[1].replace(tzinfo=None) for row in priorities_after_update])
+
+    def test_latest_detail_items_table(self):
+        # setup
+        self.db.execute_sql(Query.into('spider_runs')
+                            .insert(1, 'details', 'projekt', datetime(2022, 1, 1), datetime(2022, 1, 1), 1)
+                            .insert(2, 'details', 'projekt', datetime(2022, 1, 3), datetime(2022, 1, 3), 1)
+                            .insert(3, 'details', 'projekt', datetime(2022, 1, 2), datetime(2022, 1, 2), 1)
+                            .get_sql()
+                            )
+        self.db.execute_sql(Query.into('available_items')
+                            .insert(1, 'projekt', None, None, None, 2, False)
+                            .get_sql()
+                            )
+
+        # test
+        self.db.execute_sql(Query.into('details_items_history')
+                            .insert(1, 'projekt', 1, Json({'name_de': 'v1'}), 'success')
+                            .insert(1, 'projekt', 2, None, 'moved')
+                            .insert(1, 'projekt', 3, Json({'name_de': 'v3'}), 'success')
+                            .get_sql()
+                            )
+        latest_after_insert = self.db.execute_sql('SELECT * FROM latest_detail_items', fetch=True)
+        self.db.execute_sql('DELETE FROM details_items_history WHERE created_at = 2')
+        latest_after_delete = self.db.execute_sql('SELECT * FROM latest_detail_items', fetch=True)
+
+        # assertions
+        # run 2 started last, even though it was inserted before run 3
+        self.assertListEqual([(1, 'projekt', 2, None, 'moved', None)], latest_after_insert)
+        self.assertListEqual([(1, 'projekt', 3, {'name_de': 'v3'}, 'success', None)], latest_after_delete)
+
+    def test_archive_details_items_history_partition(self):
+        # setup
+        self.db.execute_sql(Query.into('spider_runs')
+                            .insert(1, 'details', 'projekt', datetime(2022, 1, 1), datetime(2022, 1, 1), 1)
+                            .insert(2, 'details', 'projekt', datetime(2022, 1, 2), datetime(2022, 1, 2), 1)
+                            .insert(1000, 'details', 'projekt', datetime(2022, 1, 3), datetime(2022, 1, 3), 1)
+                            .get_sql()
+                            )
+        self.db.execute_sql(Query.into('available_items')
+                            .insert(1, 'projekt', None, None, None, 1000, False)
+                            .insert(2, 'projekt', None, None, None, 2, False)
+                            .get_sql()
+                            )
+        self.db.execute_sql(Query.into('details_items_history')
+                            .insert(1, 'projekt', 1, Json({'name_de': 'v1'}), 'success')
+                            .insert(1, 'projekt', 2, Json({'name_de': 'v2'}), 'success')
+                            .insert(2, 'projekt', 2, Json({'name_de': 'v2'}), 'success')
+                            .insert(1, 'projekt', 1000, Json({'name_de': 'v1000'}), 'success')
+                            .get_sql()
+                            )
+        partitions = self.db.execute_sql('SELECT tableoid::regclass::text, created_at FROM details_items_history'
+                                         ' ORDER BY created_at', fetch=True)
+
+        # test
+        self.db.execute_sql("SELECT archive_details_items_history_partition('details_items_history_projekt_0',"
+                            " 'details_items_history_projekt_0.csv.gz')")
+        history = self.db.execute_sql('SELECT id, created_at FROM details_items_history', fetch=True)
+        baseline = self.db.execute_sql('SELECT id, created_at, item FROM details_items_baseline ORDER BY id',
+                                       fetch=True)
+        archived = self.db.execute_sql('SELECT archive_file FROM details_items_history_partitions'
+                                       ' WHERE archived_at IS NOT NULL', fetch=True)
+        self.db.execute_sql('DELETE FROM details_items_history WHERE created_at = 1000')
+        latest_after_delete = self.db.execute_sql('SELECT id, created_at FROM latest_detail_items ORDER BY id',
+                                                  fetch=True)
+        as_of_run_2 = self.db.execute_sql('SELECT id, created_at FROM detail_items_as_of(2) ORDER BY id',
+                                          fetch=True)
+
+        # assertions
+        self.assertListEqual([('details_items_history_projekt_0', 1),
+                              ('details_items_history_projekt_0', 2),
+                              ('details_items_history_projekt_0', 2),
+                              ('details_items_history_projekt_1000', 1000)], partitions)
+        self.assertListEqual([(1, 1000)], history)
+        self.assertListEqual([(1, 2, {'name_de': 'v2'}), (2, 2, {'name_de': 'v2'})], baseline)
+        self.assertListEqual([('details_items_history_projekt_0.csv.gz',)], archived)
+        # the latest version falls back to the baseline
+        self.assertListEqual([(1, 2), (2, 2)], latest_after_delete)
+        self.assertListEqual([(1, 2), (2, 2)], as_of_run_2)
+
     def test_projekte_references_view(self):
         # setup
         self.db.execute_sql(Query.into('spider_runs')
@@ -48,6 +155,133 @@ class DatabaseTest(TestCase):
         self.assertCountEqual([(4, 1, 'unternehmen_institutionen'),
                                (5, 1, 'partner_organisation_institutionen')], institution_projekt_references)
 
+    def test_projekte_references_follow_latest_item(self):
+        # setup
+        self.db.execute_sql(Query.into('spider_runs')
+                            .insert(1, 'details', 'projekt', datetime(2022, 1, 1), datetime(2022, 1, 1), 1)
+                            .insert(2, 'details', 'projekt', datetime(2022, 1, 2), datetime(2022, 1, 2), 1)
+                            .get_sql()
+                            )
+        self.db.execute_sql(Query.into('available_items')
+                            .insert(1, 'projekt', None, None, None, 2, False)
+                            .get_sql()
+                            )
+        self.db.execute_sql(Query.into('details_items_history')
+                            .insert(1, 'projekt', 1,
+                                    Json({'attributes': {'antragsteller_personen': [2, 3]}}),
+                                    'success')
+                            .get_sql()
+                            )
+
+        # test
+        self.db.execute_sql(Query.into('details_items_history')
+                            .insert(1, 'projekt', 2,
+                                    Json({'attributes': {'antragsteller_personen': [3],
+                                                         'unternehmen_institutionen': [4]}}),
+                                    'success')
+                            .get_sql()
+                            )
+        person_references_after_change = self.db.execute_sql('SELECT * FROM latest_person_projekt_references',
+                                                             fetch=True)
+        institution_references_after_change = self.db.execute_sql(
+            'SELECT * FROM latest_institution_projekt_references', fetch=True)
+        self.db.execute_sql('DELETE FROM details_items_history')
+        person_references_after_delete = self.db.execute_sql('SELECT * FROM latest_person_projekt_references',
+                                                             fetch=True)
+
+        # assertions
+        self.assertListEqual([(3, 1, 'antragsteller_personen')], person_references_after_change)
+        self.assertListEqual([(4, 1, 'unternehmen_institutionen')], institution_references_after_change)
+        self.assertListEqual([], person_references_after_delete)
+
+    def test_refresh_gepris_schema(self):
+        # setup
+        self.db.execute_sql(Query.into('spider_runs')
+                            .insert(1, 'details', 'projekt', datetime(2022, 1, 1), datetime(2022, 1, 1), 1)
+                            .insert(2, 'details', 'projekt', datetime(2022, 1, 2), datetime(2022, 1, 2), 1)
+                            .get_sql()
+                            )
+        self.db.execute_sql(Query.into('available_items')
+                            .insert(1, 'projekt', None, None, None, 1, False)
+                            .insert(2, 'person', None, None, None, 1, False)
+                            .insert(3, 'person', None, None, None, 1, False)
+                            .insert(4, 'institution', None, None, None, 1, False)
+                            .get_sql()
+                            )
+        self.db.execute_sql(Query.into('details_items_history')
+                            .insert(1, 'projekt', 1,
+                                    Json({'name_de': 'Testprojekt',
+                                          'attributes': {'antragsteller_personen': [2, 3],
+                                                         'male_personen': [2],
+                                                         'unternehmen_institutionen': [4]}}),
+                                    'success')
+                            .insert(2, 'person', 1, Json({'name_de': 'Person 2'}), 'success')
+                            .insert(3, 'person', 1, Json({'name_de': 'Person 3'}), 'success')
+                            .insert(4, 'institution', 1, Json({'name_de': 'Institution 4'}), 'success')
+                            .get_sql()
+                            )
+
+        # test
+        self.db.execute_sql('SELECT refresh_gepris_schema()')
+        personen_after_rebuild = self.db.execute_sql('SELECT id, gender FROM personen', fetch=True)
+        personen_projekte_after_rebuild = self.db.execute_sql('SELECT * FROM personen_projekte', fetch=True)
+        self.db.execute_sql(Query.into('details_items_history')
+                            .insert(1, 'projekt', 2,
+                                    Json({'name_de': 'Testprojekt',
+                                          'attributes': {'antragsteller_personen': [3],
+                                                         'female_personen': [3]}}),
+                                    'success')
+                            .insert(2, 'person', 2, None, 'moved')
+                            .get_sql()
+                            )
+        self.db.execute_sql('SELECT refresh_gepris_schema(1)')
+        personen_after_refresh = self.db.execute_sql('SELECT id, gender FROM personen', fetch=True)
+        personen_projekte_after_refresh = self.db.execute_sql('SELECT * FROM personen_projekte', fetch=True)
+        institutionen_projekte_after_refresh = self.db.execute_sql('SELECT * FROM institutionen_projekte', fetch=True)
+
+        # assertions
+        self.assertCountEqual([(2, 'male'), (3, None)], personen_after_rebuild)
+        self.assertCountEqual([(2, 1, 'antragsteller_personen'),
+                               (3, 1, 'antragsteller_personen')], personen_projekte_after_rebuild)
+        self.assertListEqual([(3, 'female')], personen_after_refresh)
+        self.assertListEqual([(3, 1, 'antragsteller_personen')], personen_projekte_after_refresh)
+        self.assertListEqual([], institutionen_projekte_after_refresh)
+
+    def test_refresh_institutionen_with_new_child(self):
+        # setup
+        self.db.execute_sql(Query.into('spider_runs')
+                            .insert(1, 'details', 'institution', datetime(2022, 1, 1), datetime(2022, 1, 1), 1)
+                            .insert(2, 'details', 'institution', datetime(2022, 1, 2), datetime(2022, 1, 2), 1)
+                            .get_sql()
+                            )
+        self.db.execute_sql(Query.into('available_items')
+                            .insert(1, 'institution', None, None, None, 1, False)
+                            .insert(2, 'institution', None, None, None, 1, False)
+                            .insert(3, 'institution', None, None, None, 2, False)
+                            .get_sql()
+                            )
+        self.db.execute_sql(Query.into('details_items_history')
+                            .insert(1, 'institution', 1,
+                                    Json({'name_de': 'Institution 1',
+                                          'trees': {'normalised_subinstitutions': [{'2': ['3']}]}}),
+                                    'success')
+                            .insert(2, 'institution', 1, Json({'name_de': 'Institution 2'}), 'success')
+                            .get_sql()
+                            )
+        self.db.execute_sql('SELECT refresh_gepris_schema()')
+
+        # test
+        # the trees of 1 and 2 did not change, only the new child 3 was scraped
+        self.db.execute_sql(Query.into('details_items_history')
+                            .insert(3, 'institution', 2, Json({'name_de': 'Institution 3'}), 'success')
+                            .get_sql()
+                            )
+        self.db.execute_sql('SELECT refresh_gepris_schema(1)')
+        institutionen = self.db.execute_sql('SELECT id, uebergeordnete_institution FROM institutionen', fetch=True)
+
+        # assertions
+        self.assertCountEqual([(1, None), (2, 1), (3, 2)], institutionen)
+
     def test_institutionen_hierarchy_view(self):
         # setup
         self.db.execute_sql(Query.into('spider_runs')
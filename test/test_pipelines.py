@@ -1,9 +1,37 @@
 from unittest import TestCase, skip
 from unittest.mock import Mock, patch
-from gepris_crawler.pipelines import EmailNotifierPipeline
+from gepris_crawler.items import ProjectItem
+from gepris_crawler.pipelines import EmailNotifierPipeline, CanonicalisationPipeline
 from test.resources import get_settings, get_test_database, get_sample_dm_item
 
 
+class CanonicalisationPipelineTest(TestCase):
+
+    def test_canonical_item(self):
+        # setup
+        spider = Mock()
+        spider.name = 'details'
+        item = ProjectItem(id=1,
+                           name_de='  Ein\t Projekt ',
+                           beschreibung_de='Erste  Zeile \n zweite Zeile',
+                           attributes={'male_personen': [3, 1, 2], 'antragsteller_personen': [3, 1],
+                                       'fachrichtungen': ['b', 'a']})
+
+        # test
+        canonical_item = CanonicalisationPipeline().process_item(item, spider)
+
+        # assertions
+        self.assertIsInstance(canonical_item, ProjectItem)
+        self.assertEqual('Ein Projekt', canonical_item['name_de'])
+        self.assertEqual('Erste Zeile\nzweite Zeile', canonical_item['beschreibung_de'])
+        self.assertListEqual(['antragsteller_personen', 'fachrichtungen', 'male_personen'],
+                             list(canonical_item['attributes'].keys()))
+        self.assertListEqual([1, 2, 3], canonical_item['attributes']['male_personen'])
+        self.assertListEqual([1, 3], canonical_item['attributes']['antragsteller_personen'])
+        # the order of other lists can have a meaning
+        self.assertListEqual(['b', 'a'], canonical_item['attributes']['fachrichtungen'])
+
+
 class ItemNotifierPipelineTest(TestCase):
 
     def setUp(self):
@@ -23,7 +51,7 @@ class ItemNotifierPipelineTest(TestCase):
                 return default_value
 
         stats = Mock(get_value=Mock(side_effect=get_value_func), get_stats=Mock(return_value={}))
-        spider = Mock(db=self.db, had_error=False, crawler=Mock(stats=stats))
+        spider = Mock(db=self.db, had_error=False, delta=False, crawler=Mock(stats=stats))
         spider.name = name
         return spider
 
@@ -93,6 +121,35 @@ class ItemNotifierPipelineTest(TestCase):
             self.assertEqual(mock_send.call_args.args[0],
                              "Warning - GeprisCrawler - Spider 'search_results' - context 'projekt' - 100 (-1) items")
 
+    def test_search_results_no_mail_delta_run(self):
+        # setup
+        pipeline = self.get_pipeline()
+        spider = self.mock_spider('search_results', 100)
+        spider.context = 'projekt'
+        spider.delta = True
+        spider.requested_items_count = 100
+        self.db.insert_data_monitor_run(get_sample_dm_item(project=1000))
+        with patch('gepris_crawler.pipelines.EmailNotifierPipeline._send') as mock_send:
+            # test
+            pipeline.close_spider(spider)
+            # assertion
+            mock_send.assert_not_called()
+
+    def test_search_results_send_mail_delta_run_with_missing_items(self):
+        # setup
+        pipeline = self.get_pipeline()
+        spider = self.mock_spider('search_results', 100)
+        spider.context = 'projekt'
+        spider.delta = True
+        spider.requested_items_count = 120
+        with patch('gepris_crawler.pipelines.EmailNotifierPipeline._send') as mock_send:
+            # test
+            pipeline.close_spider(spider)
+            # assertion
+            mock_send.assert_called_once()
+            self.assertEqual(mock_send.call_args.args[0],
+                             "Warning - GeprisCrawler - Spider 'search_results' - context 'projekt' - 100 (-20) items")
+
     def test_search_results_no_mail_less_person_than_on_last_dm_run(self):
         # setup
         pipeline = self.get_pipeline()
@@ -138,7 +195,7 @@ class ItemNotifierPipelineTest(TestCase):
         # setup
         pipeline = self.get_pipeline()
         spider = self.mock_spider('details', 100)
-        spider.ids = [i for i in range(101)]
+        spider.requested_ids_count = 101
         spider.context = 'projekt'
         with patch('gepris_crawler.pipelines.EmailNotifierPipeline._send') as mock_send:
             # test
@@ -152,7 +209,7 @@ class ItemNotifierPipelineTest(TestCase):
         # setup
         pipeline = self.get_pipeline()
         spider = self.mock_spider('details', 15000)
-        spider.ids = [i for i in range(15000)]
+        spider.requested_ids_count = 15000
         spider.context = 'projekt'
         with patch('gepris_crawler.pipelines.EmailNotifierPipeline._send') as mock_send:
             # test
@@ -166,7 +223,7 @@ class ItemNotifierPipelineTest(TestCase):
         # setup
         pipeline = self.get_pipeline()
         spider = self.mock_spider('details', 100)
-        spider.ids = [i for i in range(100)]
+        spider.requested_ids_count = 100
         spider.context = 'projekt'
         with patch('gepris_crawler.pipelines.EmailNotifierPipeline._send') as mock_send:
             # test
@@ -178,7 +235,7 @@ class ItemNotifierPipelineTest(TestCase):
         # setup
         pipeline = self.get_pipeline()
         spider = self.mock_spider('details', 99, items_moved=1)
-        spider.ids = [i for i in range(100)]
+        spider.requested_ids_count = 100
         spider.context = 'projekt'
         with patch('gepris_crawler.pipelines.EmailNotifierPipeline._send') as mock_send:
             # test
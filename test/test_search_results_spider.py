@@ -1,8 +1,12 @@
 import unittest
 import types
+from unittest.mock import Mock
 
 import scrapy
 
+from gepris_crawler.database import hash_item
+from gepris_crawler.items import SearchResultItem
+from gepris_crawler.normalisation.canonicalisation import canonicalise
 from gepris_crawler.spiders.search_results import SearchResultsSpider
 from test.resources import responses, get_settings
 
@@ -114,6 +118,64 @@ class SearchResultsSpiderTest(unittest.TestCase):
         items = [i for i in result]
         self.assertListEqual(items, [])
 
+    def test_search_results_order(self):
+        # the delta mode relies on the order of the search results by id, the newest items are on the last pages
+        first_items = self._test_parse('projekt', 'search_results/projekt_10_5_21102021.html', 5)
+        last_items = self._test_parse('projekt', 'search_results/projekt_131490_5_03122021.html', 5,
+                                      check_items_count=False)
+        ids = [item['id'] for item in first_items + last_items]
+        self.assertListEqual(sorted(ids), ids)
+
+    def test_delta_mode(self):
+        # setup
+        settings = get_settings(database=False)
+        settings.set('SEARCH_RESULTS_DELTA_UNCHANGED_PAGES', 2)
+        spider = SearchResultsSpider(context='projekt', items=5, settings=settings)
+        spider.settings = settings
+        spider.crawler = Mock()
+        spider.delta = True
+        spider.total_items = 98
+        items = [SearchResultItem(id=item_id, name_de=f' p{item_id}') for item_id in range(1, 6)]
+        stored_hashes = {item['id']: hash_item(canonicalise(item)) for item in items}
+        changed_hashes = {**stored_hashes, 1: 'changed'}
+        spider.db = Mock(get_available_item_hashes=Mock(
+            side_effect=[stored_hashes, stored_hashes, changed_hashes, stored_hashes, stored_hashes]))
+
+        # test
+        requests = []
+        for page_index in [0, 95, 90, 85, 80]:
+            # without the database buffer the stored hashes are read directly, so the Deferreds fired already
+            spider.next_delta_request(page_index, items).addCallback(requests.append)
+
+        # assertions
+        # after the first page the pages are fetched from the last one backwards,
+        # the first page does not count, after the second unchanged page in a row since the last change the run stops
+        self.assertListEqual([1, 1, 1, 1, 0], [len(page_requests) for page_requests in requests])
+        self.assertListEqual([95, 90, 85, 80], [page_requests[0].cb_kwargs['page_index']
+                                                for page_requests in requests[:4]])
+        self.assertEqual(3, requests[0][0].cb_kwargs['items_on_page'])
+        self.assertEqual(spider.parse_delta, requests[0][0].callback)
+        self.assertEqual(3 + 5 + 5 + 5, spider.requested_items_count)
+        spider.crawler.stats.set_value.assert_called_once_with('delta/stopped_at_index', 80)
+
+    def test_delta_mode_falls_back_to_full_run(self):
+        # setup
+        settings = get_settings(database=False)
+        spider = SearchResultsSpider(context='projekt', items=1000, settings=settings)
+        spider.crawler = Mock()
+        spider.delta = True
+        spider.total_items = 2500
+        spider.db = Mock(get_latest_dm_stat=Mock(return_value=2500), count_available_items=Mock(return_value=2499))
+
+        # test
+        requests = list(spider.start_requests())
+
+        # assertions
+        # an item disappeared or was not found by the delta runs, so all pages are fetched
+        self.assertFalse(spider.delta)
+        self.assertEqual(3, len(requests))
+        spider.db.get_latest_dm_stat.assert_called_once_with('project_count')
+
     def _test_parse(self, context, file, items_per_page, check_items_count=True):
         spider = SearchResultsSpider(context=context, items=items_per_page, settings=get_settings(database=False))
         result = spider.parse(responses.fake_response_from_file(file), items_per_page)